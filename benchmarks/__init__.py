@@ -0,0 +1,7 @@
+"""Benchmarks of Topaz on synthetic notebooks.
+
+    python -m benchmarks.generate 10k
+    python -m benchmarks.run 1k 10k --out benchmarks/results/today.json
+    python -m benchmarks.compare old.json new.json
+    python -m benchmarks.memory 100k
+"""
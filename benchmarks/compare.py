@@ -0,0 +1,57 @@
+"""Compare two benchmark results and report regressions.
+
+    python -m benchmarks.compare baseline.json current.json
+
+Exit status is 1 if a median got slower by more than the threshold.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+THRESHOLD = 0.2
+# Differences below this are noise.
+MIN_DELTA_MS = 0.05
+METRIC = 'median_ms'
+
+
+def compare(baseline, current, threshold=THRESHOLD, metric=METRIC) -> list:
+    "Return (size, name, old_ms, new_ms, change, is_regression) rows."
+    rows = []
+    for size, results in current['results'].items():
+        old_results = baseline['results'].get(size, {})
+        for name, stats in results.items():
+            if name not in old_results:
+                continue
+            old, new = old_results[name][metric], stats[metric]
+            change = (new - old) / old if old else 0.0
+            is_regression = (
+                change > threshold and new - old > MIN_DELTA_MS
+            )
+            rows.append((size, name, old, new, change, is_regression))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('baseline', type=Path)
+    parser.add_argument('current', type=Path)
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--metric', default=METRIC)
+    args = parser.parse_args(argv)
+
+    baseline = json.loads(args.baseline.read_text())
+    current = json.loads(args.current.read_text())
+    print(f'{baseline["meta"]["commit"]} -> {current["meta"]["commit"]}')
+    rows = compare(baseline, current, args.threshold, args.metric)
+    for size, name, old, new, change, is_regression in rows:
+        mark = 'REGRESSION' if is_regression else ''
+        print(
+            f'{size:>5} {name:<28} {old:9.2f} -> {new:9.2f} ms'
+            f' {change:+7.1%} {mark}'
+        )
+    return 1 if any(row[-1] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
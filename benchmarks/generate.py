@@ -0,0 +1,112 @@
+"""Synthetic notebook generator.
+
+Words and tags follow Zipf-like distributions like in real notes:
+a few tags are on many notes, most tags are rare, a note has 0-5 tags.
+Text length varies around TEXT_WORDS words. Notebooks are written
+with ManageDb.import_notes(), so the files have every index the app
+uses, including the similar notes graph.
+"""
+import random
+import sys
+from datetime import datetime, timedelta
+from itertools import accumulate
+from pathlib import Path
+
+from models import ManageDb
+
+DATA_DIR = Path(__file__).parent / 'data'
+SIZES = {'1k': 1_000, '10k': 10_000, '100k': 100_000, '1M': 1_000_000}
+SEED = 6543
+VOCABULARY = 30_000
+TAGS = 500
+TEXT_WORDS = 80
+TITLE_WORDS = 3
+# Probability of a note having 0, 1, 2, ... tags.
+TAG_COUNT_WEIGHTS = (20, 35, 25, 12, 5, 3)
+SYLLABLES = (
+    'ka', 'to', 'ri', 'ne', 'sa', 'mo', 'lu', 'pe', 'di', 'ra',
+    'zo', 've', 'chi', 'bo', 'ta', 'ni', 'gu', 'le', 'fa', 'shi',
+)
+START_DATE = datetime(2023, 1, 1)
+
+
+def parse_size(size) -> int:
+    return SIZES[size] if size in SIZES else int(size)
+
+
+def notebook_path(size) -> Path:
+    return DATA_DIR / f'notes-{size}.db'
+
+
+def make_words(rng, count) -> list:
+    "Pronounceable distinct words."
+    words = set()
+    while len(words) < count:
+        words.add(''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))))
+    return sorted(words)
+
+
+def zipf_weights(count) -> list:
+    """Cumulative Zipf weights, for cum_weights of random.choices():
+    with plain weights it sums them again on every call.
+    """
+    return list(accumulate(1 / rank for rank in range(1, count + 1)))
+
+
+def synthetic_notes(count, seed=SEED):
+    "Yield notes for ManageDb.import_notes(), oldest first."
+    rng = random.Random(seed)
+    words = make_words(rng, VOCABULARY)
+    word_weights = zipf_weights(VOCABULARY)
+    tags = [f'#{word}' for word in rng.sample(words, TAGS)]
+    tag_weights = zipf_weights(TAGS)
+    tag_count_weights = list(accumulate(TAG_COUNT_WEIGHTS))
+    # Spread notes over three years
+    step = timedelta(days=3 * 365) / max(count, 1)
+
+    for i in range(count):
+        length = max(1, int(rng.lognormvariate(0, 0.8) * TEXT_WORDS))
+        tag_count = rng.choices(
+            range(len(TAG_COUNT_WEIGHTS)), cum_weights=tag_count_weights
+        )[0]
+        yield {
+            'title': ' '.join(
+                rng.choices(words, cum_weights=word_weights, k=TITLE_WORDS)
+            ),
+            'text': ' '.join(
+                rng.choices(words, cum_weights=word_weights, k=length)
+            ),
+            'tags': list(set(
+                rng.choices(tags, cum_weights=tag_weights, k=tag_count)
+            )),
+            'created_at': (START_DATE + step * i).strftime('%Y-%m-%d %H:%M:%S'),
+        }
+
+
+def generate(size, path=None, progress=None) -> Path:
+    "Create notebook with size notes, replacing an existing file."
+    path = Path(path or notebook_path(size))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    for suffix in ('', '-wal', '-shm'):
+        Path(f'{path}{suffix}').unlink(missing_ok=True)
+
+    db = ManageDb(path)
+    db.create_tables()
+    db.import_notes(synthetic_notes(parse_size(size)), progress=progress)
+    db.close()
+    return path
+
+
+def ensure_notebook(size) -> Path:
+    "Generated notebook for size, made only once."
+    path = notebook_path(size)
+    if not path.exists():
+        generate(size, path)
+    return path
+
+
+if __name__ == '__main__':
+    for size in sys.argv[1:] or SIZES:
+        print(f'Generating {size} notes...')
+        generate(size, progress=lambda done: print(f'{done} notes', end='\r'))
+        print(f'\n{notebook_path(size)}')
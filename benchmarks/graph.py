@@ -0,0 +1,65 @@
+"""Similar notes graph computation with 1..N worker processes.
+
+Times reading and scoring all notes of a generated notebook, without
+writing the graph, for every number of workers, and prints notes per
+second and speedup over one process.
+
+    python -m benchmarks.graph 100k --workers 1 2 4 8
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.generate import ensure_notebook
+from models import ManageDb
+from similarity import MIN_SCORE, TOP_K, compute_graph
+from similarity_pool import compute_graph_parallel
+
+
+def compute_time(db, workers) -> float:
+    cursor = db.connect_to_db().cursor()
+    start = time.perf_counter()
+    if workers > 1:
+        compute_graph_parallel(cursor, workers, TOP_K, MIN_SCORE)
+    else:
+        compute_graph(cursor, TOP_K, MIN_SCORE)
+    return time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('sizes', nargs='*', default=['10k'])
+    parser.add_argument(
+        '--workers', nargs='+', type=int,
+        default=sorted({1, 2, 4, os.cpu_count() or 1})
+    )
+    args = parser.parse_args(argv)
+
+    report = {}
+    for size in args.sizes:
+        source = ensure_notebook(size)
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / source.name
+            shutil.copyfile(source, path)
+            db = ManageDb(path)
+            db.create_tables()
+            notes = db.stats()['notes']
+            report[size] = {}
+            for workers in args.workers:
+                seconds = compute_time(db, workers)
+                report[size][workers] = seconds
+                print(
+                    f'{size}: {workers} workers {seconds:.1f} s,'
+                    f' {notes / seconds:.0f} notes/s,'
+                    f' speedup {report[size][args.workers[0]] / seconds:.2f}'
+                )
+            db.close()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Memory used by loaded notes, bytes per note.
+
+Loads every note of a generated notebook page by page, like the grid
+does when scrolled to the end, into the layout NotesModel used before
+NoteStore (dict of tuples with tag lists, lists of ids) and into
+NoteStore with arrays of ids, and measures both with tracemalloc.
+
+    python -m benchmarks.memory 100k
+"""
+import gc
+import json
+import shutil
+import sys
+import tempfile
+import tracemalloc
+from array import array
+from pathlib import Path
+
+from benchmarks.generate import ensure_notebook, parse_size
+from models import PAGE_SIZE, ManageDb
+from note_store import NoteStore
+
+
+def iter_pages(db):
+    after = None
+    while True:
+        page = db.get_notes_page(after, PAGE_SIZE)
+        if not page:
+            return
+        yield page
+        last_id = next(reversed(page))
+        after = (page[last_id][3], last_id)
+
+
+def load_dict(db):
+    notes, loaded_ids = {}, []
+    for page in iter_pages(db):
+        notes.update(page)
+        loaded_ids.extend(page)
+    return notes, loaded_ids, list(loaded_ids)
+
+
+def load_store(db):
+    notes, loaded_ids = NoteStore(), array('q')
+    for page in iter_pages(db):
+        notes.update(page)
+        loaded_ids.extend(page)
+    return notes, loaded_ids, array('q', loaded_ids)
+
+
+def measure(load, db) -> int:
+    "Bytes still allocated after load() returns, while its result lives."
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = load(db)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return used
+
+
+def main(argv=None):
+    sizes = (argv if argv is not None else sys.argv[1:]) or ['100k']
+    report = {}
+    for size in sizes:
+        source = ensure_notebook(size)
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / source.name
+            shutil.copyfile(source, path)
+            # Cached pages would be shared with load_dict(), not counted
+            db = ManageDb(path, query_cache_bytes=0)
+            db.create_tables()
+            # Warm up page cache and statement cache
+            measure(load_store, db)
+            notes = parse_size(size)
+            report[size] = {
+                'dict_of_tuples': measure(load_dict, db) / notes,
+                'note_store': measure(load_store, db) / notes,
+            }
+            db.close()
+        print(
+            f'{size}: dict of tuples {report[size]["dict_of_tuples"]:.0f}'
+            f' B/note, NoteStore {report[size]["note_store"]:.0f} B/note'
+        )
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""Time ManageDb operations, search and the notes grid.
+
+Every size runs on a copy of its generated notebook, the copy is
+removed afterwards. Results are written as JSON, compare two runs
+with benchmarks.compare.
+
+    python -m benchmarks.run 1k 10k --out results.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks.generate import ensure_notebook, parse_size
+from models import ManageDb
+
+REPEATS = 50
+# Whole database reads are slow on large notebooks.
+FULL_READ_REPEATS = 3
+GUI_REPEATS = 5
+GRID_PAGES = 10
+SEARCH_QUERIES = ('ka', 'tori', 'sa ne', 'mo lu pe', 'zzzz')
+SEED = 9
+
+
+def summarize(samples) -> dict:
+    "Milliseconds statistics of seconds samples."
+    ms = sorted(sample * 1000 for sample in samples)
+    return {
+        'n': len(ms),
+        'mean_ms': statistics.fmean(ms),
+        'median_ms': statistics.median(ms),
+        'p95_ms': ms[min(len(ms) - 1, round(0.95 * (len(ms) - 1)))],
+        'max_ms': ms[-1],
+    }
+
+
+def measure(func, args_list) -> dict:
+    "Call func once per args tuple, return timing statistics."
+    samples = []
+    for args in args_list:
+        start = time.perf_counter()
+        func(*args)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def bench_db(db, repeats) -> dict:
+    rng = random.Random(SEED)
+    results = {}
+    words = ' '.join(f'word{i}' for i in range(60))
+
+    # Every start of the app, the schema is current
+    results['create_tables'] = measure(db.create_tables, [()] * repeats)
+
+    results['insert_data_in_tables'] = measure(
+        db.insert_data_in_tables,
+        [
+            (f'bench {i}', words, [f'#bench{i % 7}', '#benchmark'])
+            for i in range(repeats)
+        ]
+    )
+
+    note_ids = [
+        row[0] for row in db.connect_to_db().execute('SELECT id FROM note;')
+    ]
+    targets = rng.sample(note_ids, min(repeats, len(note_ids)))
+    results['update_data'] = measure(
+        db.update_data,
+        [
+            (note_id, f'updated {note_id}', words, ['#updated'])
+            for note_id in targets
+        ]
+    )
+
+    results['get_all_data_from_db'] = measure(
+        db.get_all_data_from_db, [()] * FULL_READ_REPEATS
+    )
+
+    # Walk pages like the grid does while scrolling
+    samples = []
+    after = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        page = db.get_notes_page(after)
+        samples.append(time.perf_counter() - start)
+        if not page:
+            after = None
+            continue
+        note_id, (*_, created_at) = next(reversed(page.items()))
+        after = (created_at, note_id)
+    results['get_notes_page'] = summarize(samples)
+
+    results['search_notes'] = measure(
+        db.search_notes,
+        [(SEARCH_QUERIES[i % len(SEARCH_QUERIES)],) for i in range(repeats)]
+    )
+
+    # Same queries again, answered by the query cache
+    cached_db = ManageDb(db.db_name)
+    results['search_notes_cached'] = measure(
+        cached_db.search_notes,
+        [(SEARCH_QUERIES[i % len(SEARCH_QUERIES)],) for i in range(repeats)]
+    )
+    cached_db.close()
+
+    # Editor checks what user typed before the note is saved
+    results['find_duplicates'] = measure(
+        db.find_duplicates,
+        [(f'bench {i}', words) for i in range(repeats)]
+    )
+
+    # Worst case for the similar notes graph: notes most others link
+    # to get unrelated text, every neighbour loses its edge
+    hubs = [
+        row[0] for row in db.connect_to_db().execute(
+            '''SELECT other_id FROM note_edge
+                GROUP BY other_id
+                ORDER BY COUNT(*) DESC, other_id
+                LIMIT ?;''',
+            (repeats,)
+        )
+    ]
+    results['update_linked_note'] = measure(
+        db.update_data,
+        [
+            (note_id, f'unrelated {note_id}', words, ['#updated'])
+            for note_id in hubs
+        ]
+    )
+
+    results['delete_note'] = measure(
+        db.delete_note, [(note_id,) for note_id in targets]
+    )
+    return results
+
+
+def bench_gui(db) -> dict:
+    "Offscreen MainWindow startup and grid paging."
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PyQt6 import QtWidgets
+
+    from topaz import MainWindow
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    first_paint = []
+    interactive = []
+    paging = []
+    for _ in range(GUI_REPEATS):
+        window = MainWindow(db)
+        # Notes are loaded on a worker thread
+        while window.interactive_time is None:
+            app.processEvents()
+            time.sleep(0.0005)
+        first_paint.append(window.first_paint_time)
+        interactive.append(window.interactive_time)
+
+        model = window.notes_model
+        start = time.perf_counter()
+        for _ in range(GRID_PAGES):
+            if not model.canFetchMore():
+                break
+            model.fetchMore()
+            app.processEvents()
+        paging.append(time.perf_counter() - start)
+
+        window.close()
+        window.deleteLater()
+        app.processEvents()
+    return {
+        'time_to_first_paint': summarize(first_paint),
+        'time_to_interactive': summarize(interactive),
+        f'grid_fetch_{GRID_PAGES}_pages': summarize(paging),
+    }
+
+
+def bench_size(size, repeats, gui=True) -> dict:
+    source = ensure_notebook(size)
+    with tempfile.TemporaryDirectory() as directory:
+        path = Path(directory) / source.name
+        shutil.copyfile(source, path)
+        # Timings of queries themselves, comparable between runs
+        db = ManageDb(path, query_cache_bytes=0)
+        db.create_tables()
+        results = bench_db(db, repeats)
+        if gui:
+            results.update(bench_gui(db))
+        db.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata() -> dict:
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('sizes', nargs='*', default=['1k', '10k'])
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--no-gui', action='store_true')
+    parser.add_argument('--out', type=Path)
+    args = parser.parse_args(argv)
+
+    report = {'meta': metadata(), 'results': {}}
+    for size in args.sizes:
+        print(f'{size} ({parse_size(size)} notes)')
+        report['results'][size] = results = bench_size(
+            size, args.repeats, gui=not args.no_gui
+        )
+        for name, stats in results.items():
+            print(
+                f'  {name:<28} median {stats["median_ms"]:9.2f} ms'
+                f'  p95 {stats["p95_ms"]:9.2f} ms'
+            )
+
+    out = args.out or Path(__file__).parent / 'results' / (
+        f'{report["meta"]["commit"] or "run"}-'
+        f'{datetime.now():%Y%m%d-%H%M%S}.json'
+    )
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(report, indent=2))
+    print(out)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,365 @@
+"""Near-duplicate notes with MinHash and locality-sensitive hashing.
+
+Every note gets a MinHash signature over its shingles, runs of SHINGLE
+words of the title and text. Two signatures agree in a position with
+probability equal to the Jaccard similarity of the shingle sets, so
+the share of equal positions estimates it.
+
+The signature is cut into BANDS bands of ROWS values and minhash_band
+maps a hash of every band to the note. Notes sharing any band are
+candidates: near-identical notes almost surely share one, unrelated
+ones almost never, so a lookup reads a few index rows instead of every
+note. Candidates are then scored with their stored signatures.
+
+Methods take a cursor and run inside the caller's transaction, like
+SimilarityGraph. Bodies are read with note_text().
+"""
+import hashlib
+import zlib
+from functools import cache
+from itertools import batched, chain
+
+from instrumentation import instrumented
+from similarity import WORD_RE
+from sql_params import chunked
+
+SHINGLE = 3
+BANDS = 16
+ROWS = 4
+HASHES = BANDS * ROWS
+# Estimated Jaccard similarity from which notes are duplicates. With
+# 16 bands of 4 rows a pair at 0.7 is a candidate with probability
+# 0.99, a pair at 0.3 with 0.12.
+MIN_SCORE = 0.7
+# A lookup scores at most this many candidates.
+CANDIDATES = 200
+# Longer notes are compared by their first MAX_WORDS words.
+MAX_WORDS = 20000
+# Words hashed at once by index_notes(), HASHES * 8 bytes each; the
+# arrays of a smaller batch stay in CPU cache.
+BATCH_WORDS = 8192
+# Notes tokenized with one regex call by index_notes().
+TOKENIZE_NOTES = 256
+# Put between notes tokenized at once. Their text is lowercased, so
+# no word of a note is equal to it.
+SEPARATOR_WORD = 'NOTEEND'
+# Signatures compared at once by groups().
+COMPARE_ROWS = 64
+SEED = b'topaz-minhash'
+# Odd multiplier combining values of a band into its bucket.
+BUCKET_MIX = 0x9E3779B97F4A7C15
+
+SCHEMA = [
+    # Signature as little-endian uint32 array of HASHES values.
+    '''CREATE TABLE IF NOT EXISTS note_minhash (
+        note_id INTEGER PRIMARY KEY,
+        signature BLOB,
+        FOREIGN KEY (note_id) REFERENCES note (id) ON DELETE CASCADE
+        );''',
+    # No foreign key: remove_note() deletes rows by the primary key,
+    # cascade would scan the table for every deleted note.
+    '''CREATE TABLE IF NOT EXISTS minhash_band (
+        band INTEGER,
+        bucket INTEGER,
+        note_id INTEGER,
+        PRIMARY KEY (band, bucket, note_id)
+        ) WITHOUT ROWID;''',
+]
+
+
+def note_words(title, text) -> list:
+    words = WORD_RE.findall(f'{title or ""} {text or ""}'.lower())
+    return words[:MAX_WORDS]
+
+
+def notes_words(notes) -> list:
+    """note_words() of a list of (title, text) pairs, with one regex
+    call for all of them.
+    """
+    separator = f' {SEPARATOR_WORD} '
+    words = WORD_RE.findall(separator.join(
+        f'{title or ""} {text or ""}'.lower() for title, text in notes
+    ))
+    lists = []
+    start = 0
+    for _ in range(len(notes) - 1):
+        end = words.index(SEPARATOR_WORD, start)
+        lists.append(words[start:min(end, start + MAX_WORDS)])
+        start = end + 1
+    if notes:
+        lists.append(words[start:start + MAX_WORDS])
+    return lists
+
+
+def word_hash(word) -> int:
+    "Hash of a word, the same in every process, unlike hash()."
+    return zlib.crc32(word.encode('utf-8'))
+
+
+class WordHashes(dict):
+    "word -> word_hash(word), every distinct word is hashed once."
+    def __missing__(self, word):
+        value = self[word] = word_hash(word)
+        return value
+
+
+@cache
+def hash_params() -> tuple:
+    """Multipliers of words in a shingle and (a, b) of the HASHES
+    multiply-shift functions (a * x + b) >> 32 over 64-bit integers,
+    derived from SEED so stored signatures stay valid.
+    """
+    import numpy as np
+
+    values = np.array(
+        [
+            int.from_bytes(
+                hashlib.blake2b(SEED + i.to_bytes(4, 'little'), digest_size=8)
+                .digest(), 'little'
+            ) | 1
+            for i in range(SHINGLE + 2 * HASHES)
+        ],
+        dtype=np.uint64
+    )
+    return (
+        values[:SHINGLE],
+        values[SHINGLE:SHINGLE + HASHES, None],
+        values[SHINGLE + HASHES:, None],
+    )
+
+
+def signatures(word_lists, hashes=None):
+    """MinHash signatures, (notes, HASHES) uint32, of lists of words.
+    Every list must have a word. hashes is a WordHashes kept between
+    calls.
+
+    A note of n words has n shingles, the last ones padded with zeros,
+    so notes shorter than SHINGLE words get one too. Arithmetic wraps
+    around at 64 bits, no division is needed.
+    """
+    # Heavy import, needed only here
+    import numpy as np
+
+    multipliers, a, b = hash_params()
+    lengths = np.array([len(words) for words in word_lists], dtype=np.int64)
+    offsets = np.cumsum(lengths) - lengths
+    # Words of every note followed by SHINGLE - 1 zeros
+    starts = offsets + np.arange(len(lengths)) * (SHINGLE - 1)
+    first = np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+    padded = np.zeros(len(first) + (SHINGLE - 1) * len(lengths), np.uint64)
+    # Words are looked up by map(), without a Python loop per word
+    padded[first] = np.fromiter(
+        map(
+            (WordHashes() if hashes is None else hashes).__getitem__,
+            chain.from_iterable(word_lists)
+        ),
+        dtype=np.uint64, count=len(first)
+    )
+    shingles = np.zeros(len(first), dtype=np.uint64)
+    for i in range(SHINGLE):
+        shingles += padded[first + i] * multipliers[i]
+    hashed = a * shingles
+    hashed += b
+    hashed >>= np.uint64(32)
+    # Shingles of a note are consecutive, from its offset
+    return np.minimum.reduceat(hashed, offsets, axis=1).T.astype(np.uint32)
+
+
+def band_buckets(computed):
+    "Hash of every band of every signature, (notes, BANDS) int64."
+    import numpy as np
+
+    rows = computed.reshape(len(computed), BANDS, ROWS).astype(np.uint64)
+    buckets = rows[:, :, 0]
+    for i in range(1, ROWS):
+        # Wraps around, it is only a hash
+        buckets = buckets * np.uint64(BUCKET_MIX) + rows[:, :, i]
+    return buckets.view(np.int64)
+
+
+def pack(signature) -> bytes:
+    return signature.astype('<u4').tobytes()
+
+
+def unpack(blobs):
+    "Signatures from their blobs, (len(blobs), HASHES) uint32."
+    import numpy as np
+
+    return np.frombuffer(b''.join(blobs), dtype='<u4').reshape(-1, HASHES)
+
+
+@instrumented
+class DuplicateIndex:
+    "Keep MinHash signatures and LSH bands of notes up to date."
+    def __init__(self, min_score=MIN_SCORE):
+        self.min_score = min_score
+
+    def is_empty(self, cursor) -> bool:
+        return cursor.execute('SELECT 1 FROM note_minhash LIMIT 1;').fetchone() is None
+
+    def find(self, cursor, title, text, exclude=None) -> list:
+        """Return (note_id, score) of notes near-identical to the given
+        title and text, most similar first. exclude is the id of the
+        note being edited.
+        """
+        words = note_words(title, text)
+        if not words:
+            return []
+        signature = signatures([words])
+        buckets = band_buckets(signature)[0].tolist()
+        # A join, SQLite does not search the key for IN with row values
+        cursor.execute(
+            f'''SELECT DISTINCT b.note_id
+                FROM (VALUES {','.join('(?, ?)' for _ in buckets)}) AS v
+                JOIN minhash_band b
+                    ON b.band = v.column1 AND b.bucket = v.column2
+                LIMIT ?;''',
+            [value for band in enumerate(buckets) for value in band]
+            + [CANDIDATES + 1]
+        )
+        candidates = [note_id for note_id, in cursor.fetchall() if note_id != exclude]
+        found = []
+        for chunk in chunked(candidates):
+            placeholders = ','.join('?' for _ in chunk)
+            cursor.execute(
+                f'''SELECT note_id, signature FROM note_minhash
+                    WHERE note_id IN ({placeholders});''',
+                chunk
+            )
+            rows = cursor.fetchall()
+            if not rows:
+                continue
+            others = unpack([blob for _, blob in rows])
+            scores = (others == signature).mean(axis=1).tolist()
+            found.extend(
+                (note_id, score) for (note_id, _), score in zip(rows, scores)
+                if score >= self.min_score
+            )
+        return sorted(found, key=lambda x: -x[1])
+
+    def update_note(self, cursor, note_id):
+        "Index new or changed note."
+        row = cursor.execute(
+            'SELECT title, note_text(text) FROM note WHERE id=?;', (note_id,)
+        ).fetchone()
+        self.remove_note(cursor, note_id)
+        if row:
+            self.index_notes(cursor, [(note_id, *row)])
+
+    def remove_note(self, cursor, note_id):
+        "Drop the note from the index."
+        row = cursor.execute(
+            'SELECT signature FROM note_minhash WHERE note_id=?;', (note_id,)
+        ).fetchone()
+        if not row:
+            return
+        buckets = band_buckets(unpack([row[0]]))[0].tolist()
+        cursor.executemany(
+            'DELETE FROM minhash_band WHERE band=? AND bucket=? AND note_id=?;',
+            [(band, bucket, note_id) for band, bucket in enumerate(buckets)]
+        )
+        cursor.execute('DELETE FROM note_minhash WHERE note_id=?;', (note_id,))
+
+    def index_notes(self, cursor, notes):
+        """Add notes not in the index yet, an iterable of
+        (note_id, title, text). Notes without words are skipped.
+        """
+        hashes = WordHashes()
+        batch_ids, batch_words = [], []
+        size = 0
+        for chunk in batched(notes, TOKENIZE_NOTES):
+            word_lists = notes_words([(title, text) for _, title, text in chunk])
+            for (note_id, _, _), words in zip(chunk, word_lists):
+                if not words:
+                    continue
+                batch_ids.append(note_id)
+                batch_words.append(words)
+                size += len(words)
+                if size >= BATCH_WORDS:
+                    self.write(cursor, batch_ids, batch_words, hashes)
+                    batch_ids, batch_words = [], []
+                    size = 0
+        if batch_ids:
+            self.write(cursor, batch_ids, batch_words, hashes)
+
+    def write(self, cursor, note_ids, word_lists, hashes=None):
+        "Insert signatures and bands of a batch of notes."
+        computed = signatures(word_lists, hashes)
+        buckets = band_buckets(computed).tolist()
+        cursor.executemany(
+            'INSERT INTO note_minhash(note_id, signature) VALUES(?, ?);',
+            zip(note_ids, map(pack, computed))
+        )
+        cursor.executemany(
+            '''INSERT OR IGNORE INTO minhash_band(band, bucket, note_id)
+                VALUES(?, ?, ?);''',
+            (
+                (band, bucket, note_id)
+                for note_id, note_buckets in zip(note_ids, buckets)
+                for band, bucket in enumerate(note_buckets)
+            )
+        )
+
+    def rebuild(self, cursor):
+        "Index all notes from scratch."
+        cursor.execute('DELETE FROM minhash_band;')
+        cursor.execute('DELETE FROM note_minhash;')
+        # Separate cursor, index_notes() writes with the other one
+        reader = cursor.connection.cursor()
+        reader.execute('SELECT id, title, note_text(text) FROM note ORDER BY id;')
+        self.index_notes(cursor, reader)
+
+    def groups(self, cursor) -> list:
+        """Groups of near-identical notes in the whole notebook, lists
+        of note ids, biggest group first.
+
+        Notes sharing a band are scored pairwise, duplicates of
+        duplicates end up in one group.
+        """
+        import numpy as np
+
+        cursor.execute(
+            '''SELECT GROUP_CONCAT(note_id) FROM minhash_band
+                GROUP BY band, bucket
+                HAVING COUNT(*) > 1;'''
+        )
+        buckets = [
+            [int(note_id) for note_id in ids.split(',')]
+            for ids, in cursor.fetchall()
+        ]
+        note_ids = sorted({note_id for ids in buckets for note_id in ids})
+        stored = {}
+        for chunk in chunked(note_ids):
+            placeholders = ','.join('?' for _ in chunk)
+            cursor.execute(
+                f'''SELECT note_id, signature FROM note_minhash
+                    WHERE note_id IN ({placeholders});''',
+                chunk
+            )
+            stored.update(cursor.fetchall())
+
+        # Union-find, parent of every note which is not a root
+        parent = {}
+
+        def root(note_id):
+            while note_id in parent:
+                note_id = parent[note_id]
+            return note_id
+
+        for ids in buckets:
+            rows = unpack([stored[note_id] for note_id in ids])
+            for start in range(0, len(ids), COMPARE_ROWS):
+                block = rows[start:start + COMPARE_ROWS]
+                scores = (block[:, None, :] == rows[None, :, :]).mean(axis=2)
+                for i, j in np.argwhere(scores >= self.min_score).tolist():
+                    first, second = root(ids[start + i]), root(ids[j])
+                    if first != second:
+                        parent[max(first, second)] = min(first, second)
+
+        groups = {}
+        for note_id in note_ids:
+            groups.setdefault(root(note_id), []).append(note_id)
+        return sorted(
+            (ids for ids in groups.values() if len(ids) > 1),
+            key=lambda ids: (-len(ids), ids[0])
+        )
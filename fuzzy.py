@@ -0,0 +1,157 @@
+"""Typo-tolerant search over the vocabulary of notes.
+
+Words of titles, text and tags are already in the term table of the
+similar notes graph (similarity.py). term_trigram indexes them by
+trigrams with the FTS5 trigram tokenizer; triggers keep it in sync
+whenever a word appears in or disappears from the notes.
+
+A query word gives candidates sharing most trigrams with it, they are
+ranked by edit distance and the close ones are searched in note_fts
+together with the word itself.
+"""
+TRIGRAM = 3
+# Words sharing most trigrams with the query word, ranked by
+# edit distance afterwards.
+CANDIDATES = 200
+# Close words used for one query word.
+MAX_VARIANTS = 3
+
+SCHEMA = [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS term_trigram USING fts5(
+        name,
+        content='term',
+        content_rowid='id',
+        tokenize='trigram'
+        );''',
+    # df changes on every save and does not touch the index.
+    '''CREATE TRIGGER IF NOT EXISTS term_trigram_insert
+        AFTER INSERT ON term BEGIN
+            INSERT INTO term_trigram(rowid, name) VALUES (new.id, new.name);
+        END;''',
+    '''CREATE TRIGGER IF NOT EXISTS term_trigram_delete
+        AFTER DELETE ON term BEGIN
+            INSERT INTO term_trigram(term_trigram, rowid, name)
+                VALUES ('delete', old.id, old.name);
+        END;''',
+    '''CREATE TRIGGER IF NOT EXISTS term_trigram_update
+        AFTER UPDATE OF name ON term BEGIN
+            INSERT INTO term_trigram(term_trigram, rowid, name)
+                VALUES ('delete', old.id, old.name);
+            INSERT INTO term_trigram(rowid, name) VALUES (new.id, new.name);
+        END;''',
+]
+
+
+def create_index(cursor):
+    "Create term_trigram, index existing words if it is new."
+    exists = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'term_trigram';"
+    ).fetchone()
+    for statement in SCHEMA:
+        cursor.execute(statement)
+    if not exists:
+        cursor.execute(
+            "INSERT INTO term_trigram(term_trigram) VALUES ('rebuild');"
+        )
+
+
+def trigrams(word) -> list:
+    return list(dict.fromkeys(
+        word[i:i + TRIGRAM] for i in range(len(word) - TRIGRAM + 1)
+    ))
+
+
+def transposed_trigrams(word) -> list:
+    """Trigrams of adjacent transpositions of the word, not in the word.
+
+    A swap in the middle of a short word breaks all of its trigrams,
+    pyhton and python share none.
+    """
+    grams = dict.fromkeys(trigrams(word))
+    extra = {}
+    for i in range(len(word) - 1):
+        if word[i] != word[i + 1]:
+            swapped = word[:i] + word[i + 1] + word[i] + word[i + 2:]
+            extra.update(
+                (gram, None) for gram in trigrams(swapped) if gram not in grams
+            )
+    return list(extra)
+
+
+def max_typos(word) -> int:
+    "Edit distance allowed for a word of this length."
+    if len(word) < 4:
+        return 0
+    if len(word) < 8:
+        return 1
+    return 2
+
+
+def edit_distance(a, b, limit) -> int:
+    """Levenshtein distance with transpositions, limit + 1 if it is
+    larger than limit.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous_previous = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            cost = char_a != char_b
+            value = min(
+                previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost
+            )
+            if (
+                previous_previous and i > 1 and j > 1
+                and char_a == b[j - 2] and a[i - 2] == char_b
+            ):
+                value = min(value, previous_previous[j - 2] + 1)
+            current.append(value)
+        if min(current) > limit:
+            return limit + 1
+        previous_previous, previous = previous, current
+    return previous[-1]
+
+
+def close_words(cursor, word, grams, typos) -> list:
+    "(distance, -df, name) of candidates sharing grams, within typos."
+    cursor.execute(
+        '''SELECT t.name, t.df FROM term_trigram
+            JOIN term t ON t.id = term_trigram.rowid
+            WHERE term_trigram MATCH ?
+            ORDER BY rank
+            LIMIT ?;''',
+        (' OR '.join(f'"{gram}"' for gram in grams), CANDIDATES)
+    )
+    close = []
+    for name, df in cursor.fetchall():
+        if name == word:
+            continue
+        distance = edit_distance(word, name, typos)
+        if distance <= typos:
+            close.append((distance, -df, name))
+    return close
+
+
+def similar_words(cursor, word, limit=MAX_VARIANTS) -> list:
+    """Indexed words at the smallest edit distance from the word,
+    at most max_typos(word), most frequent first. The word itself
+    is not included.
+    """
+    word = word.lower()
+    typos = max_typos(word)
+    grams = trigrams(word)
+    if not typos or not grams:
+        return []
+    close = close_words(cursor, word, grams, typos)
+    if not close:
+        # A swapped pair may leave the word no trigram in common
+        grams = transposed_trigrams(word)
+        close = grams and close_words(cursor, word, grams, typos)
+    if not close:
+        return []
+    close.sort()
+    # A word one typo away beats any word two typos away
+    best = close[0][0]
+    return [name for distance, _, name in close[:limit] if distance == best]
@@ -0,0 +1,355 @@
+"""Force-directed layout of the similar notes graph and spatial queries
+over its nodes, in NumPy.
+
+layout() is Fruchterman-Reingold: edges pull their notes together,
+every pair of notes pushes apart. Pushing is approximated the way
+Barnes-Hut does it: nodes are bucketed into a quadtree of grids, a
+node feels each distant cell as one mass at its centre, and only the
+nodes of its own and adjacent finest cells one by one. Every step is
+a handful of array operations per tree level, so an iteration costs
+O(n log n) and no Python loop runs over nodes.
+
+SpatialGrid answers which nodes are in the visible rectangle and
+which node is under the cursor; aggregate_edges() merges edges between
+the same cells for drawing a zoomed out graph.
+"""
+import math
+
+import numpy as np
+
+ITERATIONS = 120
+# Iterations for placing new notes among the cached positions.
+REFINE_ITERATIONS = 30
+# Nodes per cell of the finest grid if they were spread evenly; they
+# cluster, so fewer make fewer pairs to push one by one.
+LEAF_SIZE = 1
+# Points whose far field is computed at once, bounds temporary arrays.
+FAR_CHUNK = 16384
+# Points per cell of SpatialGrid.
+GRID_CELL_POINTS = 4
+MAX_DEPTH = 10
+# Pull towards the centre, keeps unconnected notes from drifting away.
+GRAVITY = 1.0
+# Squared distance below which nodes count as this far apart.
+MIN_DISTANCE2 = 1e-4
+SEED = 7
+
+
+class Graph:
+    """Nodes and undirected edges of the similar notes graph.
+
+    Nodes are sorted note ids, edges are pairs of node indices with
+    the best score of the two directions. positions is an (n, 2)
+    array or None before layout.
+    """
+    __slots__ = ('note_ids', 'titles', 'sources', 'targets', 'weights', 'positions')
+
+    def __init__(self, note_ids, titles, edges):
+        order = np.argsort(np.asarray(note_ids, dtype=np.int64))
+        self.note_ids = np.asarray(note_ids, dtype=np.int64)[order]
+        self.titles = [titles[i] for i in order]
+        edges = np.asarray(edges, dtype=np.float64).reshape(-1, 3)
+        ends = np.searchsorted(self.note_ids, edges[:, :2].astype(np.int64))
+        ends = np.minimum(ends, max(len(self.note_ids) - 1, 0))
+        known = (
+            (self.note_ids[ends[:, 0]] == edges[:, 0])
+            & (self.note_ids[ends[:, 1]] == edges[:, 1])
+        ) if len(self.note_ids) else np.zeros(len(edges), dtype=bool)
+        ends, scores = np.sort(ends[known], axis=1), edges[known, 2]
+        # a -> b and b -> a are one edge
+        keys = ends[:, 0] * max(len(self.note_ids), 1) + ends[:, 1]
+        order = np.lexsort((-scores, keys))
+        first = np.flatnonzero(np.diff(keys[order], prepend=-1))
+        self.sources = ends[order[first], 0]
+        self.targets = ends[order[first], 1]
+        self.weights = scores[order[first]]
+        self.positions = None
+
+    def __len__(self):
+        return len(self.note_ids)
+
+    def index_of(self, note_id):
+        "Node index of the note or None."
+        i = int(np.searchsorted(self.note_ids, note_id))
+        if i < len(self.note_ids) and self.note_ids[i] == note_id:
+            return i
+        return None
+
+
+def far_field(points, cx, cy, level, positions, unit, k2) -> np.ndarray:
+    """Pushes on points in cells (cx, cy) of the 2**level grid from
+    cells whose parent is adjacent to the points' parent cell but
+    which are not adjacent to the points' cell. Closer cells are
+    handled on finer levels.
+    """
+    side = 2 ** level
+    # Two empty cells around the grid, so no offset needs bounds checks
+    padded = side + 4
+    gx, gy = (unit * side).astype(np.int64).T
+    cell = (gy + 2) * padded + gx + 2
+    mass = np.bincount(cell, minlength=padded * padded).astype(np.float64)
+    centre_x = np.bincount(cell, positions[:, 0], padded * padded)
+    centre_y = np.bincount(cell, positions[:, 1], padded * padded)
+    occupied = mass > 0
+    centre_x[occupied] /= mass[occupied]
+    centre_y[occupied] /= mass[occupied]
+
+    # The 6 x 6 children of the parent's neighbours, at once for a
+    # chunk of points
+    jx, jy = np.divmod(np.arange(36), 6)
+    offset = (jy * padded + jx)[:, None]
+    force = np.zeros_like(points)
+    for start in range(0, len(points), FAR_CHUNK):
+        part = slice(start, start + FAR_CHUNK)
+        odd_x, odd_y = cx[part] % 2, cy[part] % 2
+        far = ~(
+            (np.abs(jx[:, None] - 2 - odd_x) <= 1)
+            & (np.abs(jy[:, None] - 2 - odd_y) <= 1)
+        )
+        target = (cy[part] - odd_y) * padded + cx[part] - odd_x + offset
+        dx = points[part, 0] - centre_x[target]
+        dy = points[part, 1] - centre_y[target]
+        d2 = np.maximum(dx * dx + dy * dy, MIN_DISTANCE2)
+        push = k2 * mass[target] * far / d2
+        force[part, 0] = (dx * push).sum(axis=0)
+        force[part, 1] = (dy * push).sum(axis=0)
+    return force
+
+
+def repulsion(positions, k2) -> np.ndarray:
+    "Approximate sum of k2 / distance pushes on every node."
+    n = len(positions)
+    force = np.zeros_like(positions)
+    if n < 2:
+        return force
+    low = positions.min(axis=0)
+    size = float((positions.max(axis=0) - low).max()) or 1.0
+    # Unit square, the upper edge still falls into the last cell
+    unit = (positions - low) / (size * (1 + 1e-9))
+    depth = int(min(MAX_DEPTH, max(1, math.ceil(math.log(n / LEAF_SIZE, 4)))))
+    side = 2 ** depth
+    cx, cy = (unit * side).astype(np.int64).T
+    cell = cy * side + cx
+
+    # Distant cells of coarse levels push all nodes of a finest cell
+    # alike, they are evaluated once at the cell's centre of mass.
+    cells, node_cell = np.unique(cell, return_inverse=True)
+    count = np.bincount(node_cell).astype(np.float64)
+    centres = np.stack((
+        np.bincount(node_cell, positions[:, 0]) / count,
+        np.bincount(node_cell, positions[:, 1]) / count,
+    ), axis=1)
+    cell_y, cell_x = np.divmod(cells, side)
+    cell_force = np.zeros_like(centres)
+    for level in range(1, depth):
+        shift = depth - level
+        cell_force += far_field(
+            centres, cell_x >> shift, cell_y >> shift, level,
+            positions, unit, k2
+        )
+    force += cell_force[node_cell]
+    force += far_field(positions, cx, cy, depth, positions, unit, k2)
+
+    # Own and adjacent cells of the finest level, node by node
+    order = np.argsort(cell, kind='stable')
+    starts = np.searchsorted(cell[order], np.arange(side * side + 1))
+    nodes = np.arange(n)
+    for dx_cell in (-1, 0, 1):
+        for dy_cell in (-1, 0, 1):
+            tx, ty = cx + dx_cell, cy + dy_cell
+            inside = (tx >= 0) & (tx < side) & (ty >= 0) & (ty < side)
+            source = nodes[inside]
+            target = (ty * side + tx)[inside]
+            counts = starts[target + 1] - starts[target]
+            total = int(counts.sum())
+            if not total:
+                continue
+            i = np.repeat(source, counts)
+            j = order[
+                np.arange(total)
+                + np.repeat(starts[target] - np.cumsum(counts) + counts, counts)
+            ]
+            other = i != j
+            i, j = i[other], j[other]
+            delta = positions[i] - positions[j]
+            d2 = np.maximum((delta * delta).sum(axis=1), MIN_DISTANCE2)
+            push = k2 / d2
+            force[:, 0] += np.bincount(i, delta[:, 0] * push, n)
+            force[:, 1] += np.bincount(i, delta[:, 1] * push, n)
+    return force
+
+
+def attraction(positions, sources, targets, weights, k) -> np.ndarray:
+    "Sum of weight * distance^2 / k pulls along edges."
+    n = len(positions)
+    delta = positions[sources] - positions[targets]
+    pull = np.sqrt((delta * delta).sum(axis=1)) * weights / k
+    fx, fy = delta[:, 0] * pull, delta[:, 1] * pull
+    return np.stack((
+        np.bincount(targets, fx, n) - np.bincount(sources, fx, n),
+        np.bincount(targets, fy, n) - np.bincount(sources, fy, n),
+    ), axis=1)
+
+
+def layout(
+        graph, positions=None, movable=None, iterations=ITERATIONS,
+        seed=SEED, progress=None, is_cancelled=None
+):
+    """Positions of graph nodes as an (n, 2) array, ideal edge length 1.
+
+    positions are the starting ones, random by default. Only nodes
+    where movable is true move, all of them by default. progress is
+    called with the number of finished iterations. Returns None if
+    is_cancelled() becomes true.
+    """
+    n = len(graph)
+    rng = np.random.default_rng(seed)
+    side = math.sqrt(max(n, 1))
+    if positions is None:
+        positions = rng.uniform(-side / 2, side / 2, (n, 2))
+    positions = np.array(positions, dtype=np.float64)
+    if movable is None:
+        movable = np.ones(n, dtype=bool)
+    if n == 0 or not movable.any():
+        return positions
+    # Edge weights are scores, rescaled so the mean pull is 1
+    weights = graph.weights
+    if len(weights):
+        weights = weights / weights.mean()
+    k = 1.0
+    # The whole graph may move at first, new nodes only a little
+    start_step = side / 10 if movable.all() else 2.0
+    for iteration in range(iterations):
+        if is_cancelled and is_cancelled():
+            return None
+        step = start_step * (1 - iteration / iterations) + 0.01
+        force = repulsion(positions, k * k)
+        force += attraction(positions, graph.sources, graph.targets, weights, k)
+        force -= GRAVITY * (positions - positions.mean(axis=0))
+        length = np.sqrt((force * force).sum(axis=1))
+        scale = np.minimum(length, step) / np.maximum(length, 1e-12)
+        positions[movable] += force[movable] * scale[movable, None]
+        if progress:
+            progress(iteration + 1)
+    return positions
+
+
+def place_new(graph, cached, seed=SEED) -> tuple:
+    """Start positions from cached {note_id: (x, y)}: notes without one
+    go next to their laid out neighbours, or anywhere if they have
+    none. Returns positions and the mask of placed notes.
+    """
+    n = len(graph)
+    rng = np.random.default_rng(seed)
+    positions = np.full((n, 2), np.nan)
+    for i, note_id in enumerate(graph.note_ids.tolist()):
+        xy = cached.get(note_id)
+        if xy is not None:
+            positions[i] = xy
+    new = np.isnan(positions[:, 0])
+    if not new.any():
+        return positions, new
+    known = ~new
+    # Mean of laid out neighbours
+    sums = np.zeros((n, 2))
+    counts = np.zeros(n)
+    for a, b in ((graph.sources, graph.targets), (graph.targets, graph.sources)):
+        use = new[a] & known[b]
+        np.add.at(sums, a[use], positions[b[use]])
+        np.add.at(counts, a[use], 1)
+    has_neighbours = new & (counts > 0)
+    positions[has_neighbours] = sums[has_neighbours] / counts[has_neighbours, None]
+    lonely = new & ~has_neighbours
+    if known.any():
+        low, high = positions[known].min(axis=0), positions[known].max(axis=0)
+    else:
+        half = math.sqrt(max(n, 1)) / 2
+        low, high = np.array([-half, -half]), np.array([half, half])
+    positions[lonely] = rng.uniform(low, high, (int(lonely.sum()), 2))
+    # Notes placed at the same spot must not overlap exactly
+    positions[new] += rng.normal(0, 0.1, (int(new.sum()), 2))
+    return positions, new
+
+
+class SpatialGrid:
+    """Points bucketed into square cells in row-major order.
+
+    Points of consecutive cells of a row are consecutive in order,
+    so a rectangle is a few slices, one per row of cells.
+    """
+    __slots__ = ('points', 'low', 'cell_size', 'cols', 'rows', 'order', 'starts')
+
+    def __init__(self, points, per_cell=GRID_CELL_POINTS):
+        self.points = points
+        n = len(points)
+        self.low = points.min(axis=0) if n else np.zeros(2)
+        extent = (points.max(axis=0) - self.low) if n else np.ones(2)
+        area = max(float(extent[0] * extent[1]), 1e-9)
+        self.cell_size = math.sqrt(area * per_cell / max(n, 1)) or 1.0
+        self.cols = int(extent[0] / self.cell_size) + 1
+        self.rows = int(extent[1] / self.cell_size) + 1
+        cell = self.cell_of(points)
+        self.order = np.argsort(cell, kind='stable')
+        self.starts = np.searchsorted(
+            cell[self.order], np.arange(self.cols * self.rows + 1)
+        )
+
+    def cell_of(self, points) -> np.ndarray:
+        c = ((points - self.low) / self.cell_size).astype(np.int64)
+        cx = np.clip(c[:, 0], 0, self.cols - 1)
+        cy = np.clip(c[:, 1], 0, self.rows - 1)
+        return cy * self.cols + cx
+
+    def query(self, x0, y0, x1, y1) -> np.ndarray:
+        "Indices of points inside the rectangle."
+        c0 = np.floor((np.array([x0, y0]) - self.low) / self.cell_size).astype(np.int64)
+        c1 = np.floor((np.array([x1, y1]) - self.low) / self.cell_size).astype(np.int64)
+        cx0, cx1 = max(c0[0], 0), min(c1[0], self.cols - 1)
+        cy0, cy1 = max(c0[1], 0), min(c1[1], self.rows - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.zeros(0, dtype=np.int64)
+        slices = [
+            self.order[self.starts[row + cx0]:self.starts[row + cx1 + 1]]
+            for row in range(cy0 * self.cols, cy1 * self.cols + 1, self.cols)
+        ]
+        found = np.concatenate(slices)
+        x, y = self.points[found].T
+        return found[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+
+    def nearest(self, x, y, radius):
+        "Index of the point closest to (x, y) within radius, or None."
+        found = self.query(x - radius, y - radius, x + radius, y + radius)
+        if not len(found):
+            return None
+        delta = self.points[found] - (x, y)
+        d2 = (delta * delta).sum(axis=1)
+        best = int(np.argmin(d2))
+        return int(found[best]) if d2[best] <= radius * radius else None
+
+
+def aggregate_edges(points, sources, targets, cell_size, limit) -> tuple:
+    """Edges merged by the cells of their ends on a cell_size grid.
+
+    Returns x0, y0, x1, y1 of lines between centres of the notes of
+    two cells and the number of edges of each, most edges first, at
+    most limit of them. Edges inside one cell are left out.
+    """
+    if not len(sources):
+        empty = np.zeros(0)
+        return empty, empty, empty, empty, empty.astype(np.int64)
+    low = points.min(axis=0)
+    c = ((points - low) / cell_size).astype(np.int64)
+    cols = int(c[:, 0].max()) + 1
+    cell = c[:, 1] * cols + c[:, 0]
+    cells, cell = np.unique(cell, return_inverse=True)
+    count = np.bincount(cell).astype(np.float64)
+    centre_x = np.bincount(cell, points[:, 0]) / count
+    centre_y = np.bincount(cell, points[:, 1]) / count
+
+    a, b = cell[sources], cell[targets]
+    a, b = np.minimum(a, b), np.maximum(a, b)
+    between = a != b
+    keys, counts = np.unique(a[between] * len(cells) + b[between], return_counts=True)
+    top = np.argsort(-counts, kind='stable')[:limit]
+    a, b = np.divmod(keys[top], len(cells))
+    return centre_x[a], centre_y[a], centre_x[b], centre_y[b], counts[top]
@@ -0,0 +1,291 @@
+"""Graph screen: notes as points, similar notes linked by lines.
+
+topaz.py imports it when the screen is first opened, it needs NumPy.
+Layout runs in LayoutTask on a thread pool and is saved in the
+note_position table, so next time only new notes are placed.
+
+GraphView paints only notes inside the visible rectangle, found with
+a SpatialGrid, and picks the level of detail by what is visible:
+zoomed out, notes are a density image and edges are merged by screen
+cells; zoomed in, every note is a circle with its edges, and labels
+appear when there is room for them.
+"""
+import math
+
+import numpy as np
+from PyQt6 import QtCore, QtGui, QtWidgets
+
+from graph_layout import (
+    ITERATIONS, REFINE_ITERATIONS, Graph, SpatialGrid, aggregate_edges,
+    layout, place_new,
+)
+from instrumentation import timed
+
+NODE_RADIUS = 4
+# Click this close to a note, in pixels, to open it.
+PICK_RADIUS = 8
+# Above this many visible notes they are drawn as a density image
+# and edges are merged.
+MAX_SHAPES = 2000
+# Zoomed in, only this many strongest edges on screen are drawn.
+MAX_EDGES = 2000
+# Titles are drawn from this zoom, pixels per layout unit, for at
+# most MAX_LABELS notes.
+LABEL_MIN_SCALE = 24
+MAX_LABELS = 150
+# Edges are merged between screen cells of this many pixels.
+AGGREGATE_CELL = 24
+MAX_AGGREGATE_EDGES = 3000
+# Density image pixel, in screen pixels.
+DENSITY_PIXEL = 2
+ZOOM_STEP = 1.25
+# Mouse moves less than this, in pixels, count as a click.
+CLICK_DISTANCE = 4
+# Layout progress is reported every this many iterations.
+PROGRESS_EVERY = 10
+
+BACKGROUND = QtGui.QColor('white')
+NODE_COLOR = QtGui.QColor('#1daf9c')
+EDGE_COLOR = QtGui.QColor(0, 0, 0, 40)
+LABEL_COLOR = QtGui.QColor('#333333')
+
+
+class LayoutSignals(QtCore.QObject):
+    "QRunnable is not a QObject, so signals of LayoutTask live here."
+    progress = QtCore.pyqtSignal(int, int)
+    finished = QtCore.pyqtSignal(int, object)
+
+
+class LayoutTask(QtCore.QRunnable):
+    """Read the graph and its saved layout, lay out notes without
+    a position and save them.
+
+    generation identifies the request. The task gives up between
+    iterations as soon as a newer one appears.
+    """
+    def __init__(self, db, generation, current_generation):
+        super().__init__()
+        self.db = db
+        self.generation = generation
+        self.current_generation = current_generation
+        self.signals = LayoutSignals()
+        self.iterations = 0
+
+    def is_stale(self):
+        return self.generation != self.current_generation()
+
+    def report(self, done):
+        if done % PROGRESS_EVERY == 0:
+            self.signals.progress.emit(done, self.iterations)
+
+    @timed
+    def run(self):
+        if self.is_stale():
+            return
+        notes, edges = self.db.get_graph()
+        graph = Graph(
+            [note_id for note_id, _ in notes], [title for _, title in notes],
+            edges
+        )
+        positions, new = place_new(graph, self.db.get_note_positions())
+        if new.any():
+            # Nothing saved yet: lay out all notes, else only move
+            # the new ones
+            self.iterations = ITERATIONS if new.all() else REFINE_ITERATIONS
+            positions = layout(
+                graph, positions, None if new.all() else new,
+                self.iterations, progress=self.report,
+                is_cancelled=self.is_stale
+            )
+            if positions is None:
+                return
+            self.db.save_note_positions(zip(
+                graph.note_ids[new].tolist(), *positions[new].T.tolist()
+            ))
+        graph.positions = positions
+        if not self.is_stale():
+            self.signals.finished.emit(self.generation, graph)
+
+
+class GraphView(QtWidgets.QWidget):
+    "Pan by dragging, zoom with the wheel, click a note to open it."
+    note_clicked = QtCore.pyqtSignal(int)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.graph = None
+        self.grid = None
+        # Pixels per layout unit and layout point at the top left
+        self.scale = 1.0
+        self.origin = np.zeros(2)
+        self.press_pos = None
+        self.press_origin = None
+        self.dragged = False
+
+    def set_graph(self, graph):
+        self.graph = graph
+        self.grid = SpatialGrid(graph.positions) if len(graph) else None
+        self.fit()
+        self.update()
+
+    def clear(self):
+        self.graph = None
+        self.grid = None
+        self.update()
+
+    def fit(self):
+        "Zoom to show all notes."
+        if self.grid is None:
+            return
+        low = self.graph.positions.min(axis=0)
+        high = self.graph.positions.max(axis=0)
+        extent = np.maximum(high - low, 1.0)
+        size = np.array([max(self.width(), 1), max(self.height(), 1)])
+        self.scale = float((size / extent).min()) * 0.9
+        self.origin = (low + high) / 2 - size / 2 / self.scale
+
+    def to_screen(self, points) -> np.ndarray:
+        return (points - self.origin) * self.scale
+
+    def to_layout(self, x, y) -> np.ndarray:
+        return self.origin + np.array([x, y]) / self.scale
+
+    @timed
+    def paintEvent(self, event):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), BACKGROUND)
+        if self.grid is None:
+            return
+        margin = NODE_RADIUS / self.scale
+        x0, y0 = self.to_layout(0, 0) - margin
+        x1, y1 = self.to_layout(self.width(), self.height()) + margin
+        visible = self.grid.query(x0, y0, x1, y1)
+        shown = np.zeros(len(self.graph), dtype=bool)
+        shown[visible] = True
+        # Edges with one end on screen cross it
+        edges = shown[self.graph.sources] | shown[self.graph.targets]
+        if len(visible) > MAX_SHAPES:
+            self.paint_overview(painter, visible, edges)
+        else:
+            self.paint_notes(painter, visible, edges)
+
+    def paint_overview(self, painter, visible, edges):
+        "Merged edges and a density image of the notes."
+        painter.setRenderHint(QtGui.QPainter.RenderHint.Antialiasing)
+        x0, y0, x1, y1, counts = aggregate_edges(
+            self.graph.positions, self.graph.sources[edges],
+            self.graph.targets[edges], AGGREGATE_CELL / self.scale,
+            MAX_AGGREGATE_EDGES
+        )
+        starts = self.to_screen(np.stack((x0, y0), axis=1)).tolist()
+        ends = self.to_screen(np.stack((x1, y1), axis=1)).tolist()
+        # One pen per width, widths grow with log of merged edges
+        widths = np.minimum(1 + np.log2(np.maximum(counts, 1)) // 2, 6)
+        for width in np.unique(widths).tolist():
+            pen = QtGui.QPen(EDGE_COLOR)
+            pen.setWidthF(width)
+            painter.setPen(pen)
+            painter.drawLines([
+                QtCore.QLineF(*starts[i], *ends[i])
+                for i in np.flatnonzero(widths == width).tolist()
+            ])
+
+        width = self.width() // DENSITY_PIXEL + 1
+        height = self.height() // DENSITY_PIXEL + 1
+        pixels = self.to_screen(self.graph.positions[visible]) // DENSITY_PIXEL
+        pixels = pixels.astype(np.int64)
+        inside = (
+            (pixels[:, 0] >= 0) & (pixels[:, 0] < width)
+            & (pixels[:, 1] >= 0) & (pixels[:, 1] < height)
+        )
+        pixels = pixels[inside]
+        density = np.bincount(
+            pixels[:, 1] * width + pixels[:, 0], minlength=width * height
+        )
+        shade = np.minimum(255, 120 + 45 * np.log2(np.maximum(density, 1)))
+        alpha = np.where(density > 0, shade, 0).astype(np.uint32)
+        argb = (alpha << 24) | np.uint32(NODE_COLOR.rgb() & 0xFFFFFF)
+        data = argb.astype('<u4').tobytes()
+        image = QtGui.QImage(
+            data, width, height, width * 4, QtGui.QImage.Format.Format_ARGB32
+        )
+        painter.drawImage(
+            QtCore.QRectF(0, 0, width * DENSITY_PIXEL, height * DENSITY_PIXEL),
+            image
+        )
+
+    def paint_notes(self, painter, visible, edges):
+        """Strongest edges, every note as a circle, titles when
+        zoomed in.
+        """
+        edges = np.flatnonzero(edges)
+        if len(edges) > MAX_EDGES:
+            strongest = np.argpartition(-self.graph.weights[edges], MAX_EDGES)
+            edges = edges[strongest[:MAX_EDGES]]
+        positions = self.to_screen(self.graph.positions)
+        starts = positions[self.graph.sources[edges]].tolist()
+        ends = positions[self.graph.targets[edges]].tolist()
+        painter.setPen(QtGui.QPen(EDGE_COLOR))
+        painter.drawLines([
+            QtCore.QLineF(x0, y0, x1, y1)
+            for (x0, y0), (x1, y1) in zip(starts, ends)
+        ])
+
+        points = positions[visible].tolist()
+        # Smooth circles, lines are too many for it
+        painter.setRenderHint(QtGui.QPainter.RenderHint.Antialiasing)
+        painter.setPen(QtCore.Qt.PenStyle.NoPen)
+        painter.setBrush(NODE_COLOR)
+        for x, y in points:
+            painter.drawEllipse(QtCore.QPointF(x, y), NODE_RADIUS, NODE_RADIUS)
+
+        if self.scale < LABEL_MIN_SCALE or len(visible) > MAX_LABELS:
+            return
+        painter.setPen(LABEL_COLOR)
+        titles = self.graph.titles
+        for i, (x, y) in zip(visible.tolist(), points):
+            painter.drawText(
+                QtCore.QPointF(x + NODE_RADIUS + 2, y + NODE_RADIUS),
+                titles[i] or ''
+            )
+
+    def wheelEvent(self, event):
+        "Zoom keeping the point under the cursor in place."
+        position = event.position()
+        anchor = self.to_layout(position.x(), position.y())
+        self.scale *= ZOOM_STEP ** (event.angleDelta().y() / 120)
+        self.origin = anchor - np.array([position.x(), position.y()]) / self.scale
+        self.update()
+
+    def mousePressEvent(self, event):
+        self.press_pos = event.position()
+        self.press_origin = self.origin.copy()
+        self.dragged = False
+
+    def mouseMoveEvent(self, event):
+        if self.press_pos is None:
+            return
+        moved = event.position() - self.press_pos
+        if math.hypot(moved.x(), moved.y()) >= CLICK_DISTANCE:
+            self.dragged = True
+        if self.dragged:
+            shift = np.array([moved.x(), moved.y()]) / self.scale
+            self.origin = self.press_origin - shift
+            self.update()
+
+    def mouseReleaseEvent(self, event):
+        if self.press_pos is None:
+            return
+        self.press_pos = None
+        if self.dragged or self.grid is None:
+            return
+        position = event.position()
+        x, y = self.to_layout(position.x(), position.y())
+        node = self.grid.nearest(x, y, PICK_RADIUS / self.scale)
+        if node is not None:
+            self.note_clicked.emit(int(self.graph.note_ids[node]))
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        if event.oldSize().width() <= 0:
+            self.fit()
@@ -0,0 +1,257 @@
+"""Opt-in latency instrumentation and profiling.
+
+Set environment variables before starting the app:
+
+    TOPAZ_INSTRUMENT=1            time ManageDb calls, SQL statements
+                                  and GUI hot paths
+    TOPAZ_INSTRUMENT_OUT=x.json   where to dump histograms on exit,
+                                  report is printed to stderr otherwise
+    TOPAZ_PROFILE=x.prof          run the session under cProfile
+
+When TOPAZ_INSTRUMENT is not set decorators return functions
+unchanged and connections are plain sqlite3.Connection, so there is
+no overhead, and modules needed only when enabled are not imported.
+dump() writes the report on demand, as does SIGUSR1.
+"""
+import atexit
+import functools
+import os
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+ENABLED = bool(os.environ.get('TOPAZ_INSTRUMENT'))
+OUTPUT = os.environ.get('TOPAZ_INSTRUMENT_OUT')
+PROFILE_OUTPUT = os.environ.get('TOPAZ_PROFILE')
+# Statements are grouped by their first characters.
+SQL_KEY_LENGTH = 80
+# Bucket i holds durations below 2**i microseconds.
+BUCKETS = 40
+PERCENTILES = (0.5, 0.95, 0.99)
+
+histograms = {}
+histograms_lock = threading.Lock()
+# Name to function returning a dict of counters, e.g. cache hits.
+counters = {}
+
+
+class Histogram:
+    "Count, total, min, max and power of two buckets of durations."
+    __slots__ = ('count', 'total', 'min', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * BUCKETS
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        bucket = min(int(seconds * 1e6).bit_length(), BUCKETS - 1)
+        self.buckets[bucket] += 1
+
+    def percentile(self, q) -> float:
+        "Upper bound of the bucket holding q-th duration, in seconds."
+        rank = q * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(2 ** bucket / 1e6, self.max)
+        return self.max
+
+    def as_dict(self) -> dict:
+        result = {
+            'count': self.count,
+            'total_ms': self.total * 1000,
+            'mean_ms': self.total * 1000 / self.count,
+            'min_ms': self.min * 1000,
+            'max_ms': self.max * 1000,
+        }
+        for q in PERCENTILES:
+            result[f'p{round(q * 100)}_ms'] = self.percentile(q) * 1000
+        result['buckets_us'] = {
+            2 ** bucket: count
+            for bucket, count in enumerate(self.buckets) if count
+        }
+        return result
+
+
+def record(name, seconds):
+    with histograms_lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(seconds)
+
+
+def add_counters(name, func):
+    "Include counters returned by func() in the report."
+    counters[name] = func
+
+
+def counters_snapshot() -> dict:
+    return {name: func() for name, func in list(counters.items())}
+
+
+def timed(func):
+    "Record duration of every call under the function's qualified name."
+    if not ENABLED:
+        return func
+    name = f'{func.__module__}.{func.__qualname__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return wrapper
+
+
+def instrumented(cls):
+    """Class decorator: time all public methods defined in the class.
+
+    Generator functions are left alone, their calls only create
+    the generator.
+    """
+    if not ENABLED:
+        return cls
+    # Slow to import, not needed unless enabled
+    import inspect
+
+    for name, value in list(vars(cls).items()):
+        if (
+            not name.startswith('_') and inspect.isfunction(value)
+            and not inspect.isgeneratorfunction(value)
+        ):
+            setattr(cls, name, timed(value))
+    return cls
+
+
+def sql_key(sql) -> str:
+    return 'sql: ' + ' '.join(sql.split())[:SQL_KEY_LENGTH]
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording duration of each statement.
+
+    For SELECT it is the time to the first row, rows are
+    stepped further on fetch.
+    """
+    def execute(self, sql, parameters=(), /):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            record(sql_key(sql), time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            record(sql_key(sql), time.perf_counter() - start)
+
+    def executescript(self, sql_script, /):
+        start = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            record(sql_key(sql_script), time.perf_counter() - start)
+
+
+class TimedConnection(sqlite3.Connection):
+    "Connection whose cursors, and shortcut methods, are TimedCursor."
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=(), /):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters, /):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script, /):
+        return self.cursor().executescript(sql_script)
+
+
+# Pass as factory to sqlite3.connect().
+CONNECTION_FACTORY = TimedConnection if ENABLED else sqlite3.Connection
+
+
+def snapshot() -> dict:
+    "Histograms as dicts, slowest total first."
+    with histograms_lock:
+        items = [(name, h.as_dict()) for name, h in histograms.items()]
+    return dict(sorted(items, key=lambda item: -item[1]['total_ms']))
+
+
+def report() -> str:
+    lines = [
+        f'{"name":<60} {"count":>7} {"total ms":>10} {"mean":>8}'
+        f' {"p50":>8} {"p95":>8} {"p99":>8} {"max":>8}'
+    ]
+    for name, stats in snapshot().items():
+        lines.append(
+            f'{name[:60]:<60} {stats["count"]:>7} {stats["total_ms"]:>10.1f}'
+            f' {stats["mean_ms"]:>8.2f} {stats["p50_ms"]:>8.2f}'
+            f' {stats["p95_ms"]:>8.2f} {stats["p99_ms"]:>8.2f}'
+            f' {stats["max_ms"]:>8.2f}'
+        )
+    for name, values in counters_snapshot().items():
+        lines.append(f'{name}: ' + ', '.join(
+            f'{key} {value:.3g}' if isinstance(value, float)
+            else f'{key} {value}'
+            for key, value in values.items()
+        ))
+    return '\n'.join(lines)
+
+
+def dump(path=OUTPUT):
+    "Write histograms to JSON file, or print report to stderr."
+    if path:
+        import json
+
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(
+                {**snapshot(), 'counters': counters_snapshot()}, file, indent=2
+            )
+    else:
+        print(report(), file=sys.stderr)
+
+
+def reset():
+    with histograms_lock:
+        histograms.clear()
+
+
+@contextmanager
+def profile_session(path=PROFILE_OUTPUT):
+    "Run the block under cProfile and save stats to path, if given."
+    if not path:
+        yield
+        return
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(path)
+
+
+if ENABLED:
+    atexit.register(dump)
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: dump())
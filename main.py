@@ -1,5 +1,314 @@
-def main():
-    print("Hello from topaz!")
+"""Topaz command line, works with a notebook without the GUI.
+
+    python main.py add "Title" --text "Body" --tag '#python' --tag '#notes'
+    python main.py list --limit 20
+    python main.py search "pyhton #notes"
+    python main.py --db work.db --db home.db search "meeting"
+    python main.py show 42
+    python main.py filter --all '#python' --none '#draft'
+    python main.py tags
+    python main.py import jsonl notes.jsonl
+    python main.py import md notes/ --no-index
+    python main.py export md notes/
+    python main.py stats
+    python main.py vacuum
+    python main.py graph --workers 8
+    python main.py duplicates
+
+PyQt6 is never imported, so the command starts fast and can run in
+scripts and batch jobs. Commands work with the first --db notebook,
+search looks in all of them at once.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from models import DB_NAME, PAGE_SIZE
+from notebooks import Notebooks
+
+# notes_io functions, imported only for these commands
+IMPORTERS = {'jsonl': 'import_jsonl', 'md': 'import_markdown_dir'}
+EXPORTERS = {'jsonl': 'export_jsonl', 'md': 'export_markdown_dir'}
+
+
+def print_notes(notes, as_json=False):
+    "Print {note_id: (title, preview, tags, created_at)} one per line."
+    for note_id, (title, preview, tags, created_at) in notes.items():
+        if as_json:
+            print(json.dumps(
+                {
+                    'id': note_id, 'title': title, 'preview': preview,
+                    'tags': tags, 'created_at': created_at,
+                },
+                ensure_ascii=False
+            ))
+        else:
+            print(f'{note_id}\t{created_at}\t{title}\t{" ".join(tags)}')
+
+
+def print_found(db, note_ids, args):
+    "Print notes in the order of note_ids."
+    note_ids = note_ids[:args.limit] if args.limit else note_ids
+    for start in range(0, len(note_ids), PAGE_SIZE):
+        chunk = note_ids[start:start + PAGE_SIZE]
+        notes = db.get_notes_by_ids(chunk)
+        print_notes(
+            {note_id: notes[note_id] for note_id in chunk if note_id in notes},
+            args.json
+        )
+
+
+def progress(done):
+    print(f'{done} notes', end='\r', file=sys.stderr)
+
+
+def cmd_add(db, args):
+    text = sys.stdin.read() if args.text == '-' else args.text
+    note_id = db.insert_data_in_tables(args.title, text, args.tag)
+    if note_id is None:
+        sys.exit('Note is not saved')
+    print(note_id)
+
+
+def cmd_list(db, args):
+    after = None
+    printed = 0
+    while not args.limit or printed < args.limit:
+        limit = PAGE_SIZE
+        if args.limit:
+            limit = min(limit, args.limit - printed)
+        page = db.get_notes_page(after, limit)
+        if not page:
+            return
+        print_notes(page, args.json)
+        printed += len(page)
+        last_id = next(reversed(page))
+        after = (page[last_id][3], last_id)
+
+
+def cmd_show(db, args):
+    notes = db.get_notes_by_ids([args.note_id])
+    if args.note_id not in notes:
+        sys.exit(f'No note {args.note_id}')
+    title, _, tags, created_at = notes[args.note_id]
+    text = db.get_note_text(args.note_id) or ''
+    if args.json:
+        print(json.dumps(
+            {
+                'id': args.note_id, 'title': title, 'text': text,
+                'tags': tags, 'created_at': created_at,
+            },
+            ensure_ascii=False
+        ))
+    else:
+        print(f'{title}\n{created_at}  {" ".join(tags)}\n\n{text}')
+
+
+def print_federated(notebooks, found, as_json=False):
+    "Print (path, note_id) found in several notebooks, in order."
+    by_path = {}
+    for path, note_id in found:
+        by_path.setdefault(path, []).append(note_id)
+    notes = {}
+    for path, note_ids in by_path.items():
+        db = notebooks.open(path)
+        for start in range(0, len(note_ids), PAGE_SIZE):
+            page = db.get_notes_by_ids(note_ids[start:start + PAGE_SIZE])
+            notes.update(((path, note_id), note) for note_id, note in page.items())
+    for path, note_id in found:
+        if (path, note_id) not in notes:
+            continue
+        title, preview, tags, created_at = notes[path, note_id]
+        if as_json:
+            print(json.dumps(
+                {
+                    'notebook': path, 'id': note_id, 'title': title,
+                    'preview': preview, 'tags': tags,
+                    'created_at': created_at,
+                },
+                ensure_ascii=False
+            ))
+        else:
+            print(f'{path}\t{note_id}\t{created_at}\t{title}\t{" ".join(tags)}')
+
+
+def cmd_search(db, args):
+    if len(args.notebooks) > 1:
+        found = args.notebooks.search(args.query, args.limit)
+        print_federated(args.notebooks, found, args.json)
+    else:
+        print_found(db, db.find_notes(args.query), args)
+
+
+def cmd_filter(db, args):
+    print_found(db, db.filter_by_tags(args.all, args.any, args.none), args)
+
+
+def cmd_tags(db, args):
+    facets = db.tag_facets(args.all, args.any, args.none)
+    if args.json:
+        print(json.dumps(facets, ensure_ascii=False))
+        return
+    for tag, count in facets.items():
+        print(f'{count}\t{tag}')
+
+
+def cmd_import(db, args):
+    import notes_io
+
+    start = time.perf_counter()
+    importer = getattr(notes_io, IMPORTERS[args.format])
+    count = importer(
+        db, args.path, progress=progress, index=not args.no_index
+    )
+    print(f'\n{count} notes in {time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+
+def cmd_export(db, args):
+    import notes_io
+
+    start = time.perf_counter()
+    exporter = getattr(notes_io, EXPORTERS[args.format])
+    count = exporter(db, args.path, progress=progress)
+    print(f'\n{count} notes in {time.perf_counter() - start:.1f} s', file=sys.stderr)
+
+
+def cmd_stats(db, args):
+    stats = db.stats()
+    if args.json:
+        print(json.dumps(stats))
+        return
+    for name, value in stats.items():
+        print(f'{name:<20} {value}')
+
+
+def cmd_vacuum(db, args):
+    before = db.stats().get('file_bytes', 0)
+    compressed = db.vacuum()
+    after = db.stats().get('file_bytes', 0)
+    print(f'{compressed} bodies compressed, {before} -> {after} bytes')
+
+
+def cmd_graph(db, args):
+    start = time.perf_counter()
+    db.rebuild_similarity_graph(args.workers)
+    db.rebuild_duplicate_index()
+    print(
+        f'{db.stats().get("similar_edges", 0)} edges in'
+        f' {time.perf_counter() - start:.1f} s', file=sys.stderr
+    )
+
+
+def cmd_duplicates(db, args):
+    start = time.perf_counter()
+    groups = db.duplicate_groups()
+    for i, group in enumerate(groups):
+        if args.json:
+            print(json.dumps(group))
+            continue
+        if i:
+            print()
+        notes = db.get_notes_by_ids(group)
+        print_notes({note_id: notes[note_id] for note_id in group if note_id in notes})
+    print(
+        f'{len(groups)} groups, {sum(map(len, groups))} notes in'
+        f' {time.perf_counter() - start:.1f} s', file=sys.stderr
+    )
+
+
+def add_tag_filter(parser):
+    parser.add_argument('--all', nargs='+', default=[], metavar='TAG')
+    parser.add_argument('--any', nargs='+', default=[], metavar='TAG')
+    parser.add_argument('--none', nargs='+', default=[], metavar='TAG')
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='topaz', description='Topaz notes without the GUI.'
+    )
+    parser.add_argument(
+        '--db', action='append', metavar='PATH',
+        help=f'notebook file, {DB_NAME} by default; repeat to search several'
+    )
+    parser.add_argument('--json', action='store_true', help='JSON output')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    add = commands.add_parser('add', help='add a note')
+    add.add_argument('title')
+    add.add_argument('--text', default='', help="note text, '-' reads stdin")
+    add.add_argument('--tag', action='append', default=[])
+    add.set_defaults(func=cmd_add)
+
+    list_ = commands.add_parser('list', help='list notes, oldest first')
+    list_.add_argument('--limit', type=int)
+    list_.set_defaults(func=cmd_list)
+
+    show = commands.add_parser('show', help='print a note with its text')
+    show.add_argument('note_id', type=int)
+    show.set_defaults(func=cmd_show)
+
+    search = commands.add_parser(
+        'search', help='full-text search, #tag words filter by tags'
+    )
+    search.add_argument('query')
+    search.add_argument('--limit', type=int)
+    search.set_defaults(func=cmd_search)
+
+    filter_ = commands.add_parser('filter', help='notes by tags')
+    add_tag_filter(filter_)
+    filter_.add_argument('--limit', type=int)
+    filter_.set_defaults(func=cmd_filter)
+
+    tags = commands.add_parser('tags', help='tags with number of notes')
+    add_tag_filter(tags)
+    tags.set_defaults(func=cmd_tags)
+
+    for name, formats in (('import', IMPORTERS), ('export', EXPORTERS)):
+        sub = commands.add_parser(name, help=f'{name} JSON Lines or Markdown')
+        sub.add_argument('format', choices=formats)
+        sub.add_argument('path')
+        sub.set_defaults(func=cmd_import if name == 'import' else cmd_export)
+    commands.choices['import'].add_argument(
+        '--no-index', action='store_true',
+        help='skip similar notes and duplicates, run graph afterwards'
+    )
+
+    stats = commands.add_parser('stats', help='notebook statistics')
+    stats.set_defaults(func=cmd_stats)
+
+    vacuum = commands.add_parser(
+        'vacuum', help='compress large bodies and shrink the file'
+    )
+    vacuum.set_defaults(func=cmd_vacuum)
+
+    graph = commands.add_parser(
+        'graph',
+        help='rebuild similar notes graph on all cores and duplicate index'
+    )
+    graph.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    graph.set_defaults(func=cmd_graph)
+
+    duplicates = commands.add_parser(
+        'duplicates', help='groups of near-identical notes'
+    )
+    duplicates.set_defaults(func=cmd_duplicates)
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    args.notebooks = Notebooks(args.db or [DB_NAME])
+    db = args.notebooks.open((args.db or [DB_NAME])[0])
+    db.create_tables()
+    try:
+        args.func(db, args)
+    except BrokenPipeError:
+        # Output piped to head and similar
+        sys.stderr.close()
+    finally:
+        args.notebooks.close()
 
 
 if __name__ == "__main__":
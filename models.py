@@ -1,24 +1,253 @@
+import re
 import sqlite3
+import threading
+import weakref
+import zlib
+from itertools import batched
+
+from duplicates import SCHEMA as DUPLICATES_SCHEMA, DuplicateIndex
+from fuzzy import create_index as create_fuzzy_index, similar_words
+import instrumentation
+from instrumentation import CONNECTION_FACTORY, instrumented
+from query_cache import QUERY_CACHE_BYTES, QueryCache, cached
+from similarity import (
+    SCHEMA as SIMILARITY_SCHEMA, TOP_K, SimilarityGraph
+)
+from sql_params import chunked
+from tag_index import (
+    SCHEMA as TAG_INDEX_SCHEMA, TagIndex, bitmap_ids, normalize_tags,
+    parse_query, read_version
+)
 
 DB_NAME = 'notes.db'
+PAGE_SIZE = 200
+# Column weights for bm25(): title, text, tags.
+FTS_WEIGHTS = (10.0, 1.0, 5.0)
+# Notes inserted in one transaction by import_notes().
+IMPORT_BATCH_SIZE = 5000
+# Imports adding fewer notes than this share of the notebook update the
+# similar notes graph note by note, bigger ones rebuild it: a note costs
+# about ten times more to add alone than within a rebuild.
+INCREMENTAL_IMPORT_SHARE = 0.1
+# How many prepared statements each connection keeps.
+CACHED_STATEMENTS = 256
+# Connections of ended threads kept for the next ones, the rest are
+# closed. Qt pool threads end their Python thread state after every
+# task, so every task would open a connection otherwise.
+IDLE_CONNECTIONS = 4
+# Tiles show only a few lines, listings carry this much of the text.
+PREVIEW_LENGTH = 200
+# Bodies of at least this many bytes are stored zlib-compressed.
+COMPRESS_MIN_SIZE = 4096
+COMPRESS_LEVEL = 6
+# Stored in PRAGMA user_version once create_tables() has built the
+# schema. Bump it whenever the schema or a migration changes.
+SCHEMA_VERSION = 5
+# Kinds of writes of ManageDb.write_batch().
+INSERT = 'insert'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+def make_preview(text):
+    return text[:PREVIEW_LENGTH] if text else text
+
+
+def pack_text(text, min_size=COMPRESS_MIN_SIZE):
+    """Body as stored in note.text: compressed bytes if it is at least
+    min_size bytes long and compression helps, the text otherwise.
+    min_size None turns compression off.
+    """
+    if min_size is None or not text:
+        return text
+    data = text.encode('utf-8')
+    if len(data) < min_size:
+        return text
+    packed = zlib.compress(data, COMPRESS_LEVEL)
+    return packed if len(packed) < len(data) else text
+
+
+def unpack_text(value):
+    """Body from note.text. SQL queries call it as note_text(text),
+    so bodies are decompressed only when they are read.
+    """
+    if isinstance(value, bytes):
+        return zlib.decompress(value).decode('utf-8')
+    return value
 
 
+class ConnectionLease:
+    "Lives in thread-local data as long as the thread has a connection."
+    __slots__ = ('__weakref__',)
+
+
+@instrumented
 class ManageDb:
-    def __init__(self):
-        ...
+    """Access to notes database.
+
+    Every thread gets its own long-lived connection, opened on first
+    use and kept until close(). WAL journal lets readers work while
+    a note is being saved.
+
+    db_name: path of the database file.
+    synchronous: NORMAL is safe in WAL mode and avoids fsync on
+        every commit, FULL syncs every commit.
+    cache_size: page cache per connection, negative value is KiB.
+    mmap_size: bytes of database file mapped into memory.
+    compress_min_size: bodies of at least this many bytes are
+        compressed, None stores all of them as text.
+    query_cache_bytes: budget of cached listing, search and tag
+        filter results, 0 turns the cache off (see query_cache.py).
+    """
+    def __init__(
+            self, db_name=DB_NAME, synchronous='NORMAL', cache_size=-16000,
+            mmap_size=64 * 1024 * 1024, compress_min_size=COMPRESS_MIN_SIZE,
+            query_cache_bytes=QUERY_CACHE_BYTES
+    ):
+        self.db_name = db_name
+        self.compress_min_size = compress_min_size
+        self.pragmas = (
+            'PRAGMA foreign_keys = ON;',
+            'PRAGMA journal_mode = WAL;',
+            f'PRAGMA synchronous = {synchronous};',
+            f'PRAGMA cache_size = {int(cache_size)};',
+            f'PRAGMA mmap_size = {int(mmap_size)};',
+            'PRAGMA temp_store = MEMORY;',
+        )
+        self.local = threading.local()
+        # Open connections: in use by a thread or idle
+        self.connections = []
+        self.idle = []
+        self.connections_lock = threading.Lock()
+        self.similarity = SimilarityGraph()
+        self.duplicates = DuplicateIndex()
+        self.tag_index = TagIndex()
+        # Tag name -> id, None until load_tag_ids(). Tags are never
+        # deleted, so ids stay valid whoever has added them.
+        self.tag_ids = None
+        self.query_cache = QueryCache(query_cache_bytes)
+        # PRAGMA data_version of every connection when the query cache
+        # last looked, see check_data_version()
+        self.data_versions = {}
+        if instrumentation.ENABLED:
+            instrumentation.add_counters(
+                f'query cache {db_name}', self.query_cache.stats
+            )
 
     def connect_to_db(self):
-        conn = sqlite3.connect(DB_NAME)
-        conn.execute("PRAGMA foreign_keys = ON;")
+        """Return connection of the current thread.
+
+        Use it as `with self.connect_to_db() as conn:`, the block
+        commits or rolls back but keeps the connection open.
+        When the thread ends the connection goes back to the idle
+        ones and is reused by another thread.
+        """
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            with self.connections_lock:
+                conn = self.idle.pop() if self.idle else None
+            if conn is None:
+                conn = self.open_connection()
+            self.local.conn = conn
+            # Thread-local data is dropped when the thread ends
+            self.local.lease = lease = ConnectionLease()
+            weakref.finalize(lease, self.release_connection, conn)
+        return conn
+
+    def open_connection(self):
+        conn = sqlite3.connect(
+            self.db_name,
+            cached_statements=CACHED_STATEMENTS,
+            factory=CONNECTION_FACTORY,
+            # One thread uses it at a time, but it moves to another
+            # thread when its own ends, and close() may run from
+            # another thread on shutdown.
+            check_same_thread=False,
+        )
+        for pragma in self.pragmas:
+            conn.execute(pragma)
+        conn.create_function(
+            'note_text', 1, unpack_text, deterministic=True
+        )
+        with self.connections_lock:
+            self.connections.append(conn)
         return conn
 
+    def release_connection(self, conn):
+        "Keep connection of an ended thread for reuse, or close it."
+        with self.connections_lock:
+            if conn not in self.connections:
+                # Closed by close()
+                return
+            if len(self.idle) < IDLE_CONNECTIONS:
+                self.idle.append(conn)
+                return
+            self.connections.remove(conn)
+            self.data_versions.pop(conn, None)
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+
+    def close(self):
+        """Close connections of all threads.
+
+        ManageDb can be used again after that, new connections
+        are opened on demand.
+        """
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+            self.idle = []
+            self.data_versions = {}
+        for conn in connections:
+            try:
+                conn.execute('PRAGMA optimize;')
+                conn.close()
+            except sqlite3.Error as e:
+                print(f'Error occured: \n {e}')
+        self.local = threading.local()
+
+    def committed(self, notes_changed=True):
+        """Record a commit of this ManageDb. Cached results are dropped
+        if notes, tags or their text changed.
+        """
+        # Ids of tags added by the transaction are real now
+        new_tag_ids = getattr(self.local, 'new_tag_ids', None)
+        if new_tag_ids and self.tag_ids is not None:
+            self.tag_ids.update(new_tag_ids)
+        self.local.new_tag_ids = {}
+        if notes_changed:
+            self.query_cache.clear()
+
+    def check_data_version(self):
+        """Drop cached results if another connection has committed
+        since this connection last looked: the writer thread, another
+        ManageDb or another process.
+        """
+        conn = self.connect_to_db()
+        version = conn.execute('PRAGMA data_version;').fetchone()[0]
+        # A new connection has not seen earlier commits either
+        if self.data_versions.get(conn) != version:
+            self.data_versions[conn] = version
+            self.query_cache.clear()
+
+    def cache_stats(self) -> dict:
+        "Hit, miss and eviction counters and size of the query cache."
+        return self.query_cache.stats()
+
     def create_tables(self):
+        """Create tables and migrate older databases.
+
+        Skipped when the database is already at SCHEMA_VERSION, the
+        statements below scan every note.
+        """
         sql_statements = [
             '''CREATE TABLE IF NOT EXISTS note (
                 id INTEGER PRIMARY KEY,
                 title VARCHAR(24),
                 text TEXT,
-                created_at datetime default current_timestamp
+                created_at datetime default current_timestamp,
+                preview TEXT
                 );''',
             '''CREATE TABLE IF NOT EXISTS tag (
                 id INTEGER PRIMARY KEY,
@@ -31,104 +260,515 @@ class ManageDb:
                 FOREIGN KEY (tag_id) REFERENCES tag (id) ON DELETE CASCADE,
                 UNIQUE (note_id, tag_id)
                 );''',
+            # Notes of a tag without scanning note_tag.
+            '''CREATE INDEX IF NOT EXISTS note_tag_tag_id
+                ON note_tag (tag_id, note_id);''',
+            # Keyset pagination goes by (created_at, id).
+            '''CREATE INDEX IF NOT EXISTS note_created_at_id
+                ON note (created_at, id);''',
+            # What note_fts indexes, read by it instead of a copy.
+            '''CREATE VIEW IF NOT EXISTS note_fts_source AS
+                SELECT n.id, n.title, note_text(n.text) AS text,
+                (SELECT GROUP_CONCAT(t.name, ' ') FROM note_tag nt
+                    JOIN tag t ON t.id = nt.tag_id
+                    WHERE nt.note_id = n.id) AS tags
+                FROM note n;''',
+            *SIMILARITY_SCHEMA,
+            *DUPLICATES_SCHEMA,
+            *TAG_INDEX_SCHEMA,
+            # Graph view layout, kept so the graph opens without it.
+            '''CREATE TABLE IF NOT EXISTS note_position (
+                note_id INTEGER PRIMARY KEY,
+                x REAL,
+                y REAL,
+                FOREIGN KEY (note_id) REFERENCES note (id) ON DELETE CASCADE
+                );''',
         ]
         try:
             with self.connect_to_db() as conn:
                 cursor = conn.cursor()
+                version = cursor.execute('PRAGMA user_version;').fetchone()[0]
+                if version >= SCHEMA_VERSION:
+                    return
                 for statement in sql_statements:
                     cursor.execute(statement)
+                self.add_preview_column(cursor)
+                self.create_fts(cursor)
+                create_fuzzy_index(cursor)
+                # Graph of notes created before it existed
+                has_notes = cursor.execute('SELECT 1 FROM note LIMIT 1;').fetchone()
+                if has_notes and self.similarity.is_empty(cursor):
+                    self.similarity.rebuild(cursor)
+                if has_notes and self.duplicates.is_empty(cursor):
+                    self.duplicates.rebuild(cursor)
+                cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION};')
+            self.committed()
         except sqlite3.Error as e:
             print(f'Error occured: \n {e}')
 
-    def insert_tags_into_table(self, cursor, tags: list):
-        """Insert tags into tag table. Just insert new tags
-        and get all id for these tags.
+    @staticmethod
+    def add_preview_column(cursor):
+        "Add preview column to databases created before it existed."
+        columns = {row[1] for row in cursor.execute('PRAGMA table_info(note);')}
+        if 'preview' in columns:
+            return
+        cursor.execute('ALTER TABLE note ADD COLUMN preview TEXT;')
+        cursor.execute(
+            'UPDATE note SET preview = substr(note_text(text), 1, ?);',
+            (PREVIEW_LENGTH,)
+        )
+
+    @staticmethod
+    def create_fts(cursor):
+        """Create the full-text index over notes, rowid is the note id.
 
+        It is external content: it keeps no copy of bodies, which
+        would be stored uncompressed, and reads note_fts_source when
+        rebuilt. Before SCHEMA_VERSION 5 it kept its own copy, such a
+        table is replaced.
+        """
+        row = cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'note_fts';"
+        ).fetchone()
+        if row and 'note_fts_source' in row[0]:
+            return
+        if row:
+            cursor.execute('DROP TABLE note_fts;')
+        cursor.execute(
+            '''CREATE VIRTUAL TABLE note_fts USING fts5(
+                title,
+                text,
+                tags,
+                content='note_fts_source',
+                content_rowid='id'
+                );'''
+        )
+        cursor.execute("INSERT INTO note_fts(note_fts) VALUES('rebuild');")
+
+    def pack_text(self, text):
+        return pack_text(text, self.compress_min_size)
+
+    def compress_bodies(self, batch_size=IMPORT_BATCH_SIZE, progress=None):
+        """Compress large bodies stored as text, e.g. by an older
+        version or with compression off. Returns how many were
+        compressed. The file shrinks after VACUUM.
+        """
+        if self.compress_min_size is None:
+            return 0
+        compressed = 0
+        last_id = 0
+        try:
+            while True:
+                with self.connect_to_db() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute(
+                        '''SELECT id, text FROM note
+                            WHERE id > ? AND typeof(text) = 'text'
+                            AND length(CAST(text AS BLOB)) >= ?
+                            ORDER BY id
+                            LIMIT ?;''',
+                        (last_id, self.compress_min_size, batch_size)
+                    )
+                    rows = cursor.fetchall()
+                    if not rows:
+                        return compressed
+                    last_id = rows[-1][0]
+                    packed = [
+                        (self.pack_text(text), note_id)
+                        for note_id, text in rows
+                    ]
+                    cursor.executemany(
+                        'UPDATE note SET text=? WHERE id=?;',
+                        [row for row in packed if isinstance(row[0], bytes)]
+                    )
+                compressed += sum(isinstance(row[0], bytes) for row in packed)
+                if progress:
+                    progress(compressed)
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+            return compressed
+
+    def load_tag_ids(self, cursor=None):
+        "Read all tag ids into self.tag_ids, unless they are loaded."
+        if self.tag_ids is not None:
+            return
+        try:
+            cursor = cursor or self.connect_to_db().cursor()
+            self.tag_ids = dict(cursor.execute('SELECT name, id FROM tag;'))
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+
+    def forget_new_tags(self):
+        "Transaction is rolled back, ids of its new tags may be reused."
+        self.local.new_tag_ids = {}
+
+    def insert_tags_into_table(self, cursor, tags: list) -> dict:
+        """Return {name: id} of normalized tags, inserting new ones.
+
+        Known ids come from self.tag_ids, only new tags are queried,
+        MAX_SQL_PARAMS at a time. Their ids get into self.tag_ids
+        when committed() is called after the transaction.
         cursor argument need for consistency:
         If the tag insertion fails, the connection should rollback().
         """
-        try:
-            # Insert data in db
-            insert_tag_data = 'INSERT OR IGNORE INTO tag(name) VALUES(?);'
+        self.load_tag_ids(cursor)
+        known = self.tag_ids or {}
+        new_tag_ids = self.local.__dict__.setdefault('new_tag_ids', {})
+        tag_map = {}
+        missing = []
+        for tag in normalize_tags(tags):
+            tag_id = known.get(tag) or new_tag_ids.get(tag)
+            if tag_id is None:
+                missing.append(tag)
+            else:
+                tag_map[tag] = tag_id
+        for chunk in chunked(missing):
             cursor.executemany(
-                insert_tag_data, [(tag,) for tag in tags if tag != '']
+                'INSERT OR IGNORE INTO tag(name) VALUES(?);',
+                [(tag,) for tag in chunk]
             )
-
-            # Get tags from db
-            join_tags = ','.join('?' for _ in tags)
-            select_data_from_tag = (
-                f'SELECT id, name FROM tag WHERE name IN ({join_tags});'
+            placeholders = ','.join('?' for _ in chunk)
+            cursor.execute(
+                f'SELECT name, id FROM tag WHERE name IN ({placeholders});',
+                chunk
             )
-            cursor.execute(select_data_from_tag, tags)
-            get_data_from_tag = cursor.fetchall()
-            tag_map: dict = {name: tid for tid, name in get_data_from_tag}
-            return tag_map
+            found = dict(cursor.fetchall())
+            new_tag_ids.update(found)
+            tag_map.update(found)
+        return tag_map
+
+    @staticmethod
+    def index_fts(cursor, note_id):
+        """Add a note to the full-text index from note and note_tag
+        tables, inside the write transaction.
+        """
+        cursor.execute(
+            '''INSERT INTO note_fts(rowid, title, text, tags)
+                SELECT id, title, text, tags FROM note_fts_source
+                WHERE id=?;''',
+            (note_id,)
+        )
+
+    @staticmethod
+    def unindex_fts(cursor, note_id):
+        """Remove a note from the full-text index. Call before the
+        note or its tags change: note_fts keeps no copy, it needs the
+        indexed values to remove them.
+        """
+        cursor.execute(
+            '''INSERT INTO note_fts(note_fts, rowid, title, text, tags)
+                SELECT 'delete', id, title, text, tags FROM note_fts_source
+                WHERE id=?;''',
+            (note_id,)
+        )
+
+    def insert_data_in_tables(self, title: str, text: str, tags: list):
+        try:
+            return self.write_batch([(INSERT, title, text, tags)])[0]
         except sqlite3.Error as e:
             print(f'Error occured: \n {e}')
 
-    def insert_data_in_tables(self, title: str, text: str, tags: list):
+    def insert_note_row(self, cursor, title, text, tags):
+        "Insert note inside the caller's transaction, return its id."
+        # Insert data into tag table
+        tag_map = self.insert_tags_into_table(cursor, tags)
+
+        # Insert data into note table
+        insert_data_note = (
+            'INSERT INTO note(title, text, preview) VALUES(?, ?, ?);'
+        )
+        cursor.execute(
+            insert_data_note,
+            (title, self.pack_text(text), make_preview(text))
+        )
+        note_last_row_id = cursor.lastrowid
+
+        # Insert data into intermediate table note_tag
+        if tag_map:
+            insert_data_note_tag = (
+                'INSERT INTO note_tag(tag_id, note_id) VALUES(?, ?);'
+            )
+            cursor.executemany(
+                insert_data_note_tag,
+                [
+                    (tag_id, note_last_row_id) for tag_id in tag_map.values()
+                ]
+            )
+        self.index_fts(cursor, note_last_row_id)
+        self.similarity.update_note(cursor, note_last_row_id)
+        self.duplicates.update_note(cursor, note_last_row_id)
+        return note_last_row_id
+
+    def write_batch(self, writes) -> list:
+        """Apply several writes in one transaction.
+
+        writes are tuples (INSERT, title, text, tags),
+        (UPDATE, note_id, title, text, tags) or (DELETE, note_id).
+        Returns the note id of every write, None for an update of
+        a missing note. sqlite3.Error is raised and nothing is
+        written if any write fails.
+        """
+        results = []
+        index_updates = []
         try:
             with self.connect_to_db() as conn:
                 cursor = conn.cursor()
+                # Write lock first, so nobody commits between the reads
+                # of the tag index version
+                cursor.execute('BEGIN IMMEDIATE;')
+                version_before = read_version(cursor)
+                for kind, *args in writes:
+                    if kind == INSERT:
+                        note_id = self.insert_note_row(cursor, *args)
+                    elif kind == UPDATE:
+                        note_id = self.update_note_row(cursor, *args)
+                    elif kind == DELETE:
+                        note_id = self.delete_note_row(cursor, *args)
+                    else:
+                        raise ValueError(f'Unknown write {kind!r}')
+                    results.append(note_id)
+                    if note_id is not None:
+                        index_updates.append((
+                            note_id,
+                            # Tags are stored as normalize_tags() returns
+                            None if kind == DELETE else normalize_tags(args[-1])
+                        ))
+                version_after = read_version(cursor)
+        except BaseException:
+            self.forget_new_tags()
+            raise
+        # Only committed changes get into the tag index
+        self.tag_index.apply(index_updates, version_before, version_after)
+        self.committed()
+        return results
 
-                # Insert data into tag table
-                tag_map = self.insert_tags_into_table(cursor, tags)
-
-                # Insert data into note table
-                insert_data_note = (
-                    'INSERT INTO note(title, text) VALUES(?, ?);'
-                )
-                cursor.execute(insert_data_note, (title, text))
-                note_last_row_id = cursor.lastrowid
+    def import_notes(
+            self, notes, batch_size=IMPORT_BATCH_SIZE, progress=None,
+            index=True
+    ):
+        """Insert many notes, batch_size notes per transaction.
 
-                # Insert data into intermediate table note_tag
-                if tag_map:
-                    insert_data_note_tag = (
-                        'INSERT INTO note_tag(tag_id, note_id) VALUES(?, ?);'
-                    )
-                    cursor.executemany(
-                        insert_data_note_tag,
-                        [
-                            (tag_id, note_last_row_id) for tag_id in tag_map.values()
-                        ]
-                    )
-                return note_last_row_id
+        notes is an iterable of dicts with title, text, tags and
+        optional created_at, it is consumed lazily. progress is called
+        with the number of imported notes after every batch.
+        Imported notes are added to the similar notes graph and the
+        duplicate index once at the end, see index_imported(); with
+        index=False call rebuild_similarity_graph() and
+        rebuild_duplicate_index() later.
+        """
+        note_ids = []
+        try:
+            for batch in batched(notes, batch_size):
+                with self.connect_to_db() as conn:
+                    note_ids.extend(self.insert_batch(conn.cursor(), batch))
+                self.committed()
+                if progress:
+                    progress(len(note_ids))
+            if note_ids and index:
+                with self.connect_to_db() as conn:
+                    self.index_imported(conn.cursor(), note_ids)
         except sqlite3.Error as e:
+            self.forget_new_tags()
             print(f'Error occured: \n {e}')
+        # Cheaper to load it again than to update per note
+        self.tag_index.invalidate()
+        self.committed()
+        return len(note_ids)
+
+    def index_imported(self, cursor, note_ids):
+        """Add imported notes to the duplicate index and the similar
+        notes graph. The graph is updated note by note when they are
+        under INCREMENTAL_IMPORT_SHARE of all notes, rebuilt otherwise.
+        """
+        # Separate cursor, index_notes() writes with the other one
+        reader = cursor.connection.cursor()
+        for chunk in chunked(note_ids):
+            placeholders = ','.join('?' for _ in chunk)
+            reader.execute(
+                f'''SELECT id, title, note_text(text) FROM note
+                    WHERE id IN ({placeholders});''',
+                chunk
+            )
+            self.duplicates.index_notes(cursor, reader.fetchall())
+        total = cursor.execute('SELECT COUNT(*) FROM note;').fetchone()[0]
+        if len(note_ids) < total * INCREMENTAL_IMPORT_SHARE:
+            for note_id in note_ids:
+                self.similarity.update_note(cursor, note_id)
+        else:
+            self.similarity.rebuild(cursor)
+
+    def insert_batch(self, cursor, notes) -> range:
+        """Insert notes with executemany, tags are resolved once per
+        batch. Return ids of the notes.
+        """
+        note_tags = [normalize_tags(note['tags']) for note in notes]
+        tag_map = self.insert_tags_into_table(
+            cursor, [tag for tags in note_tags for tag in tags]
+        )
 
+        # Ids are assigned here to link tags without a query per note,
+        # the transaction holds the write lock.
+        last_id = cursor.execute(
+            'SELECT COALESCE(MAX(id), 0) FROM note;'
+        ).fetchone()[0]
+        ids = range(last_id + 1, last_id + 1 + len(notes))
+        cursor.executemany(
+            '''INSERT INTO note(id, title, text, preview, created_at)
+                VALUES(?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP));''',
+            [
+                (
+                    note_id, note['title'], self.pack_text(note['text']),
+                    make_preview(note['text']), note.get('created_at')
+                )
+                for note_id, note in zip(ids, notes)
+            ]
+        )
+        cursor.executemany(
+            'INSERT OR IGNORE INTO note_tag(tag_id, note_id) VALUES(?, ?);',
+            [
+                (tag_map[tag], note_id)
+                for note_id, tags in zip(ids, note_tags)
+                for tag in tags
+            ]
+        )
+        cursor.executemany(
+            'INSERT INTO note_fts(rowid, title, text, tags) VALUES(?, ?, ?, ?);',
+            [
+                (note_id, note['title'], note['text'], ' '.join(tags))
+                for note_id, note, tags in zip(ids, notes, note_tags)
+            ]
+        )
+        return ids
+
+    def iter_notes(self, page_size=PAGE_SIZE * 10):
+        """Yield (note_id, title, text, tags, created_at) of all notes
+        page by page, without loading the whole database.
+        """
+        after = None
+        while True:
+            page = self.get_notes_page(after, page_size, with_text=True)
+            for note_id, (title, text, tags, created_at) in page.items():
+                yield note_id, title, text, tags, created_at
+                after = (created_at, note_id)
+            if len(page) < page_size:
+                return
+
+    @cached(dict)
     def get_all_data_from_db(self):
+        with self.connect_to_db() as conn:
+            cursor = conn.cursor()
+            statement = '''
+                SELECT n.id, n.title, note_text(n.text),
+                GROUP_CONCAT(t.name, ',') AS tags,
+                created_at
+                FROM note n
+                LEFT JOIN note_tag nt ON n.id = nt.note_id
+                LEFT JOIN tag t ON t.id = nt.tag_id
+                GROUP BY n.id
+                ORDER BY created_at;'''
+        cursor.execute(statement)
+        data_from_db = cursor.fetchall()
+
+        db_dict = {}
+        for note_id, title, text, tags, created_at in data_from_db:
+            db_dict[note_id] = (
+                title, text, tags.split(',') if tags else [], created_at
+            )
+        return db_dict
+
+    def get_notes_page(
+            self, after=None, limit=PAGE_SIZE, with_text=False
+    ) -> dict:
+        """Return next page of notes ordered by (created_at, id).
+
+        after is (created_at, id) of the last note of previous page,
+        None for the first page. Cost of a page does not depend on
+        how many notes are in the database.
+        Notes have preview instead of text unless with_text is True.
+
+        Not cached: loaded pages are kept by NoteStore, a cached copy
+        would hold every note twice.
+        """
+        body = 'note_text(n.text)' if with_text else 'n.preview'
+        statement = f'''
+            SELECT n.id, n.title, {body},
+            (SELECT GROUP_CONCAT(t.name, ',') FROM note_tag nt
+                JOIN tag t ON t.id = nt.tag_id
+                WHERE nt.note_id = n.id) AS tags,
+            n.created_at
+            FROM note n
+            WHERE (n.created_at, n.id) > (?, ?)
+            ORDER BY n.created_at, n.id
+            LIMIT ?;'''
+        # Empty string sorts before any datetime, 0 before any id.
+        created_at, note_id = after if after else ('', 0)
         try:
             with self.connect_to_db() as conn:
                 cursor = conn.cursor()
-                statement = '''
-                    SELECT n.id, n.title, n.text,
-                    GROUP_CONCAT(t.name, ',') AS tags,
-                    created_at
-                    FROM note n
-                    LEFT JOIN note_tag nt ON n.id = nt.note_id
-                    LEFT JOIN tag t ON t.id = nt.tag_id
-                    GROUP BY n.id
-                    ORDER BY created_at;'''
-            cursor.execute(statement)
-            data_from_db = cursor.fetchall()
+                cursor.execute(statement, (created_at, note_id, limit))
+                return self.rows_to_dict(cursor.fetchall())
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+            return {}
 
-            db_dict = {}
-            for note_id, title, text, tags, created_at in data_from_db:
-                db_dict[note_id] = (
-                    title, text, tags.split(',') if tags else [], created_at
-                )
+    def get_notes_by_ids(self, note_ids, with_text=False) -> dict:
+        """Return notes with given ids, e.g. found by search_notes(),
+        with preview instead of text unless with_text is True.
+        """
+        note_ids = list(note_ids)
+        body = 'note_text(n.text)' if with_text else 'n.preview'
+        db_dict = {}
+        try:
+            with self.connect_to_db() as conn:
+                cursor = conn.cursor()
+                for chunk in chunked(note_ids):
+                    placeholders = ','.join('?' for _ in chunk)
+                    cursor.execute(
+                        f'''SELECT n.id, n.title, {body},
+                        (SELECT GROUP_CONCAT(t.name, ',') FROM note_tag nt
+                            JOIN tag t ON t.id = nt.tag_id
+                            WHERE nt.note_id = n.id) AS tags,
+                        n.created_at
+                        FROM note n
+                        WHERE n.id IN ({placeholders});''',
+                        chunk
+                    )
+                    db_dict.update(self.rows_to_dict(cursor.fetchall()))
             return db_dict
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+            return {}
 
+    def get_note_text(self, note_id):
+        "Return full text of a note, None if there is no such note."
+        try:
+            with self.connect_to_db() as conn:
+                row = conn.execute(
+                    'SELECT note_text(text) FROM note WHERE id=?;', (note_id,)
+                ).fetchone()
+                return row[0] if row else None
         except sqlite3.Error as e:
             print(f'Error occured: \n {e}')
 
+    @staticmethod
+    def rows_to_dict(rows) -> dict:
+        """Convert (id, title, text, tags, created_at) rows to notes
+        dict, text may be the preview.
+        """
+        return {
+            note_id: (
+                title, text, tags.split(',') if tags else [], created_at
+            )
+            for note_id, title, text, tags, created_at in rows
+        }
+
     def show_data(self, note_title):
         'DEPRICATED?'
         try:
             with self.connect_to_db() as conn:
                 cursor = conn.cursor()
                 statement = '''
-                    SELECT n.title, n.text, t.name FROM note n
+                    SELECT n.title, note_text(n.text), t.name FROM note n
                     LEFT JOIN note_tag nt ON (n.id=nt.note_id)
                     LEFT JOIN tag t ON (t.id=nt.tag_id)
                     WHERE n.title=(?)
@@ -139,62 +779,352 @@ class ManageDb:
         except sqlite3.Error as e:
             print(f'Error occured: \n {e}')
 
+    @cached(list)
+    def search_notes(
+            self, query: str, limit=None, is_cancelled=None, fuzzy=False,
+            with_scores=False
+    ) -> list:
+        """Return ids of notes matching query, best match first.
+
+        Every word of the query must be present in title, text or tags
+        of the note, the last letters of a word may be omitted
+        ("prog" finds "programming"). Notes are ranked by bm25.
+        With fuzzy=True a word also matches words a typo or two away
+        ("pyhton" finds "python"), see fuzzy.py. with_scores=True
+        returns (note_id, score) pairs, lower score is better.
+
+        is_cancelled is polled while the query runs; once it returns
+        True the query is aborted and an empty list is returned.
+        """
+        words = re.findall(r'\w+', query)
+        if not words:
+            return []
+        statement = '''
+            SELECT rowid, bm25(note_fts, ?, ?, ?) AS score FROM note_fts
+            WHERE note_fts MATCH ?
+            ORDER BY score
+            LIMIT ?;'''
+        with self.connect_to_db() as conn:
+            if is_cancelled:
+                conn.set_progress_handler(is_cancelled, 1000)
+            try:
+                cursor = conn.cursor()
+                match = ' AND '.join(
+                    self.match_word(cursor, word, fuzzy) for word in words
+                )
+                cursor.execute(
+                    statement,
+                    (*FTS_WEIGHTS, match, -1 if limit is None else limit)
+                )
+                if with_scores:
+                    return cursor.fetchall()
+                return [row[0] for row in cursor.fetchall()]
+            finally:
+                if is_cancelled:
+                    conn.set_progress_handler(None, 0)
+
+    @staticmethod
+    def match_word(cursor, word, fuzzy=False) -> str:
+        "FTS5 query of a word: its prefix, or close words too."
+        prefix = f'"{word}"*'
+        if not fuzzy:
+            return prefix
+        variants = [f'"{close}"' for close in similar_words(cursor, word)]
+        return f'({" OR ".join([prefix, *variants])})'
+
+    def load_tag_index(self):
+        "Load the tag index, again if the database changed without it."
+        try:
+            with self.connect_to_db() as conn:
+                self.tag_index.load(conn.cursor())
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+
+    @cached(list)
+    def filter_by_tags(self, all_tags=(), any_tags=(), none_tags=()) -> list:
+        """Return ids of notes having every tag of all_tags, at least
+        one of any_tags and none of none_tags, in id order.
+        """
+        with self.connect_to_db() as conn:
+            return bitmap_ids(self.tag_index.select(
+                conn.cursor(), all_tags, any_tags, none_tags
+            ))
+
+    @cached(dict)
+    def tag_facets(self, all_tags=(), any_tags=(), none_tags=()) -> dict:
+        "Return {tag: number of notes} among notes of the tag filter."
+        with self.connect_to_db() as conn:
+            return self.tag_index.facets(
+                conn.cursor(), all_tags, any_tags, none_tags
+            )
+
+    def find_notes(
+            self, query: str, is_cancelled=None, with_scores=False
+    ) -> list:
+        """Return ids of notes matching search bar query.
+
+        #tag, #a|#b and -#tag words filter by tags (see tag_index),
+        other words are searched with search_notes() and keep
+        its ranking. If the words match nothing, they are searched
+        again allowing typos. with_scores=True returns (note_id, score)
+        pairs as search_notes() does, notes found by tags alone
+        score 0.
+        """
+        text, all_tags, any_tags, none_tags = parse_query(query)
+        is_tag_query = all_tags or any_tags or none_tags
+        tagged = (
+            self.filter_by_tags(all_tags, any_tags, none_tags)
+            if is_tag_query else None
+        )
+        if not text:
+            tagged = tagged or []
+            if with_scores:
+                return [(note_id, 0.0) for note_id in tagged]
+            return tagged
+        found = self.search_notes(
+            text, is_cancelled=is_cancelled, with_scores=with_scores
+        )
+        if not found and not (is_cancelled and is_cancelled()):
+            found = self.search_notes(
+                text, is_cancelled=is_cancelled, fuzzy=True,
+                with_scores=with_scores
+            )
+        if tagged is None:
+            return found
+        tagged = set(tagged)
+        if with_scores:
+            return [row for row in found if row[0] in tagged]
+        return [note_id for note_id in found if note_id in tagged]
+
     def update_data(self, note_id, new_title, text, tags):
+        try:
+            if self.write_batch(
+                    [(UPDATE, note_id, new_title, text, tags)]
+            )[0] is None:
+                return 'Cannot update'
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+
+    def update_note_row(self, cursor, note_id, new_title, text, tags):
+        """Update note inside the caller's transaction, return its id
+        or None if there is no such note.
+        """
+        tag_map = self.insert_tags_into_table(cursor, tags)
+        get_note_id = cursor.execute(
+            'SELECT id FROM note WHERE id=?',
+            (note_id,)
+        ).fetchone()
+        # It must be impossible that updated_title doesnt exists
+        if not get_note_id:
+            return None
+        self.unindex_fts(cursor, note_id)
+
+        statement = '''
+            UPDATE note
+            SET title=?, text=?, preview=?
+            WHERE id=?'''
+
+        cursor.execute(
+            statement,
+            (new_title, self.pack_text(text), make_preview(text), note_id)
+        )
+
+        # Refresh intermediate table
+        cursor.execute(
+            'SELECT tag_id FROM note_tag WHERE note_id=?',
+            (note_id,)
+        )
+        current_tag_ids = {row[0] for row in cursor.fetchall()}
+
+        # Also when all tags are removed
+        new_tag_ids = set(tag_map.values())
+        tags_to_add = new_tag_ids - current_tag_ids
+        tags_to_remove = current_tag_ids - new_tag_ids
+        if tags_to_add:
+            cursor.executemany(
+                'INSERT INTO note_tag (note_id, tag_id) VALUES (?, ?)',
+                [(note_id, tid) for tid in tags_to_add]
+            )
+        if tags_to_remove:
+            cursor.executemany(
+                "DELETE FROM note_tag WHERE note_id = ? AND tag_id = ?",
+                [(note_id, tid) for tid in tags_to_remove]
+            )
+        self.index_fts(cursor, note_id)
+        self.similarity.update_note(cursor, note_id)
+        self.duplicates.update_note(cursor, note_id)
+        return note_id
+
+    def delete_note(self, note_id):
+        try:
+            self.write_batch([(DELETE, note_id)])
+            return True
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+
+    def delete_note_row(self, cursor, note_id):
+        "Delete note inside the caller's transaction, return its id."
+        self.similarity.remove_note(cursor, note_id)
+        self.duplicates.remove_note(cursor, note_id)
+        self.unindex_fts(cursor, note_id)
+        statement = '''
+            DELETE FROM note
+            WHERE id=(?);'''
+        cursor.execute(statement, (note_id,))
+        return note_id
+
+    def get_similar_notes(self, note_id, limit=TOP_K) -> list:
+        "Return (note_id, score) of notes most similar to given one."
         try:
             with self.connect_to_db() as conn:
-                cursor = conn.cursor()
-                tag_map = self.insert_tags_into_table(cursor, tags)
-                get_note_id = cursor.execute(
-                    'SELECT id FROM note WHERE id=?',
-                    (note_id,)
-                ).fetchone()
-                # It must be impossible that updated_title doesnt exists
-                if not get_note_id:
-                    return 'Cannot update'
+                return self.similarity.similar_notes(
+                    conn.cursor(), note_id, limit
+                )
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+            return []
 
-                statement = '''
-                    UPDATE note
-                    SET title=?, text=?
-                    WHERE id=?'''
+    def find_duplicates(self, title, text, exclude_id=None) -> list:
+        """Return (note_id, score) of saved notes near-identical to the
+        given title and text, most similar first. exclude_id is the
+        note being edited.
+        """
+        try:
+            with self.connect_to_db() as conn:
+                return self.duplicates.find(
+                    conn.cursor(), title, text, exclude_id
+                )
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+            return []
 
-                cursor.execute(statement, (new_title, text, note_id))
+    def duplicate_groups(self) -> list:
+        "Return groups of near-identical notes, lists of note ids."
+        try:
+            with self.connect_to_db() as conn:
+                return self.duplicates.groups(conn.cursor())
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+            return []
 
-                # Refresh intermediate table
-                cursor.execute(
-                    'SELECT tag_id FROM note_tag WHERE note_id=?',
-                    (note_id,)
+    def get_graph(self) -> tuple:
+        """Return ([(note_id, title)], [(note_id, other_id, score)])
+        of all notes and similar notes edges.
+        """
+        try:
+            with self.connect_to_db() as conn:
+                notes = conn.execute('SELECT id, title FROM note;').fetchall()
+                edges = conn.execute(
+                    'SELECT note_id, other_id, score FROM note_edge;'
+                ).fetchall()
+                return notes, edges
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+            return [], []
+
+    def get_note_positions(self) -> dict:
+        "Return {note_id: (x, y)} of the saved graph layout."
+        try:
+            with self.connect_to_db() as conn:
+                cursor = conn.execute('SELECT note_id, x, y FROM note_position;')
+                return {note_id: (x, y) for note_id, x, y in cursor}
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+            return {}
+
+    def save_note_positions(self, positions):
+        "Save graph layout, an iterable of (note_id, x, y)."
+        try:
+            with self.connect_to_db() as conn:
+                conn.executemany(
+                    '''INSERT OR REPLACE INTO note_position(note_id, x, y)
+                        VALUES(?, ?, ?);''',
+                    positions
                 )
-                current_tag_ids = {row[0] for row in cursor.fetchall()}
+            self.committed(notes_changed=False)
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
 
-                if tag_map:
-                    new_tag_ids = {tag_map[tag] for tag in tags if tag != ''}
+    def rebuild_similarity_graph(self, workers=1):
+        """Recompute similar notes graph from scratch, on a pool of
+        processes if workers > 1.
+        """
+        try:
+            with self.connect_to_db() as conn:
+                self.similarity.rebuild(conn.cursor(), workers)
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+        # Words of the fuzzy index are rewritten too
+        self.committed()
 
-                    tags_to_add = new_tag_ids - current_tag_ids
-                    tags_to_remove = current_tag_ids - new_tag_ids
-                    if tags_to_add:
-                        cursor.executemany(
-                            'INSERT INTO note_tag (note_id, tag_id) VALUES (?, ?)',
-                            [(note_id, tid) for tid in tags_to_add]
-                        )
-                    if tags_to_remove:
-                        cursor.executemany(
-                            "DELETE FROM note_tag WHERE note_id = ? AND tag_id = ?",
-                            [(note_id, tid) for tid in tags_to_remove]
-                        )
+    def rebuild_duplicate_index(self):
+        "Recompute MinHash signatures and bands of all notes."
+        try:
+            with self.connect_to_db() as conn:
+                self.duplicates.rebuild(conn.cursor())
         except sqlite3.Error as e:
             print(f'Error occured: \n {e}')
+        self.committed()
 
-    def delete_note(self, note_id):
+    def vacuum(self) -> int:
+        """Compress large bodies, merge full-text index segments and
+        rebuild the file to free unused pages. Returns how many bodies
+        were compressed.
+        """
+        compressed = self.compress_bodies()
         try:
             with self.connect_to_db() as conn:
-                cursor = conn.cursor()
-                statement = '''
-                    DELETE FROM note
-                    WHERE id=(?);'''
-                cursor.execute(statement, (note_id,))
-                return True
+                conn.execute("INSERT INTO note_fts(note_fts) VALUES('optimize');")
+            # VACUUM cannot run inside a transaction
+            conn.execute('VACUUM;')
+            conn.execute('PRAGMA optimize;')
+        except sqlite3.Error as e:
+            print(f'Error occured: \n {e}')
+        return compressed
+
+    def stats(self) -> dict:
+        """Counts of notes, tags and index rows, sizes in bytes.
+
+        body_bytes - stored_body_bytes is what compression saves in
+        the file: note_fts keeps no copy of bodies.
+        """
+        try:
+            with self.connect_to_db() as conn:
+                notes, compressed, stored_bytes, body_bytes = conn.execute(
+                    '''SELECT COUNT(*), COALESCE(SUM(typeof(text) = 'blob'), 0),
+                        COALESCE(SUM(length(CAST(text AS BLOB))), 0),
+                        COALESCE(SUM(CASE WHEN typeof(text) = 'blob'
+                            THEN length(CAST(note_text(text) AS BLOB))
+                            ELSE length(CAST(text AS BLOB)) END), 0)
+                        FROM note;'''
+                ).fetchone()
+                page_size = conn.execute('PRAGMA page_size;').fetchone()[0]
+                return {
+                    'notes': notes,
+                    'compressed_bodies': compressed,
+                    'body_bytes': body_bytes,
+                    'stored_body_bytes': stored_bytes,
+                    'fts_index_bytes': conn.execute(
+                        'SELECT COALESCE(SUM(length(block)), 0) FROM note_fts_data;'
+                    ).fetchone()[0],
+                    'tags': conn.execute('SELECT COUNT(*) FROM tag;').fetchone()[0],
+                    'note_tags': conn.execute(
+                        'SELECT COUNT(*) FROM note_tag;'
+                    ).fetchone()[0],
+                    'terms': conn.execute('SELECT COUNT(*) FROM term;').fetchone()[0],
+                    'similar_edges': conn.execute(
+                        'SELECT COUNT(*) FROM note_edge;'
+                    ).fetchone()[0],
+                    'file_bytes': page_size * conn.execute(
+                        'PRAGMA page_count;'
+                    ).fetchone()[0],
+                    'free_bytes': page_size * conn.execute(
+                        'PRAGMA freelist_count;'
+                    ).fetchone()[0],
+                }
         except sqlite3.Error as e:
             print(f'Error occured: \n {e}')
+            return {}
 
 
 if __name__ == '__main__':
@@ -0,0 +1,107 @@
+"""Compact in-memory store of loaded notes.
+
+One store holds every note the GUI has loaded: the grid paints from it,
+search results are filled into it and the editor reads title, tags and
+date from it. Notes are kept column-wise in parallel lists indexed by
+slot, so a note costs a few list pointers instead of a tuple, a tag
+list and a dict entry of its own. Tag names are interned and equal tag
+lists share one tuple, so a popular tag exists once in memory.
+"""
+import sys
+from array import array
+
+NO_TAGS = ()
+
+
+class NoteStore:
+    "Notes by id: title, preview, tags and created_at."
+    __slots__ = (
+        'ids', 'titles', 'previews', 'tags', 'created_at',
+        'slots', 'free_slots', 'tag_sets',
+    )
+
+    def __init__(self):
+        self.ids = array('q')
+        self.titles = []
+        self.previews = []
+        self.tags = []
+        self.created_at = []
+        # note id -> slot in the columns
+        self.slots = {}
+        # Slots of removed notes, reused by new ones
+        self.free_slots = []
+        # Every distinct tag tuple once
+        self.tag_sets = {}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, note_id):
+        return note_id in self.slots
+
+    def __getitem__(self, note_id) -> tuple:
+        slot = self.slots[note_id]
+        return (
+            self.titles[slot], self.previews[slot],
+            self.tags[slot], self.created_at[slot],
+        )
+
+    def get(self, note_id, default=None):
+        return self[note_id] if note_id in self.slots else default
+
+    def share_tags(self, tags) -> tuple:
+        if not tags:
+            return NO_TAGS
+        key = tuple(sys.intern(tag) for tag in tags)
+        return self.tag_sets.setdefault(key, key)
+
+    def add(self, note_id, title, preview, tags, created_at):
+        "Add note or replace its data."
+        tags = self.share_tags(tags)
+        slot = self.slots.get(note_id)
+        if slot is None and self.free_slots:
+            slot = self.free_slots.pop()
+            self.slots[note_id] = slot
+            self.ids[slot] = note_id
+        if slot is None:
+            self.slots[note_id] = len(self.ids)
+            self.ids.append(note_id)
+            self.titles.append(title)
+            self.previews.append(preview)
+            self.tags.append(tags)
+            self.created_at.append(created_at)
+            return
+        self.titles[slot] = title
+        self.previews[slot] = preview
+        self.tags[slot] = tags
+        self.created_at[slot] = created_at
+
+    def update(self, notes):
+        "Add notes of a {note_id: (title, preview, tags, created_at)} dict."
+        for note_id, note in notes.items():
+            self.add(note_id, *note)
+
+    def remove(self, note_id):
+        slot = self.slots.pop(note_id, None)
+        if slot is None:
+            return
+        self.ids[slot] = 0
+        self.titles[slot] = self.previews[slot] = None
+        self.tags[slot] = NO_TAGS
+        self.created_at[slot] = None
+        self.free_slots.append(slot)
+
+    def clear(self):
+        self.__init__()
+
+    def title(self, note_id):
+        return self.titles[self.slots[note_id]]
+
+    def preview(self, note_id):
+        return self.previews[self.slots[note_id]]
+
+    def note_tags(self, note_id) -> tuple:
+        return self.tags[self.slots[note_id]]
+
+    def date(self, note_id):
+        return self.created_at[self.slots[note_id]]
@@ -0,0 +1,118 @@
+"""Several notebooks, one SQLite file each, e.g. per project or year.
+
+Notebooks keeps a ManageDb for every file. search() runs find_notes()
+in all notebooks at once: each notebook has its own reader thread, so
+it is read with one connection however many searches run, and SQLite
+works on the files in parallel. Ranked lists are merged by bm25 score.
+
+The list of notebooks and the one open in the GUI are kept in
+NOTEBOOKS_FILE.
+"""
+import heapq
+import json
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+from models import DB_NAME, ManageDb
+
+NOTEBOOKS_FILE = 'notebooks.json'
+
+
+def notebook_key(path) -> str:
+    "Notebooks are told apart by absolute path of their file."
+    return str(Path(path).resolve())
+
+
+def load_list(path=NOTEBOOKS_FILE) -> tuple:
+    """Return (notebook paths, current path) saved by save_list(),
+    the default notebook if there is nothing saved.
+    """
+    try:
+        data = json.loads(Path(path).read_text(encoding='utf-8'))
+        return data['notebooks'], data['current']
+    except (OSError, ValueError, KeyError):
+        return [DB_NAME], DB_NAME
+
+
+def save_list(paths, current, path=NOTEBOOKS_FILE):
+    Path(path).write_text(
+        json.dumps({'notebooks': list(paths), 'current': current}, indent=2),
+        encoding='utf-8'
+    )
+
+
+def search_notebook(db, query, is_cancelled=None) -> list:
+    "find_notes() with scores, run on the reader thread of db."
+    # Schema of a notebook not opened before
+    db.create_tables()
+    return db.find_notes(query, is_cancelled, with_scores=True)
+
+
+class Notebooks:
+    """Open notebooks by path.
+
+    db_options are passed to every ManageDb.
+    """
+    def __init__(self, paths=(), **db_options):
+        self.db_options = db_options
+        self.databases = {}
+        self.readers = {}
+        for path in paths:
+            self.open(path)
+
+    def __len__(self):
+        return len(self.databases)
+
+    @property
+    def paths(self) -> list:
+        return [db.db_name for db in self.databases.values()]
+
+    def add(self, db) -> ManageDb:
+        "Add an already created ManageDb, return the one in use."
+        key = notebook_key(db.db_name)
+        if key not in self.databases:
+            self.databases[key] = db
+            self.readers[key] = ThreadPoolExecutor(
+                1, thread_name_prefix='topaz-reader'
+            )
+        return self.databases[key]
+
+    def open(self, path) -> ManageDb:
+        "Return ManageDb of the notebook, adding it if it is new."
+        db = self.databases.get(notebook_key(path))
+        if db is None:
+            db = self.add(ManageDb(path, **self.db_options))
+        return db
+
+    def remove(self, path):
+        "Close the notebook and forget it, its file stays."
+        key = notebook_key(path)
+        db = self.databases.pop(key, None)
+        if db is None:
+            return
+        self.readers.pop(key).shutdown()
+        db.close()
+
+    def search(self, query, limit=None, is_cancelled=None) -> list:
+        """Return (path, note_id) of notes matching query in all
+        notebooks, best match first, see ManageDb.find_notes().
+        """
+        futures = [
+            (db.db_name, self.readers[key].submit(
+                search_notebook, db, query, is_cancelled
+            ))
+            for key, db in self.databases.items()
+        ]
+        ranked = [
+            [(score, path, note_id) for note_id, score in future.result()]
+            for path, future in futures
+        ]
+        # Equal scores, e.g. of tag queries, keep notebook order
+        merged = heapq.merge(*ranked, key=lambda row: row[0])
+        return [(path, note_id) for _, path, note_id in islice(merged, limit)]
+
+    def close(self):
+        for key in list(self.databases):
+            self.readers.pop(key).shutdown()
+            self.databases.pop(key).close()
@@ -0,0 +1,184 @@
+"""Import and export of notes.
+
+Two formats:
+- JSON Lines: one note per line,
+  {"title": ..., "text": ..., "tags": [...], "created_at": ...}
+- directory of Markdown files, one note per file, with front-matter:
+
+      ---
+      title: "Note title"
+      tags: ["#python", "#history"]
+      created_at: 2025-11-25 07:45:17
+      ---
+      Note text
+
+Readers are generators, so files are read while notes are inserted
+by ManageDb.import_notes() in large transactions.
+"""
+import json
+import re
+from pathlib import Path
+
+FRONT_MATTER = '---'
+# Characters not allowed in file names on common systems.
+UNSAFE_FILE_CHARS = re.compile(r'[^\w\- ]+')
+
+
+def read_jsonl(path):
+    "Yield notes from JSON Lines file, empty lines are skipped."
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            note = json.loads(line)
+            yield {
+                'title': note.get('title', ''),
+                'text': note.get('text', ''),
+                # A list or a "#a, #b" string, normalize_tags() splits it
+                'tags': note.get('tags') or [],
+                'created_at': note.get('created_at'),
+            }
+
+
+def parse_front_matter_value(value):
+    "JSON value if it looks like one, plain string otherwise."
+    value = value.strip()
+    if value[:1] in ('[', '"'):
+        try:
+            return json.loads(value)
+        except json.JSONDecodeError:
+            pass
+    return value
+
+
+def read_markdown_note(path) -> dict:
+    text = Path(path).read_text(encoding='utf-8')
+    meta = {}
+    lines = text.split('\n')
+    if lines and lines[0].strip() == FRONT_MATTER:
+        for i, line in enumerate(lines[1:], start=1):
+            if line.strip() == FRONT_MATTER:
+                text = '\n'.join(lines[i + 1:])
+                break
+            key, sep, value = line.partition(':')
+            if sep:
+                meta[key.strip()] = parse_front_matter_value(value)
+        else:
+            # No closing line, it was not front-matter
+            meta = {}
+
+    tags = meta.get('tags') or []
+    if isinstance(tags, str):
+        tags = [tag.strip() for tag in tags.split(',')]
+    return {
+        'title': str(meta.get('title', Path(path).stem)),
+        'text': text,
+        'tags': [str(tag) for tag in tags],
+        'created_at': meta.get('created_at') or None,
+    }
+
+
+def read_markdown_dir(directory):
+    "Yield notes from *.md files of the directory, in name order."
+    for path in sorted(Path(directory).glob('*.md')):
+        yield read_markdown_note(path)
+
+
+def write_jsonl(notes, path, progress=None, progress_every=10000) -> int:
+    "Write (note_id, title, text, tags, created_at) rows to JSON Lines."
+    written = 0
+    with open(path, 'w', encoding='utf-8') as file:
+        for _, title, text, tags, created_at in notes:
+            file.write(json.dumps(
+                {
+                    'title': title, 'text': text,
+                    'tags': tags, 'created_at': created_at,
+                },
+                ensure_ascii=False
+            ))
+            file.write('\n')
+            written += 1
+            if progress and written % progress_every == 0:
+                progress(written)
+    if progress:
+        progress(written)
+    return written
+
+
+def markdown_file_name(note_id, title) -> str:
+    slug = UNSAFE_FILE_CHARS.sub('', title or '').strip()[:40]
+    return f'{note_id}-{slug}.md' if slug else f'{note_id}.md'
+
+
+def write_markdown_dir(notes, directory, progress=None, progress_every=10000) -> int:
+    "Write (note_id, title, text, tags, created_at) rows as Markdown files."
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    written = 0
+    for note_id, title, text, tags, created_at in notes:
+        front_matter = '\n'.join((
+            FRONT_MATTER,
+            f'title: {json.dumps(title, ensure_ascii=False)}',
+            f'tags: {json.dumps(tags, ensure_ascii=False)}',
+            f'created_at: {created_at}',
+            FRONT_MATTER,
+        ))
+        (directory / markdown_file_name(note_id, title)).write_text(
+            f'{front_matter}\n{text}', encoding='utf-8'
+        )
+        written += 1
+        if progress and written % progress_every == 0:
+            progress(written)
+    if progress:
+        progress(written)
+    return written
+
+
+def import_jsonl(db, path, progress=None, index=True) -> int:
+    return db.import_notes(read_jsonl(path), progress=progress, index=index)
+
+
+def import_markdown_dir(db, directory, progress=None, index=True) -> int:
+    return db.import_notes(
+        read_markdown_dir(directory), progress=progress, index=index
+    )
+
+
+def export_jsonl(db, path, progress=None) -> int:
+    return write_jsonl(db.iter_notes(), path, progress)
+
+
+def export_markdown_dir(db, directory, progress=None) -> int:
+    return write_markdown_dir(db.iter_notes(), directory, progress)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    from models import ManageDb
+
+    usage = (
+        'Usage: python notes_io.py import|export jsonl|md PATH'
+    )
+    if len(sys.argv) != 4:
+        sys.exit(usage)
+    action, kind, target = sys.argv[1:]
+    actions = {
+        ('import', 'jsonl'): import_jsonl,
+        ('import', 'md'): import_markdown_dir,
+        ('export', 'jsonl'): export_jsonl,
+        ('export', 'md'): export_markdown_dir,
+    }
+    if (action, kind) not in actions:
+        sys.exit(usage)
+
+    db = ManageDb()
+    db.create_tables()
+    start = time.perf_counter()
+    count = actions[action, kind](
+        db, target, progress=lambda done: print(f'{done} notes', end='\r')
+    )
+    elapsed = time.perf_counter() - start
+    print(f'{count} notes in {elapsed:.1f} s ({count / max(elapsed, 1e-9):.0f} notes/s)')
+    db.close()
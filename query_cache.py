@@ -0,0 +1,164 @@
+"""Cache of query results of ManageDb.
+
+Results of listing, search and tag filter methods are kept by method
+and arguments in an LRU dict within a byte budget. ManageDb clears it
+after its own writes and when PRAGMA data_version shows that another
+connection, of this or another process, has committed.
+
+Cleared results must not come back: a query running during a clear
+may have read the old data, so put() drops results computed before
+the last clear.
+"""
+import functools
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from itertools import islice
+
+QUERY_CACHE_BYTES = 32 * 1024 * 1024
+# Size of big results is estimated from this many items.
+SAMPLE_ITEMS = 64
+# Returned by QueryCache.get() when there is no entry.
+MISSING = object()
+
+
+def result_size(value) -> int:
+    """Rough bytes held by a result of dicts, lists, tuples, strings
+    and numbers, extrapolated from the first SAMPLE_ITEMS items.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        sample = list(islice(value.items(), SAMPLE_ITEMS))
+        sample_size = sum(result_size(k) + result_size(v) for k, v in sample)
+    elif isinstance(value, (list, tuple)):
+        sample = value[:SAMPLE_ITEMS]
+        sample_size = sum(map(result_size, sample))
+    else:
+        return size
+    return size + sample_size * len(value) // max(len(sample), 1)
+
+
+def freeze(value):
+    "Hashable form of arguments, lists become tuples."
+    if isinstance(value, (list, tuple)):
+        return tuple(map(freeze, value))
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    return value
+
+
+def copy_result(value):
+    "Shallow copy, callers may change the list or dict they get."
+    if isinstance(value, (list, dict)):
+        return type(value)(value)
+    return value
+
+
+class QueryCache:
+    """LRU dict of results with a budget of max_bytes, 0 turns it
+    off. Thread-safe.
+    """
+    def __init__(self, max_bytes=QUERY_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # Bumped by clear(), results computed before are not stored
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        "Cached result, MISSING if there is none."
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, generation):
+        """Store result computed while generation was current,
+        evicting least recently used results to fit.
+        """
+        size = result_size(value)
+        with self.lock:
+            if generation != self.generation or size > self.max_bytes:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+            }
+
+
+def cached(empty):
+    """Cache results of a ManageDb method in self.query_cache by its
+    arguments. is_cancelled is not part of the key and results of
+    cancelled calls are not stored.
+
+    The method lets sqlite3.Error out: it is printed here and empty()
+    is returned without being stored, so a transient "database is
+    locked" is not served from the cache until the next write.
+    """
+    def decorate(method):
+        name = method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cache = self.query_cache
+            is_cancelled = kwargs.get('is_cancelled')
+            key = None
+            try:
+                if cache.max_bytes:
+                    self.check_data_version()
+                    key = (name, freeze(args), freeze({
+                        k: v for k, v in kwargs.items() if k != 'is_cancelled'
+                    }))
+                    value = cache.get(key)
+                    if value is not MISSING:
+                        return copy_result(value)
+                    generation = cache.generation
+                value = method(self, *args, **kwargs)
+            except sqlite3.Error as e:
+                # Cancelled queries are interrupted, that is no error
+                if not (is_cancelled and is_cancelled()):
+                    print(f'Error occured: \n {e}')
+                return empty()
+            if key is not None and not (is_cancelled and is_cancelled()):
+                cache.put(key, value, generation)
+            return copy_result(value)
+        return wrapper
+    return decorate
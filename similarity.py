@@ -0,0 +1,631 @@
+"""Graph of similar notes.
+
+Every note is a TF-IDF vector over words of its title, text and tags.
+A note keeps edges to its TOP_K most similar notes (cosine similarity)
+in note_edge table.
+
+Changing a note touches only edges of this note and of notes which are
+or may become linked to it. Candidates are found with the note_fts
+full-text index, then scored exactly with their stored vectors.
+rebuild() computes the whole graph in sparse NumPy batches, on a pool
+of processes for batch jobs (similarity_pool.py).
+
+Methods take a cursor and run inside the caller's transaction, like
+ManageDb.index_fts(). Bodies are read with note_text(), the SQL
+function ManageDb registers to decompress them.
+"""
+import heapq
+import math
+import re
+import sys
+from array import array
+from collections import Counter
+
+from instrumentation import instrumented
+from sql_params import chunked
+
+TOP_K = 8
+MIN_SCORE = 0.05
+# Words found in more notes do not make notes similar. It also bounds
+# the work per note, so the graph is built in time linear in notes.
+MAX_DF = 200
+# Tags describe the note better than any single word.
+TAG_WEIGHT = 3
+# Most important words of a note used to look for candidates.
+QUERY_TERMS = 16
+# How many best full-text matches are scored as candidates.
+CANDIDATES = 100
+# Notes which lose their edge to a changed or removed note look for a
+# new neighbour with a full-text query each, inside the write. Only
+# this many of them per write, the rest keep one edge less until they
+# change themselves or rebuild().
+RELINK_LIMIT = 2
+# Upper bound of products computed at once in rebuild().
+BATCH_PRODUCTS = 4_000_000
+
+WORD_RE = re.compile(r'\w\w+')
+
+SCHEMA = [
+    # Vocabulary and number of notes containing every word.
+    '''CREATE TABLE IF NOT EXISTS term (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE,
+        df INTEGER
+        );''',
+    # Term ids and word counts of the note as packed int32 arrays,
+    # length of its TF-IDF vector when it was indexed.
+    '''CREATE TABLE IF NOT EXISTS note_vector (
+        note_id INTEGER PRIMARY KEY,
+        terms BLOB,
+        counts BLOB,
+        norm REAL,
+        FOREIGN KEY (note_id) REFERENCES note (id) ON DELETE CASCADE
+        );''',
+    '''CREATE TABLE IF NOT EXISTS note_edge (
+        note_id INTEGER,
+        other_id INTEGER,
+        score REAL,
+        PRIMARY KEY (note_id, other_id),
+        FOREIGN KEY (note_id) REFERENCES note (id) ON DELETE CASCADE,
+        FOREIGN KEY (other_id) REFERENCES note (id) ON DELETE CASCADE
+        ) WITHOUT ROWID;''',
+    '''CREATE INDEX IF NOT EXISTS note_edge_other_id
+        ON note_edge (other_id);''',
+]
+
+
+def note_terms(title, text, tags) -> Counter:
+    "Count words of a note, tag words count TAG_WEIGHT times."
+    counts = Counter(WORD_RE.findall(f'{title or ""} {text or ""}'.lower()))
+    for tag in tags:
+        for word in WORD_RE.findall(tag.lower()):
+            counts[word] += TAG_WEIGHT
+    return counts
+
+
+def term_weight(count) -> float:
+    return 1 + math.log(count)
+
+
+def idf(df, n_notes) -> float:
+    return math.log((n_notes + 1) / (df + 1)) + 1
+
+
+def pack(values) -> bytes:
+    "Little-endian int32 array, the same on every machine."
+    packed = array('i', values)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack(blob) -> array:
+    values = array('i')
+    values.frombytes(blob)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+@instrumented
+class SimilarityGraph:
+    """Keep note_edge up to date with notes.
+
+    Scores of a changed note use document frequencies of the moment,
+    norms of other notes are the ones stored when they were indexed,
+    so scores drift slightly until the next rebuild(). Neighbours
+    keep their edges to a changed note with its new score and are
+    not searched again, see RELINK_LIMIT.
+    """
+    def __init__(self, top_k=TOP_K, min_score=MIN_SCORE):
+        self.top_k = top_k
+        self.min_score = min_score
+
+    def note_count(self, cursor) -> int:
+        return cursor.execute('SELECT COUNT(*) FROM note_vector;').fetchone()[0]
+
+    def is_empty(self, cursor) -> bool:
+        return cursor.execute('SELECT 1 FROM note_vector LIMIT 1;').fetchone() is None
+
+    def similar_notes(self, cursor, note_id, limit=TOP_K) -> list:
+        "Return (other_id, score) pairs, most similar first."
+        cursor.execute(
+            '''SELECT other_id, score FROM note_edge
+                WHERE note_id=?
+                ORDER BY score DESC
+                LIMIT ?;''',
+            (note_id, limit)
+        )
+        return cursor.fetchall()
+
+    def update_note(self, cursor, note_id):
+        "Index new or changed note and update affected edges."
+        row = cursor.execute(
+            'SELECT title, note_text(text) FROM note WHERE id=?;', (note_id,)
+        ).fetchone()
+        if not row:
+            return
+        cursor.execute(
+            '''SELECT t.name FROM note_tag nt
+                JOIN tag t ON t.id = nt.tag_id
+                WHERE nt.note_id=?;''',
+            (note_id,)
+        )
+        tags = [name for name, in cursor.fetchall()]
+        word_counts = note_terms(*row, tags)
+
+        self.drop_terms(cursor, note_id)
+        cursor.executemany(
+            '''INSERT INTO term(name, df) VALUES(?, 1)
+                ON CONFLICT(name) DO UPDATE SET df = df + 1;''',
+            [(word,) for word in word_counts]
+        )
+        terms = {}
+        for chunk in chunked(word_counts):
+            placeholders = ','.join('?' for _ in chunk)
+            cursor.execute(
+                f'SELECT id, name, df FROM term WHERE name IN ({placeholders});',
+                chunk
+            )
+            terms.update(
+                (term_id, (name, df)) for term_id, name, df in cursor.fetchall()
+            )
+        counts = {
+            term_id: word_counts[name] for term_id, (name, _) in terms.items()
+        }
+
+        # Count this note, it is not in note_vector yet
+        n_notes = self.note_count(cursor) + 1
+        weights = self.weights(counts, terms, n_notes)
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        cursor.execute(
+            '''INSERT INTO note_vector(note_id, terms, counts, norm)
+                VALUES(?, ?, ?, ?);''',
+            (note_id, pack(counts), pack(counts.values()), norm)
+        )
+
+        scores = self.scores(cursor, note_id, weights, terms, norm, n_notes)
+        self.replace_edges(cursor, note_id, scores)
+        self.link_back(cursor, note_id, scores)
+
+    def remove_note(self, cursor, note_id):
+        """Drop note from the graph, notes linked to it find
+        other neighbours. Call before the note row is deleted.
+        """
+        cursor.execute(
+            'SELECT note_id, score FROM note_edge WHERE other_id=?;',
+            (note_id,)
+        )
+        linked = dict(cursor.fetchall())
+        cursor.execute(
+            'DELETE FROM note_edge WHERE note_id=? OR other_id=?;',
+            (note_id, note_id)
+        )
+        self.drop_terms(cursor, note_id)
+        self.relink_some(cursor, linked)
+
+    def drop_terms(self, cursor, note_id):
+        "Forget indexed words of the note."
+        row = cursor.execute(
+            'SELECT terms FROM note_vector WHERE note_id=?;', (note_id,)
+        ).fetchone()
+        if not row:
+            return
+        term_ids = [(term_id,) for term_id in unpack(row[0])]
+        cursor.executemany(
+            'UPDATE term SET df = df - 1 WHERE id=?;', term_ids
+        )
+        cursor.executemany(
+            'DELETE FROM term WHERE id=? AND df <= 0;', term_ids
+        )
+        cursor.execute('DELETE FROM note_vector WHERE note_id=?;', (note_id,))
+
+    def weights(self, counts, terms, n_notes) -> dict:
+        "TF-IDF weights by term id."
+        return {
+            term_id: term_weight(count) * idf(terms[term_id][1], n_notes)
+            for term_id, count in counts.items()
+        }
+
+    def scores(self, cursor, note_id, weights, terms, norm, n_notes) -> dict:
+        """Cosine similarity of the note to the best full-text matches
+        of its most important words. Words in one note only or in too
+        many notes do not count, the same as in rebuild().
+
+        terms maps term id to (name, df).
+        """
+        shared = {
+            term_id: weight * idf(terms[term_id][1], n_notes)
+            for term_id, weight in weights.items()
+            if 1 < terms[term_id][1] <= MAX_DF
+        }
+        if not shared:
+            return {}
+        query_terms = heapq.nlargest(QUERY_TERMS, shared, key=shared.get)
+        cursor.execute(
+            '''SELECT rowid FROM note_fts
+                WHERE note_fts MATCH ? AND rowid != ?
+                ORDER BY rank
+                LIMIT ?;''',
+            (
+                ' OR '.join(f'"{terms[term_id][0]}"' for term_id in query_terms),
+                note_id, CANDIDATES
+            )
+        )
+        candidates = [other for other, in cursor.fetchall()]
+
+        scores = {}
+        for chunk in chunked(candidates):
+            placeholders = ','.join('?' for _ in chunk)
+            cursor.execute(
+                f'''SELECT note_id, terms, counts, norm FROM note_vector
+                    WHERE note_id IN ({placeholders});''',
+                chunk
+            )
+            for other, other_terms, other_counts, other_norm in cursor.fetchall():
+                dot = 0.0
+                for term_id, count in zip(unpack(other_terms), unpack(other_counts)):
+                    if term_id in shared:
+                        dot += shared[term_id] * term_weight(count)
+                score = dot / (norm * other_norm)
+                if score >= self.min_score:
+                    scores[other] = score
+        return scores
+
+    def replace_edges(self, cursor, note_id, scores):
+        "Link note to its top_k most similar notes."
+        cursor.execute('DELETE FROM note_edge WHERE note_id=?;', (note_id,))
+        top = heapq.nlargest(self.top_k, scores.items(), key=lambda x: x[1])
+        cursor.executemany(
+            'INSERT INTO note_edge(note_id, other_id, score) VALUES(?, ?, ?);',
+            [(note_id, other, score) for other, score in top]
+        )
+
+    def link_back(self, cursor, note_id, scores):
+        """Update edges of other notes pointing to the changed note
+        and add the note to neighbours of notes it now beats.
+        """
+        cursor.execute(
+            'SELECT note_id, score FROM note_edge WHERE other_id=?;',
+            (note_id,)
+        )
+        linked = dict(cursor.fetchall())
+        lost = {}
+        for other, old_score in linked.items():
+            new_score = scores.get(other)
+            if new_score is not None:
+                # Another note may be closer now if the score went
+                # down, left to rebuild()
+                cursor.execute(
+                    '''UPDATE note_edge SET score=?
+                        WHERE note_id=? AND other_id=?;''',
+                    (new_score, other, note_id)
+                )
+            else:
+                lost[other] = old_score
+        cursor.executemany(
+            'DELETE FROM note_edge WHERE note_id=? AND other_id=?;',
+            [(other, note_id) for other in lost]
+        )
+
+        candidates = [other for other in scores if other not in linked]
+        stats = {}
+        for chunk in chunked(candidates):
+            placeholders = ','.join('?' for _ in chunk)
+            cursor.execute(
+                f'''SELECT note_id, COUNT(*), MIN(score) FROM note_edge
+                    WHERE note_id IN ({placeholders})
+                    GROUP BY note_id;''',
+                chunk
+            )
+            stats.update(
+                (other, (count, lowest))
+                for other, count, lowest in cursor.fetchall()
+            )
+        for other in candidates:
+            count, lowest = stats.get(other, (0, 0.0))
+            if count < self.top_k or scores[other] > lowest:
+                cursor.execute(
+                    '''INSERT OR REPLACE INTO note_edge(note_id, other_id, score)
+                        VALUES(?, ?, ?);''',
+                    (other, note_id, scores[other])
+                )
+                if count >= self.top_k:
+                    self.trim_edges(cursor, other)
+
+        self.relink_some(cursor, lost)
+
+    def trim_edges(self, cursor, note_id):
+        "Keep only top_k edges of the note."
+        cursor.execute(
+            '''DELETE FROM note_edge
+                WHERE note_id=? AND other_id NOT IN (
+                    SELECT other_id FROM note_edge
+                    WHERE note_id=?
+                    ORDER BY score DESC
+                    LIMIT ?);''',
+            (note_id, note_id, self.top_k)
+        )
+
+    def relink_some(self, cursor, lost):
+        """Relink up to RELINK_LIMIT notes of lost, {note_id: score of
+        the edge they lost}, those which lost the closest neighbour.
+        """
+        for other in heapq.nlargest(RELINK_LIMIT, lost, key=lost.get):
+            self.relink(cursor, other)
+
+    def relink(self, cursor, note_id):
+        "Recompute edges of already indexed note."
+        row = cursor.execute(
+            'SELECT terms, counts, norm FROM note_vector WHERE note_id=?;',
+            (note_id,)
+        ).fetchone()
+        if not row:
+            return
+        counts = dict(zip(unpack(row[0]), unpack(row[1])))
+        terms = {}
+        for chunk in chunked(counts):
+            placeholders = ','.join('?' for _ in chunk)
+            cursor.execute(
+                f'SELECT id, name, df FROM term WHERE id IN ({placeholders});',
+                chunk
+            )
+            terms.update(
+                (term_id, (name, df)) for term_id, name, df in cursor.fetchall()
+            )
+        n_notes = self.note_count(cursor)
+        weights = self.weights(counts, terms, n_notes)
+        scores = self.scores(cursor, note_id, weights, terms, row[2], n_notes)
+        self.replace_edges(cursor, note_id, scores)
+
+    def rebuild(self, cursor, workers=1):
+        """Recompute vectors and all edges from scratch.
+
+        With workers > 1 notes are read and scored on a process pool,
+        see similarity_pool.py. Workers read notes committed before
+        the caller's transaction.
+        """
+        if workers > 1:
+            # Starts processes, only for batch jobs
+            from similarity_pool import compute_graph_parallel
+            terms, index, edges = compute_graph_parallel(
+                cursor, workers, self.top_k, self.min_score
+            )
+        else:
+            terms, index, edges = compute_graph(
+                cursor, self.top_k, self.min_score
+            )
+        self.write_graph(cursor, terms, index, edges)
+
+    def write_graph(self, cursor, terms, index, edges):
+        "Replace term, note_vector and note_edge with computed ones."
+        # Heavy import, needed only here
+        import numpy as np
+
+        note_ids, words, indices, counts, indptr = terms
+        terms32 = (indices + 1).astype('<i4')
+        counts32 = counts.astype('<i4')
+        bounds = indptr.tolist()
+        ids = note_ids.tolist()
+        for table in ('note_edge', 'note_vector', 'term'):
+            cursor.execute(f'DELETE FROM {table};')
+        # Term id is its position in vocabulary plus one
+        cursor.executemany(
+            'INSERT INTO term(id, name, df) VALUES(?, ?, ?);',
+            zip(range(1, len(words) + 1), words, index['df'].tolist())
+        )
+        cursor.executemany(
+            '''INSERT INTO note_vector(note_id, terms, counts, norm)
+                VALUES(?, ?, ?, ?);''',
+            (
+                (
+                    ids[i],
+                    terms32[bounds[i]:bounds[i + 1]].tobytes(),
+                    counts32[bounds[i]:bounds[i + 1]].tobytes(),
+                    norm
+                )
+                for i, norm in enumerate(index['norms'].tolist())
+            )
+        )
+        if edges:
+            edge_from, edge_to, edge_score = zip(*edges)
+            cursor.executemany(
+                'INSERT INTO note_edge(note_id, other_id, score) VALUES(?, ?, ?);',
+                zip(
+                    note_ids[np.concatenate(edge_from)].tolist(),
+                    note_ids[np.concatenate(edge_to)].tolist(),
+                    np.concatenate(edge_score).tolist()
+                )
+            )
+
+
+# Whole graph computation, in steps that run on blocks of notes, so
+# similarity_pool.py can spread them over processes. Notes become rows
+# of a sparse matrix of normalized TF-IDF weights. For a block of rows,
+# products with the rows sharing a word are expanded through the
+# inverted index and summed, so the work depends on shared words, not
+# on number of pairs.
+
+def read_terms(cursor, first_id=None, last_id=None) -> tuple:
+    """Count words of notes with ids from first_id to last_id, all
+    notes by default, in id order.
+
+    Returns note ids, distinct words of these notes and the CSR
+    arrays: word of every (note, word) entry as position in words,
+    its count, and where entries of every note start.
+    """
+    # Heavy import, needed only here
+    import numpy as np
+
+    where, params = '', ()
+    if first_id is not None:
+        where, params = 'WHERE n.id BETWEEN ? AND ?', (first_id, last_id)
+    note_ids = array('q')
+    all_words = []
+    all_counts = array('q')
+    indptr = array('q', [0])
+    cursor.execute(
+        f'''SELECT n.id, n.title, note_text(n.text),
+            (SELECT GROUP_CONCAT(t.name, ',') FROM note_tag nt
+                JOIN tag t ON t.id = nt.tag_id
+                WHERE nt.note_id = n.id)
+            FROM note n
+            {where}
+            ORDER BY n.id;''',
+        params
+    )
+    for note_id, title, text, tags in cursor.fetchall():
+        word_counts = note_terms(title, text, tags.split(',') if tags else [])
+        note_ids.append(note_id)
+        all_words.extend(word_counts)
+        all_counts.extend(word_counts.values())
+        indptr.append(len(all_words))
+    vocab = {word: i for i, word in enumerate(dict.fromkeys(all_words))}
+    indices = np.fromiter(
+        map(vocab.__getitem__, all_words), dtype=np.int64,
+        count=len(all_words)
+    )
+    return (
+        np.frombuffer(note_ids, dtype=np.int64), list(vocab), indices,
+        np.frombuffer(all_counts, dtype=np.int64),
+        np.frombuffer(indptr, dtype=np.int64),
+    )
+
+
+def merge_terms(blocks) -> tuple:
+    """Join read_terms() of consecutive blocks of notes into one,
+    words get positions in the order they first appear.
+    """
+    import numpy as np
+
+    if len(blocks) == 1:
+        return blocks[0]
+    vocab = {}
+    note_ids, indices, counts = [], [], []
+    indptr = [np.zeros(1, dtype=np.int64)]
+    entries = 0
+    for block_ids, words, block_indices, block_counts, block_indptr in blocks:
+        position = np.fromiter(
+            (vocab.setdefault(word, len(vocab)) for word in words),
+            dtype=np.int64, count=len(words)
+        )
+        note_ids.append(block_ids)
+        indices.append(position[block_indices])
+        counts.append(block_counts)
+        indptr.append(block_indptr[1:] + entries)
+        entries += int(block_indptr[-1])
+    return (
+        np.concatenate(note_ids), list(vocab), np.concatenate(indices),
+        np.concatenate(counts), np.concatenate(indptr),
+    )
+
+
+def term_index(indices, counts, indptr, n_terms) -> dict:
+    """Document frequencies, norms, normalized weights and the inverted
+    index over words shared by a few notes, as arrays by name.
+    """
+    import numpy as np
+
+    n_notes = len(indptr) - 1
+    tf = 1 + np.log(counts)
+    row_of = np.repeat(np.arange(n_notes), np.diff(indptr))
+
+    df = np.bincount(indices, minlength=n_terms)
+    idf_of = np.log((n_notes + 1) / (df + 1)) + 1
+    weights = tf * idf_of[indices]
+    norms = np.sqrt(np.bincount(row_of, weights=weights ** 2, minlength=n_notes))
+    norms[norms == 0] = 1.0
+    normalized = weights / norms[row_of]
+
+    useful = (df > 1) & (df <= MAX_DF)
+    keep = useful[indices]
+    rows = row_of[keep]
+    terms = indices[keep]
+    values = normalized[keep]
+    order = np.argsort(terms, kind='stable')
+    posting_len = np.bincount(terms, minlength=n_terms)
+    return {
+        'df': df,
+        'norms': norms,
+        'rows': rows,
+        'terms': terms,
+        'values': values,
+        'posting_rows': rows[order],
+        'posting_values': values[order],
+        'posting_len': posting_len,
+        'posting_start': np.cumsum(posting_len) - posting_len,
+        # Products of rows up to every row
+        'row_products': np.cumsum(
+            np.bincount(rows, weights=posting_len[terms], minlength=n_notes)
+        ),
+    }
+
+
+def row_blocks(row_products, batch_products=BATCH_PRODUCTS) -> list:
+    "(first, last) ranges of rows with about batch_products products."
+    import numpy as np
+
+    n_notes = len(row_products)
+    blocks = []
+    first = 0
+    while first < n_notes:
+        done = row_products[first - 1] if first else 0
+        last = int(np.searchsorted(
+            row_products, done + batch_products, side='right'
+        ))
+        last = max(last, first + 1)
+        blocks.append((first, last))
+        first = last
+    return blocks
+
+
+def block_edges(index, first, last, top_k, min_score) -> tuple:
+    """Row, other row and score arrays of top_k edges of every row
+    from first to last - 1.
+    """
+    import numpy as np
+
+    n_notes = len(index['row_products'])
+    rows = index['rows']
+    posting_len = index['posting_len']
+    start, stop = np.searchsorted(rows, (first, last))
+
+    batch_terms = index['terms'][start:stop]
+    lens = posting_len[batch_terms]
+    offsets = np.arange(lens.sum()) + np.repeat(
+        index['posting_start'][batch_terms] - np.cumsum(lens) + lens, lens
+    )
+    row = np.repeat(rows[start:stop] - first, lens)
+    other = index['posting_rows'][offsets]
+    product = (
+        np.repeat(index['values'][start:stop], lens)
+        * index['posting_values'][offsets]
+    )
+
+    # Sum products of every (row, other) pair
+    keys = row * n_notes + other
+    order = np.argsort(keys)
+    keys = keys[order]
+    starts = np.flatnonzero(np.diff(keys, prepend=-1))
+    sums = np.add.reduceat(product[order], starts) if len(keys) else product
+    row, other = np.divmod(keys[starts], n_notes)
+
+    good = (sums >= min_score) & (row + first != other)
+    row, other, sums = row[good], other[good], sums[good]
+    order = np.lexsort((-sums, row))
+    row, other, sums = row[order], other[order], sums[order]
+    rank = np.arange(len(row)) - np.searchsorted(row, row)
+    top = rank < top_k
+    return row[top] + first, other[top], sums[top]
+
+
+def compute_graph(cursor, top_k=TOP_K, min_score=MIN_SCORE) -> tuple:
+    "(terms, index, edges) of all notes, in this process."
+    terms = read_terms(cursor)
+    _, words, indices, counts, indptr = terms
+    index = term_index(indices, counts, indptr, len(words))
+    edges = [
+        block_edges(index, first, last, top_k, min_score)
+        for first, last in row_blocks(index['row_products'])
+    ]
+    return terms, index, edges
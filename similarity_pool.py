@@ -0,0 +1,129 @@
+"""Rebuild of the similar notes graph on a process pool.
+
+SimilarityGraph.rebuild(cursor, workers=N) gives the two slow steps of
+compute_graph() to N processes:
+
+1. Notes are split into blocks of consecutive ids. A worker reads its
+   block with its own read-only connection and counts words, only the
+   distinct words and number arrays of the block come back.
+2. Arrays of the inverted index are copied once into shared memory.
+   Workers map them without pickling and score blocks of rows, only
+   the top edges of every row come back.
+
+The parent joins the blocks and writes the graph in bulk, in the
+caller's transaction. Workers read notes committed before it.
+"""
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_context
+from multiprocessing.shared_memory import SharedMemory
+from pathlib import Path
+
+import numpy as np
+
+from models import unpack_text
+from similarity import (
+    BATCH_PRODUCTS, block_edges, compute_graph, merge_terms, read_terms,
+    row_blocks, term_index,
+)
+
+# Blocks per worker, so a worker with long notes does not hold up
+# the others.
+BLOCKS_PER_WORKER = 4
+# Arrays of term_index() used by block_edges().
+SHARED_ARRAYS = (
+    'rows', 'terms', 'values', 'posting_rows', 'posting_values',
+    'posting_len', 'posting_start', 'row_products',
+)
+
+
+def database_path(cursor):
+    "File of the main database, None if it is in memory."
+    for _, name, path in cursor.execute('PRAGMA database_list;').fetchall():
+        if name == 'main':
+            return path or None
+    return None
+
+
+def id_ranges(note_ids, blocks) -> list:
+    "(first_id, last_id) of about equal blocks of sorted note ids."
+    size = -(-len(note_ids) // blocks)
+    return [
+        (note_ids[i], note_ids[min(i + size, len(note_ids)) - 1])
+        for i in range(0, len(note_ids), size)
+    ]
+
+
+def read_block(path, first_id, last_id) -> tuple:
+    "read_terms() of a block, run in a worker."
+    conn = sqlite3.connect(Path(path).as_uri() + '?mode=ro', uri=True)
+    try:
+        conn.create_function('note_text', 1, unpack_text, deterministic=True)
+        return read_terms(conn.cursor(), first_id, last_id)
+    finally:
+        conn.close()
+
+
+def share(arrays) -> tuple:
+    """Copy arrays into new shared memory. Returns it and the layout,
+    (name, dtype, offset, length) of every array.
+    """
+    layout = []
+    size = 0
+    for name, values in arrays.items():
+        layout.append((name, values.dtype.str, size, len(values)))
+        size += values.nbytes
+    memory = SharedMemory(create=True, size=max(size, 1))
+    for name, dtype, offset, length in layout:
+        np.ndarray(length, dtype, memory.buf, offset)[:] = arrays[name]
+    return memory, layout
+
+
+def score_block(memory_name, layout, first, last, top_k, min_score) -> tuple:
+    "block_edges() over shared index arrays, run in a worker."
+    memory = SharedMemory(name=memory_name)
+    try:
+        index = {
+            name: np.ndarray(length, dtype, memory.buf, offset)
+            for name, dtype, offset, length in layout
+        }
+        edges = block_edges(index, first, last, top_k, min_score)
+        # Views must be gone before close(), edges are copies
+        del index
+        return edges
+    finally:
+        memory.close()
+
+
+def compute_graph_parallel(cursor, workers, top_k, min_score) -> tuple:
+    "compute_graph() on a pool of workers processes."
+    path = database_path(cursor)
+    note_ids = [
+        note_id for note_id, in cursor.execute('SELECT id FROM note ORDER BY id;')
+    ]
+    if path is None or not note_ids:
+        return compute_graph(cursor, top_k, min_score)
+    blocks = workers * BLOCKS_PER_WORKER
+    # spawn: the GUI and the write queue run threads, fork would copy
+    # them half-way
+    with ProcessPoolExecutor(workers, mp_context=get_context('spawn')) as pool:
+        firsts, lasts = zip(*id_ranges(note_ids, blocks))
+        terms = merge_terms(list(pool.map(read_block, repeat(path), firsts, lasts)))
+        _, words, indices, counts, indptr = terms
+        index = term_index(indices, counts, indptr, len(words))
+
+        row_products = index['row_products']
+        total = int(row_products[-1]) if len(row_products) else 0
+        batch_products = max(1, min(BATCH_PRODUCTS, total // blocks))
+        firsts, lasts = zip(*row_blocks(row_products, batch_products))
+        memory, layout = share({name: index[name] for name in SHARED_ARRAYS})
+        try:
+            edges = list(pool.map(
+                score_block, repeat(memory.name), repeat(layout),
+                firsts, lasts, repeat(top_k), repeat(min_score)
+            ))
+        finally:
+            memory.close()
+            memory.unlink()
+    return terms, index, edges
@@ -0,0 +1,14 @@
+"""Statements with more host parameters than SQLite allows.
+
+Every module that builds an IN (...) list from ids or words takes its
+chunks from here, so they agree on the limit.
+"""
+# SQLite limits number of host parameters in one statement.
+MAX_SQL_PARAMS = 900
+
+
+def chunked(items, size=MAX_SQL_PARAMS):
+    "Lists of at most size items, in order."
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
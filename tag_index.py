@@ -0,0 +1,327 @@
+"""In-memory index from tag to notes.
+
+A tag used by many notes has a bitmap, a Python int with bit note_id
+set for each of its notes, so AND/OR/NOT of tags are single integer
+operations and facet counts are bit_count() calls. A bitmap is as wide
+as the largest note id, so rare tags, most of them in a real notebook,
+keep a set of note ids instead and become bitmaps only in a query.
+The index is loaded from note_tag on first use and then kept in sync
+by ManageDb write methods after their transaction commits.
+
+Triggers count every change of note and note_tag in tag_index_version,
+whoever makes it: this process, another one or the sqlite3 shell. The
+index remembers the count it reflects and is loaded again when the
+count has moved without it.
+
+Search bar syntax understood by parse_query():
+    #a #b       notes with both tags
+    #a|#b       notes with any of the tags
+    -#c         notes without the tag
+other words are full-text searched.
+"""
+import re
+import threading
+
+TAG_PREFIX = '#'
+NOT_PREFIX = '-'
+OR_SEPARATOR = '|'
+# Tags are separated by commas and spaces, search splits on spaces.
+TAG_SEPARATORS = re.compile(r'[,\s]+')
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS tag_index_version (
+        id INTEGER PRIMARY KEY CHECK (id = 0),
+        changes INTEGER NOT NULL
+        );''',
+    'INSERT OR IGNORE INTO tag_index_version(id, changes) VALUES(0, 0);',
+    *(
+        f'''CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_counted
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE tag_index_version SET changes = changes + 1;
+            END;'''
+        for table, events in (
+            # Edits of title and text do not matter here
+            ('note', ('INSERT', 'DELETE')),
+            ('note_tag', ('INSERT', 'UPDATE', 'DELETE')),
+        )
+        for event in events
+    ),
+]
+# A tag gets a bitmap when it has a note in at least one of this many
+# ids, rarer tags keep a set: an id in a set takes about as much
+# memory as 256 bits.
+DENSE_EVERY = 256
+# Positions of set bits of every byte value.
+BYTE_BITS = [
+    tuple(bit for bit in range(8) if byte >> bit & 1) for byte in range(256)
+]
+
+
+def bitmap_from_ids(note_ids) -> int:
+    "Bitmap with bits of given ids set, built in one pass."
+    note_ids = list(note_ids)
+    if not note_ids:
+        return 0
+    data = bytearray(max(note_ids) // 8 + 1)
+    for note_id in note_ids:
+        data[note_id >> 3] |= 1 << (note_id & 7)
+    return int.from_bytes(data, 'little')
+
+
+def bitmap_ids(bitmap) -> list:
+    "Ids of set bits in ascending order."
+    data = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+    ids = []
+    for offset, byte in enumerate(data):
+        if byte:
+            base = offset * 8
+            ids.extend(base + bit for bit in BYTE_BITS[byte])
+    return ids
+
+
+def read_version(cursor) -> int:
+    "Count of changes of notes and their tags, see SCHEMA."
+    row = cursor.execute(
+        'SELECT changes FROM tag_index_version WHERE id = 0;'
+    ).fetchone()
+    return row[0] if row else 0
+
+
+def normalize_tags(tags) -> list:
+    """Tags as they are stored: the editor's string or a list split on
+    commas and spaces, without empty strings and repeats, in order.
+    """
+    if isinstance(tags, str):
+        tags = [tags]
+    return list(dict.fromkeys(
+        tag for value in tags for tag in TAG_SEPARATORS.split(value) if tag
+    ))
+
+
+def parse_query(query) -> tuple:
+    "Split search query into (text, all_tags, any_tags, none_tags)."
+    words, all_tags, any_tags, none_tags = [], [], [], []
+    for token in query.split():
+        if token.startswith(NOT_PREFIX + TAG_PREFIX) and len(token) > 2:
+            none_tags.append(token[len(NOT_PREFIX):])
+        elif token.startswith(TAG_PREFIX) and OR_SEPARATOR in token:
+            any_tags.extend(tag for tag in token.split(OR_SEPARATOR) if tag)
+        elif token.startswith(TAG_PREFIX) and len(token) > 1:
+            all_tags.append(token)
+        else:
+            words.append(token)
+    return ' '.join(words), all_tags, any_tags, none_tags
+
+
+def is_dense(count, width) -> bool:
+    "Whether count notes among width ids are kept as a bitmap."
+    return count * DENSE_EVERY >= width
+
+
+def count_in(data, note_ids) -> int:
+    "Number of note_ids set in data, bytes of a bitmap."
+    size = len(data)
+    return sum(
+        data[note_id >> 3] >> (note_id & 7) & 1
+        for note_id in note_ids if note_id >> 3 < size
+    )
+
+
+class TagIndex:
+    """Tag name -> bitmap or set of note ids (see DENSE_EVERY), plus
+    tags of every note.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # None until loaded
+        self.postings = None
+        self.note_tags = {}
+        self.all_notes = 0
+        # read_version() the index reflects
+        self.version = None
+
+    def is_loaded(self) -> bool:
+        return self.postings is not None
+
+    def load(self, cursor):
+        "Read the whole index from db, unless it is up to date."
+        with self.lock:
+            self.refresh(cursor)
+
+    def refresh(self, cursor):
+        """Load the index, again if the database has changed without
+        it, with the lock held.
+        """
+        # Read first: a commit in between makes it older than the
+        # index, which is then loaded once more, never the reverse
+        version = read_version(cursor)
+        if self.postings is not None and self.version == version:
+            return
+        note_ids = [row[0] for row in cursor.execute('SELECT id FROM note;')]
+        ids_by_tag = {}
+        note_tags = {note_id: set() for note_id in note_ids}
+        cursor.execute(
+            '''SELECT nt.note_id, t.name FROM note_tag nt
+                JOIN tag t ON t.id = nt.tag_id;'''
+        )
+        for note_id, name in cursor:
+            ids_by_tag.setdefault(name, []).append(note_id)
+            note_tags.setdefault(note_id, set()).add(name)
+        self.all_notes = bitmap_from_ids(note_ids)
+        self.note_tags = note_tags
+        width = self.all_notes.bit_length()
+        self.postings = {
+            name: bitmap_from_ids(ids) if is_dense(len(ids), width)
+            else set(ids)
+            for name, ids in ids_by_tag.items()
+        }
+        self.version = version
+
+    def invalidate(self):
+        "Forget the index, it is loaded again on next use."
+        with self.lock:
+            self.clear()
+
+    def clear(self):
+        "invalidate() with the lock held."
+        self.postings = None
+        self.note_tags = {}
+        self.all_notes = 0
+        self.version = None
+
+    @staticmethod
+    def read_note_tags(cursor, note_id) -> list:
+        "Tags of a note as stored in db."
+        cursor.execute(
+            '''SELECT t.name FROM note_tag nt
+                JOIN tag t ON t.id = nt.tag_id
+                WHERE nt.note_id = ?;''',
+            (note_id,)
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+    def apply(self, updates, version_before, version_after):
+        """Apply (note_id, tags) of a committed transaction, tags None
+        for a deleted note. The transaction moved the database from
+        version_before to version_after; if the index is older than
+        version_before it has missed other changes and is dropped.
+        """
+        with self.lock:
+            if self.postings is None:
+                return
+            if self.version != version_before:
+                self.clear()
+                return
+            for note_id, tags in updates:
+                if tags is None:
+                    self.remove_note(note_id)
+                else:
+                    self.set_note(note_id, tags)
+            self.version = version_after
+
+    def set_note(self, note_id, tags):
+        "Replace tags of a new or changed note, with the lock held."
+        self.all_notes |= 1 << note_id
+        new_tags = {tag for tag in tags if tag}
+        old_tags = self.note_tags.get(note_id, set())
+        for tag in old_tags - new_tags:
+            self.discard(tag, note_id)
+        for tag in new_tags - old_tags:
+            self.add(tag, note_id)
+        self.note_tags[note_id] = new_tags
+
+    def remove_note(self, note_id):
+        "Drop a deleted note, with the lock held."
+        self.set_note(note_id, ())
+        self.note_tags.pop(note_id, None)
+        self.all_notes &= ~(1 << note_id)
+
+    def add(self, tag, note_id):
+        "Add a note to a tag, its set becomes a bitmap once dense."
+        posting = self.postings.get(tag)
+        if isinstance(posting, int):
+            self.postings[tag] = posting | 1 << note_id
+            return
+        posting = posting or set()
+        posting.add(note_id)
+        if is_dense(len(posting), self.all_notes.bit_length()):
+            posting = bitmap_from_ids(posting)
+        self.postings[tag] = posting
+
+    def discard(self, tag, note_id):
+        """Remove a note from postings of a tag, a bitmap becomes a set
+        at half the density it was made at, so it does not flip back
+        and forth.
+        """
+        posting = self.postings[tag]
+        if isinstance(posting, int):
+            posting &= ~(1 << note_id)
+            width = self.all_notes.bit_length()
+            if not is_dense(2 * posting.bit_count(), width):
+                posting = set(bitmap_ids(posting))
+        else:
+            posting.discard(note_id)
+        if posting:
+            self.postings[tag] = posting
+        else:
+            del self.postings[tag]
+
+    def bitmap(self, tag) -> int:
+        "Bitmap of notes of a tag, with the lock held."
+        posting = self.postings.get(tag, 0)
+        if isinstance(posting, int):
+            return posting
+        return bitmap_from_ids(posting)
+
+    def select(self, cursor, all_tags=(), any_tags=(), none_tags=()) -> int:
+        """Bitmap of notes having all of all_tags, at least one of
+        any_tags and none of none_tags. Empty lists do not restrict.
+
+        The index is brought up to date under the same lock, so an
+        invalidate() from another thread cannot come in between.
+        """
+        with self.lock:
+            self.refresh(cursor)
+            return self.select_loaded(all_tags, any_tags, none_tags)
+
+    def select_loaded(self, all_tags, any_tags, none_tags) -> int:
+        "select() with the lock held and the index loaded."
+        result = self.all_notes
+        for tag in all_tags:
+            result &= self.bitmap(tag)
+        if any_tags:
+            union = 0
+            for tag in any_tags:
+                union |= self.bitmap(tag)
+            result &= union
+        for tag in none_tags:
+            result &= ~self.bitmap(tag)
+        return result
+
+    def facets(self, cursor, all_tags=(), any_tags=(), none_tags=()) -> dict:
+        """Number of notes with every tag among the notes select()
+        returns, most used first.
+        """
+        with self.lock:
+            self.refresh(cursor)
+            if all_tags or any_tags or none_tags:
+                bitmap = self.select_loaded(all_tags, any_tags, none_tags)
+                data = bitmap.to_bytes(
+                    (bitmap.bit_length() + 7) // 8, 'little'
+                )
+                counts = {
+                    tag: (posting & bitmap).bit_count()
+                    if isinstance(posting, int) else count_in(data, posting)
+                    for tag, posting in self.postings.items()
+                }
+            else:
+                # Every note is selected
+                counts = {
+                    tag: posting.bit_count()
+                    if isinstance(posting, int) else len(posting)
+                    for tag, posting in self.postings.items()
+                }
+        return dict(sorted(
+            ((tag, count) for tag, count in counts.items() if count),
+            key=lambda item: (-item[1], item[0])
+        ))
@@ -0,0 +1,96 @@
+"""MainWindow keeps database work off the GUI thread and ignores
+results of a notebook it has switched away from.
+"""
+import os
+import threading
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import pytest
+from PyQt6 import QtWidgets
+
+from models import ManageDb
+from topaz import MainWindow
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+def notebook(path, title):
+    db = ManageDb(path)
+    db.create_tables()
+    db.insert_data_in_tables(title, 'text', ['#test'])
+    db.close()
+
+
+def wait(app, condition, timeout=5):
+    "Process events until condition() is true or timeout seconds pass."
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.001)
+
+
+def test_switch_during_load_drops_old_page(app, tmp_path):
+    notebook(tmp_path / 'first.db', 'first')
+    notebook(tmp_path / 'second.db', 'second')
+    window = MainWindow(ManageDb(tmp_path / 'first.db'))
+    started = []
+    start = window.notes_model.start
+    window.notes_model.start = lambda page: (started.append(page), start(page))
+
+    # The first notebook's page is still queued when the switch happens
+    window.switch_notebook(str(tmp_path / 'second.db'))
+    wait(app, lambda: window.interactive_time is not None)
+
+    titles = [note[0] for page in started for note in page.values()]
+    assert titles == ['second']
+    window.close()
+
+
+def test_save_queries_db_off_the_gui_thread(app, tmp_path):
+    notebook(tmp_path / 'notes.db', 'first')
+    db = ManageDb(tmp_path / 'notes.db')
+    window = MainWindow(db)
+    wait(app, lambda: window.interactive_time is not None)
+    gui_calls = []
+    for name in ('find_duplicates', 'get_notes_by_ids'):
+        method = getattr(db, name)
+
+        def on_gui_thread(*args, method=method, name=name, **kwargs):
+            if threading.current_thread() is threading.main_thread():
+                gui_calls.append(name)
+            return method(*args, **kwargs)
+        setattr(db, name, on_gui_thread)
+
+    window.create_note()
+    window.title.setText('second')
+    window.text.setPlainText('a note saved right away')
+    window.click_accept_and_save_button()
+    wait(app, lambda: window.notes_model.rowCount() == 2)
+
+    assert window.notes_model.rowCount() == 2
+    assert gui_calls == []
+    window.close()
+
+
+def test_save_of_a_duplicate_waits_for_second_click(app, tmp_path):
+    notebook(tmp_path / 'notes.db', 'first')
+    window = MainWindow(ManageDb(tmp_path / 'notes.db'))
+    wait(app, lambda: window.interactive_time is not None)
+
+    window.create_note()
+    window.title.setText('first')
+    window.text.setPlainText('text')
+    window.click_accept_and_save_button()
+    wait(app, lambda: window.duplicate_checked is not None)
+    assert window.stack.currentWidget() is window.create_window
+    assert not window.duplicate_label.isHidden()
+
+    window.click_accept_and_save_button()
+    wait(app, lambda: window.notes_model.rowCount() == 2)
+    assert window.notes_model.rowCount() == 2
+    window.close()
@@ -0,0 +1,95 @@
+"""ManageDb storage: full-text index and connections."""
+import sqlite3
+import threading
+
+import pytest
+
+from models import IDLE_CONNECTIONS, ManageDb
+
+BODY = 'compressible body of a long note ' * 400
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = ManageDb(tmp_path / 'notes.db')
+    db.create_tables()
+    yield db
+    db.close()
+
+
+def check_fts(db):
+    with db.connect_to_db() as conn:
+        # Compares the index with what note_fts_source gives
+        conn.execute(
+            "INSERT INTO note_fts(note_fts, rank) VALUES('integrity-check', 1);"
+        )
+
+
+def test_fts_follows_edits_without_a_copy(db):
+    first = db.insert_data_in_tables('first', BODY, ['#long'])
+    second = db.insert_data_in_tables('second', 'short text', ['#short'])
+    db.update_data(first, 'renamed', 'other words now', ['#edited'])
+    db.delete_note(second)
+    check_fts(db)
+
+    assert db.search_notes('renamed') == [first]
+    assert db.search_notes('compressible') == []
+    assert db.find_notes('#edited') == [first]
+    with db.connect_to_db() as conn:
+        tables = {row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE name LIKE 'note_fts%';"
+        )}
+    assert 'note_fts_content' not in tables
+
+
+def test_stats_count_compressed_bodies(db):
+    db.insert_data_in_tables('long', BODY, [])
+    stats = db.stats()
+    assert stats['compressed_bodies'] == 1
+    assert stats['body_bytes'] == len(BODY)
+    assert stats['stored_body_bytes'] < len(BODY) // 10
+
+
+def run_in_threads(db, count, together=False):
+    """Read the db from count threads one after another, or all holding
+    a connection at once with together=True. Return their connections.
+    """
+    barrier = threading.Barrier(count) if together else None
+    used = []
+
+    def read():
+        conn = db.connect_to_db()
+        conn.execute('SELECT COUNT(*) FROM note;').fetchone()
+        used.append(conn)
+        if barrier:
+            barrier.wait()
+
+    threads = [threading.Thread(target=read) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+        if not together:
+            thread.join()
+    for thread in threads:
+        thread.join()
+    return used
+
+
+def test_threads_reuse_connections(db):
+    main = db.connect_to_db()
+    used = run_in_threads(db, 20)
+    assert len(set(used)) == 1
+    assert set(db.connections) == {main, used[0]}
+    assert db.idle == used[:1]
+
+
+def test_connections_of_ended_threads_are_closed(db):
+    main = db.connect_to_db()
+    used = run_in_threads(db, IDLE_CONNECTIONS + 4, together=True)
+    assert len(set(used)) == IDLE_CONNECTIONS + 4
+    assert set(db.connections) == {main, *db.idle}
+    assert len(db.idle) == IDLE_CONNECTIONS
+    closed = [conn for conn in used if conn not in db.idle]
+    assert len(closed) == 4
+    for conn in closed:
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1;')
@@ -0,0 +1,83 @@
+"""Create, update and delete touch only the affected tile of the grid.
+
+NotesModel signals are counted per operation: a full rebuild would
+show up as modelReset, a changed tile as one dataChanged.
+"""
+import os
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+import pytest
+from PyQt6 import QtWidgets
+
+from models import ManageDb
+from topaz import NotesModel
+
+NOTES = 5
+SIGNALS = ('modelReset', 'rowsInserted', 'rowsRemoved', 'dataChanged')
+
+
+@pytest.fixture(scope='module')
+def app():
+    return QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = ManageDb(tmp_path / 'notes.db')
+    db.create_tables()
+    for i in range(NOTES):
+        db.insert_data_in_tables(f'note {i}', f'text {i}', ['#test'])
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def model(app, db):
+    model = NotesModel(db)
+    model.start(db.get_notes_page())
+    return model
+
+
+@pytest.fixture
+def counts(model):
+    "Number of every signal emitted from now on."
+    counts = dict.fromkeys(SIGNALS, 0)
+    for name in SIGNALS:
+        getattr(model, name).connect(
+            lambda *args, name=name: counts.__setitem__(name, counts[name] + 1)
+        )
+    return counts
+
+
+def test_create_inserts_one_row(db, model, counts):
+    note_id = db.insert_data_in_tables('new', 'text', ['#new'])
+    model.add_note(note_id, 'new', 'text', ['#new'], '2030-01-01 00:00:00')
+
+    assert counts == {
+        'modelReset': 0, 'rowsInserted': 1, 'rowsRemoved': 0, 'dataChanged': 0
+    }
+    assert model.rowCount() == NOTES + 1
+    assert model.rows[-1] == note_id
+
+
+def test_update_changes_one_tile(db, model, counts):
+    note_id = model.rows[2]
+    model.update_note(note_id, 'changed', 'text', ['#test'], '2030-01-01')
+
+    assert counts == {
+        'modelReset': 0, 'rowsInserted': 0, 'rowsRemoved': 0, 'dataChanged': 1
+    }
+    assert model.data(model.index(2)) == 'changed'
+
+
+def test_delete_removes_one_row(db, model, counts):
+    note_id = model.rows[1]
+    following = list(model.rows[2:])
+    model.remove_note(note_id)
+
+    assert counts == {
+        'modelReset': 0, 'rowsInserted': 0, 'rowsRemoved': 1, 'dataChanged': 0
+    }
+    assert list(model.rows[1:]) == following
+    assert model.row_of(following[0]) == 1
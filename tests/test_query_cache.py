@@ -0,0 +1,36 @@
+"""Query cache keeps no failed results and no results of old data."""
+import sqlite3
+
+import pytest
+
+from models import ManageDb
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = ManageDb(tmp_path / 'notes.db')
+    db.create_tables()
+    db.insert_data_in_tables('python', 'text', ['#python'])
+    yield db
+    db.close()
+
+
+def test_error_result_is_not_cached(db, monkeypatch):
+    select = db.tag_index.select
+
+    def locked(*args):
+        raise sqlite3.OperationalError('database is locked')
+
+    monkeypatch.setattr(db.tag_index, 'select', locked)
+    assert db.filter_by_tags(['#python']) == []
+    monkeypatch.setattr(db.tag_index, 'select', select)
+    assert len(db.filter_by_tags(['#python'])) == 1
+
+
+def test_rebuild_clears_cache(db):
+    # Same connection, data_version does not see this commit
+    with db.connect_to_db() as conn:
+        conn.execute('DELETE FROM term;')
+    assert db.search_notes('pyhton', fuzzy=True) == []
+    db.rebuild_similarity_graph()
+    assert len(db.search_notes('pyhton', fuzzy=True)) == 1
@@ -0,0 +1,134 @@
+"""Tag index: sets for rare tags and bitmaps for common ones, changes
+of other processes and concurrent invalidation.
+"""
+import subprocess
+import sys
+import threading
+
+import pytest
+
+import tag_index
+from models import ManageDb
+from query_cache import QUERY_CACHE_BYTES
+from tag_index import TagIndex, bitmap_ids
+
+NOTES = 40
+# How long invalidate() gets to finish before select() goes on.
+INVALIDATE_WAIT_S = 0.1
+OTHER_PROCESS = """
+import sqlite3, sys
+path, note_id, tag = sys.argv[1:]
+with sqlite3.connect(path) as conn:
+    conn.execute("INSERT INTO note(id, title, text) VALUES(?, 'other', '');",
+                 (note_id,))
+    conn.execute('INSERT OR IGNORE INTO tag(name) VALUES(?);', (tag,))
+    conn.execute(
+        "INSERT INTO note_tag(note_id, tag_id)"
+        " SELECT ?, id FROM tag WHERE name = ?;", (note_id, tag))
+"""
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    # Bitmap from one note in 4 ids, with 40 notes both kinds exist
+    monkeypatch.setattr(tag_index, 'DENSE_EVERY', 4)
+    db = ManageDb(tmp_path / 'notes.db')
+    db.create_tables()
+    for i in range(1, NOTES + 1):
+        tags = ['#even'] if i % 2 == 0 else []
+        if i == 7:
+            tags.append('#rare')
+        db.insert_data_in_tables(f'note {i}', 'text', tags)
+    yield db
+    db.close()
+
+
+def loaded(db) -> TagIndex:
+    index = TagIndex()
+    with db.connect_to_db() as conn:
+        index.load(conn.cursor())
+    return index
+
+
+def test_dense_and_sparse_postings(db):
+    index = loaded(db)
+    assert isinstance(index.postings['#even'], int)
+    assert index.postings['#rare'] == {7}
+
+    with db.connect_to_db() as conn:
+        cursor = conn.cursor()
+        assert bitmap_ids(index.select(cursor, ['#rare'])) == [7]
+        either = index.select(cursor, any_tags=['#rare', '#even'])
+        assert bitmap_ids(either) == [2, 4, 6, 7, *range(8, NOTES + 1, 2)]
+        only_even = index.select(cursor, ['#even'], none_tags=['#rare'])
+        assert bitmap_ids(only_even) == list(range(2, NOTES + 1, 2))
+        assert index.facets(cursor) == {'#even': NOTES // 2, '#rare': 1}
+        assert index.facets(cursor, none_tags=['#even']) == {'#rare': 1}
+        assert index.facets(cursor, ['#rare']) == {'#rare': 1}
+
+
+def test_postings_change_kind_with_updates(db):
+    index = loaded(db)
+    with index.lock:
+        for note_id in range(1, 21):
+            index.set_note(note_id, ['#rare'])
+    assert isinstance(index.postings['#rare'], int)
+    assert index.select_loaded(['#rare'], (), ()) == (1 << 21) - 2
+
+    with index.lock:
+        for note_id in range(1, 20):
+            index.set_note(note_id, [])
+    assert index.postings['#rare'] == {20}
+    assert index.select_loaded(['#rare'], (), ()) == 1 << 20
+
+    with index.lock:
+        index.remove_note(20)
+    assert '#rare' not in index.postings
+
+
+def insert_in_other_process(path, note_id, tag):
+    "Tag a new note from another process with plain sqlite3."
+    subprocess.run(
+        [sys.executable, '-c', OTHER_PROCESS, str(path), str(note_id), tag],
+        check=True
+    )
+
+
+@pytest.mark.parametrize('cache_bytes', [0, QUERY_CACHE_BYTES])
+def test_index_sees_other_process_commits(tmp_path, cache_bytes):
+    db = ManageDb(tmp_path / 'notes.db', query_cache_bytes=cache_bytes)
+    db.create_tables()
+    first = db.insert_data_in_tables('first', 'text', ['#shared'])
+    assert db.filter_by_tags(['#shared']) == [first]
+
+    # Commits of both processes between two reads of the index
+    insert_in_other_process(tmp_path / 'notes.db', 100, '#shared')
+    second = db.insert_data_in_tables('second', 'text', ['#shared'])
+    assert db.filter_by_tags(['#shared']) == sorted([first, second, 100])
+    assert db.tag_facets() == {'#shared': 3}
+
+    insert_in_other_process(tmp_path / 'notes.db', 200, '#other')
+    assert db.filter_by_tags(any_tags=['#other']) == [200]
+    db.close()
+
+
+def test_invalidate_during_select(db, monkeypatch):
+    db.query_cache.max_bytes = 0
+    index = db.tag_index
+    select_loaded = index.select_loaded
+    invalidators = []
+
+    def select_with_invalidate(*args):
+        # invalidate() from another thread while select() computes
+        thread = threading.Thread(target=index.invalidate)
+        thread.start()
+        thread.join(INVALIDATE_WAIT_S)
+        invalidators.append(thread)
+        return select_loaded(*args)
+
+    monkeypatch.setattr(index, 'select_loaded', select_with_invalidate)
+    assert db.filter_by_tags(['#even']) == list(range(2, NOTES + 1, 2))
+    assert db.tag_facets(['#even']) == {'#even': NOTES // 2}
+    for thread in invalidators:
+        thread.join()
+    assert not index.is_loaded()
@@ -0,0 +1,54 @@
+"""Writer thread of WriteQueue survives failing writes and callbacks."""
+import pytest
+
+from models import INSERT, ManageDb
+from write_queue import WriteQueue
+
+FLUSH_TIMEOUT_S = 5
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = ManageDb(tmp_path / 'notes.db')
+    db.create_tables()
+    yield db
+    db.close()
+
+
+def test_writer_goes_on_after_a_write_raises(db):
+    done, failed = [], []
+    queue = WriteQueue(
+        db, lambda write, note_id: done.append(write[1]),
+        lambda write, message: failed.append(write[1]), batch_delay=0
+    )
+    # Not sqlite3.Error: the body is not a string
+    queue.put('broken', (INSERT, 'broken', 42, []))
+    queue.insert('kept', 'text', [])
+    assert queue.flush(FLUSH_TIMEOUT_S)
+    queue.insert('later', 'text', [])
+    assert queue.flush(FLUSH_TIMEOUT_S)
+    assert queue.thread.is_alive()
+    queue.close()
+
+    assert failed == ['broken']
+    assert done == ['kept', 'later']
+    assert sorted(db.find_notes('text')) == [1, 2]
+
+
+def test_writer_goes_on_after_a_callback_raises(db):
+    done = []
+
+    def on_done(write, note_id):
+        if write[1] == 'first':
+            raise RuntimeError('callback failed')
+        done.append(write[1])
+
+    queue = WriteQueue(db, on_done, batch_delay=0)
+    queue.insert('first', 'text', [])
+    assert queue.flush(FLUSH_TIMEOUT_S)
+    queue.insert('second', 'text', [])
+    assert queue.flush(FLUSH_TIMEOUT_S)
+    assert queue.thread.is_alive()
+    queue.close()
+
+    assert done == ['second']
@@ -1,56 +1,446 @@
 import sys
+import time
+from array import array
 from datetime import datetime
 from pathlib import Path
-from re import split as rsplit
 
 from PyQt6 import QtGui
 from PyQt6 import QtCore
 from PyQt6 import QtWidgets
 
-from models import ManageDb
+import instrumentation
+from instrumentation import timed
+from models import INSERT, PAGE_SIZE, UPDATE, make_preview
+from note_store import NoteStore
+from notebooks import Notebooks, load_list, save_list
+from tag_index import normalize_tags
+from write_queue import WriteQueue
 
 
 NOTES_JSON_FILE = 'notes.json'
 HEIGHT_OF_WINDOW = 600
 WIDTH_OF_WINDOW = 400
+# Search starts when user stops typing for this long.
+SEARCH_DEBOUNCE_MS = 250
+# Editor looks for near-identical notes when user stops typing for
+# this long.
+DUPLICATE_DEBOUNCE_MS = 500
 
 
-class NoteButton(QtWidgets.QPushButton):
-    request_delete = QtCore.pyqtSignal(int, str)
+NOTE_ID_ROLE = QtCore.Qt.ItemDataRole.UserRole + 1
+NOTE_PREVIEW_ROLE = QtCore.Qt.ItemDataRole.UserRole + 2
+NOTE_TAGS_ROLE = QtCore.Qt.ItemDataRole.UserRole + 3
+NOTE_CREATED_AT_ROLE = QtCore.Qt.ItemDataRole.UserRole + 4
 
-    def __init__(self, note_id, title, preview_text, tags, created_at, parent=None):
+TILE_SIZE = 100
+TILE_MARGIN = 12
+
+
+class NotesModel(QtCore.QAbstractListModel):
+    """List model over notes shown in the grid.
+
+    Notes are pulled from db page by page when the view scrolls
+    to the end (canFetchMore/fetchMore), so the first screen costs
+    the same for any number of notes. Search results are paged the
+    same way: only ids are known upfront, data is fetched for
+    the next page of them.
+    """
+    def __init__(self, db, parent=None):
         super().__init__(parent)
+        self.db = db
+        # Loaded notes, from pages and from search results; bodies
+        # are not kept
+        self.notes = NoteStore()
+        # Ids of loaded pages in (created_at, id) order
+        self.loaded_ids = array('q')
+        self.page_cursor = None
+        # Nothing is fetched before start() or reload()
+        self.has_more_pages = False
+        # Search result ids or None, and how many of them are in rows
+        self.filter_ids = None
+        self.filter_pos = 0
+        # Ids shown by the view and their rows, built on demand
+        self.rows = array('q')
+        self.row_index = None
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+    def data(self, index, role=QtCore.Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        note_id = self.rows[index.row()]
+        if role == QtCore.Qt.ItemDataRole.DisplayRole:
+            return self.notes.title(note_id)
+        if role == NOTE_ID_ROLE:
+            return note_id
+        if role == NOTE_PREVIEW_ROLE:
+            return self.notes.preview(note_id)
+        if role == NOTE_TAGS_ROLE:
+            return self.notes.note_tags(note_id)
+        if role == NOTE_CREATED_AT_ROLE:
+            return self.notes.date(note_id)
+        return None
+
+    def row_of(self, note_id):
+        "Row of the note in the view or None."
+        if self.row_index is None:
+            self.row_index = {
+                row_id: row for row, row_id in enumerate(self.rows)
+            }
+        return self.row_index.get(note_id)
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return False
+        if self.filter_ids is None:
+            return self.has_more_pages
+        return self.filter_pos < len(self.filter_ids)
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return
+        if self.filter_ids is None:
+            new_ids = self.fetch_page()
+        else:
+            new_ids = self.fetch_filtered()
+        if not new_ids:
+            return
+        first = len(self.rows)
+        self.beginInsertRows(
+            QtCore.QModelIndex(), first, first + len(new_ids) - 1
+        )
+        self.rows.extend(new_ids)
+        if self.row_index is not None:
+            self.row_index.update(
+                (note_id, first + i) for i, note_id in enumerate(new_ids)
+            )
+        self.endInsertRows()
+
+    @timed
+    def fetch_page(self) -> list:
+        "Load next page of all notes, return its ids."
+        return self.add_page(
+            self.db.get_notes_page(self.page_cursor, PAGE_SIZE)
+        )
+
+    def add_page(self, page) -> list:
+        "Keep page following the loaded ones, return its ids."
+        self.has_more_pages = len(page) == PAGE_SIZE
+        if not page:
+            return []
+        last_id = next(reversed(page))
+        self.page_cursor = (page[last_id][3], last_id)
+        self.notes.update(page)
+        self.loaded_ids.extend(page)
+        return list(page)
+
+    @timed
+    def fetch_filtered(self) -> list:
+        "Load data for next page of search results, return their ids."
+        next_ids = self.filter_ids[self.filter_pos:self.filter_pos + PAGE_SIZE]
+        self.filter_pos += len(next_ids)
+        missing = [note_id for note_id in next_ids if note_id not in self.notes]
+        if missing:
+            self.notes.update(self.db.get_notes_by_ids(missing))
+        # Note could be deleted after the search
+        return [note_id for note_id in next_ids if note_id in self.notes]
+
+    @timed
+    def start(self, first_page):
+        "Show all notes, starting from first page read by LoadTask."
+        self.beginResetModel()
+        self.notes.clear()
+        self.loaded_ids = array('q')
+        self.page_cursor = None
+        self.add_page(first_page)
+        self.filter_ids = None
+        self.filter_pos = 0
+        self.rows = array('q', self.loaded_ids)
+        self.row_index = None
+        self.endResetModel()
+
+    @timed
+    def reload(self):
+        "Drop loaded notes and start paging from the first note."
+        self.beginResetModel()
+        self.notes.clear()
+        self.loaded_ids = array('q')
+        self.page_cursor = None
+        self.has_more_pages = True
+        self.rows = array('q')
+        self.row_index = None
+        self.endResetModel()
+        self.set_filter(self.filter_ids)
+
+    @timed
+    def set_filter(self, note_ids=None):
+        """Show only notes with given ids in given order.
+        None shows all notes.
+        """
+        self.beginResetModel()
+        self.filter_ids = note_ids
+        self.filter_pos = 0
+        self.rows = array('q', self.loaded_ids if note_ids is None else ())
+        self.row_index = None
+        self.endResetModel()
+        if not self.rows:
+            self.fetchMore()
+
+    def add_note(self, note_id, title, preview, tags, created_at):
+        """Append just created note, the newest one, after loaded notes.
+
+        While pages are left to load it is not added: paging
+        reaches it at the end anyway.
+        """
+        if self.has_more_pages:
+            return
+        self.notes.add(note_id, title, preview, tags, created_at)
+        self.loaded_ids.append(note_id)
+        self.page_cursor = (created_at, note_id)
+        if self.filter_ids is None:
+            row = len(self.rows)
+            self.beginInsertRows(QtCore.QModelIndex(), row, row)
+            self.rows.append(note_id)
+            if self.row_index is not None:
+                self.row_index[note_id] = row
+            self.endInsertRows()
+
+    def update_note(self, note_id, title, preview, tags, created_at):
+        "Change data of a single note and repaint only its tile."
+        if note_id not in self.notes:
+            return
+        self.notes.add(note_id, title, preview, tags, created_at)
+        row = self.row_of(note_id)
+        if row is not None:
+            index = self.index(row)
+            self.dataChanged.emit(index, index)
+
+    def remove_note(self, note_id):
+        "Remove note from model, following tiles shift by one."
+        self.notes.remove(note_id)
+        if note_id in self.loaded_ids:
+            self.loaded_ids.remove(note_id)
+        row = self.row_of(note_id)
+        if row is not None:
+            self.beginRemoveRows(QtCore.QModelIndex(), row, row)
+            del self.rows[row]
+            # Following rows have shifted
+            self.row_index = None
+            self.endRemoveRows()
+
+
+class NoteDelegate(QtWidgets.QStyledItemDelegate):
+    "Paint note tile: title and a few lines of text."
+    def sizeHint(self, option, index):
+        return QtCore.QSize(TILE_SIZE, TILE_SIZE)
+
+    @timed
+    def paint(self, painter, option, index):
+        painter.save()
+        painter.setRenderHint(QtGui.QPainter.RenderHint.Antialiasing)
+
+        rect = QtCore.QRectF(option.rect).adjusted(1, 1, -1, -1)
+        is_hovered = option.state & QtWidgets.QStyle.StateFlag.State_MouseOver
+        pen = QtGui.QPen(QtGui.QColor('#4CAF50'), 2 if is_hovered else 1)
+        painter.setPen(pen)
+        painter.setBrush(QtGui.QColor('white'))
+        painter.drawRoundedRect(rect, 12, 12)
+
+        text_rect = rect.adjusted(8, 4, -8, -4).toRect()
+        metrics = option.fontMetrics
+        title = metrics.elidedText(
+            index.data() or '', QtCore.Qt.TextElideMode.ElideRight,
+            text_rect.width()
+        )
+        painter.setPen(option.palette.color(QtGui.QPalette.ColorRole.Text))
+        painter.drawText(
+            text_rect,
+            QtCore.Qt.AlignmentFlag.AlignLeft | QtCore.Qt.AlignmentFlag.AlignTop,
+            title
+        )
+
+        preview_rect = text_rect.adjusted(0, 2 * metrics.height(), 0, 0)
+        painter.drawText(
+            preview_rect,
+            QtCore.Qt.AlignmentFlag.AlignLeft
+            | QtCore.Qt.AlignmentFlag.AlignTop
+            | QtCore.Qt.TextFlag.TextWordWrap,
+            index.data(NOTE_PREVIEW_ROLE) or ''
+        )
+        painter.restore()
+
+
+class SearchSignals(QtCore.QObject):
+    "QRunnable is not a QObject, so signals of SearchTask live here."
+    finished = QtCore.pyqtSignal(int, list)
+
+
+class SearchTask(QtCore.QRunnable):
+    """Run find_notes() on a thread pool.
+
+    generation identifies the query. The task gives up, before start
+    or while SQLite is running, as soon as a newer query appears.
+    """
+    def __init__(self, db, query, generation, current_generation):
+        super().__init__()
+        self.db = db
+        self.query = query
+        self.generation = generation
+        self.current_generation = current_generation
+        self.signals = SearchSignals()
 
-        self.note_id = note_id
+    def is_stale(self):
+        return self.generation != self.current_generation()
+
+    @timed
+    def run(self):
+        if self.is_stale():
+            return
+        found_ids = self.db.find_notes(
+            self.query, is_cancelled=self.is_stale
+        )
+        if not self.is_stale():
+            self.signals.finished.emit(self.generation, found_ids)
+
+
+def find_duplicates(db, title, text, exclude_id=None) -> list:
+    "(note_id, title, score) of saved notes near-identical to the given."
+    found = db.find_duplicates(title, text, exclude_id)
+    notes = db.get_notes_by_ids([note_id for note_id, _ in found])
+    return [
+        (note_id, notes[note_id][0], score)
+        for note_id, score in found if note_id in notes
+    ]
+
+
+class DuplicateSignals(QtCore.QObject):
+    finished = QtCore.pyqtSignal(int, list)
+
+
+class DuplicateTask(QtCore.QRunnable):
+    "Run find_duplicates() for the editor on a thread pool."
+    def __init__(self, db, title, text, exclude_id, generation):
+        super().__init__()
+        self.db = db
         self.title = title
-        self.preview_text = preview_text
-        self.tags = tags
-        self.created_at = created_at
+        self.text = text
+        self.exclude_id = exclude_id
+        self.generation = generation
+        self.signals = DuplicateSignals()
 
-        self.setFixedWidth(100)
-        self.setFixedHeight(100)
-        self.setText(f"{title}\n\n{preview_text}")
+    @timed
+    def run(self):
+        self.signals.finished.emit(self.generation, find_duplicates(
+            self.db, self.title, self.text, self.exclude_id
+        ))
 
-        # Set name for using in style.qss
-        self.setObjectName('note_button')
 
-    def contextMenuEvent(self, event):
-        menu = QtWidgets.QMenu(self)
-        delete_action = menu.addAction("Delete")
-        action = menu.exec(event.globalPos())
+class LoadSignals(QtCore.QObject):
+    loaded = QtCore.pyqtSignal(int, dict)
 
-        if action == delete_action:
-            self.request_delete.emit(self.note_id, self.title)
 
+class LoadTask(QtCore.QRunnable):
+    """Open the notebook off the GUI thread: create or migrate the
+    schema and read the first page of notes.
 
-class MainWindow(QtWidgets.QMainWindow):
-    "Main window."
-    def __init__(self, db):
+    generation identifies the notebook opening, results of a notebook
+    switched away from are ignored.
+    """
+    def __init__(self, db, generation):
         super().__init__()
         self.db = db
+        self.generation = generation
+        self.signals = LoadSignals()
+
+    @timed
+    def run(self):
+        self.db.create_tables()
+        self.db.load_tag_ids()
+        self.signals.loaded.emit(
+            self.generation, self.db.get_notes_page(None, PAGE_SIZE)
+        )
+
+
+class WriteSignals(QtCore.QObject):
+    """Results of WriteQueue, emitted from the writer thread and
+    delivered on the GUI thread.
+    """
+    done = QtCore.pyqtSignal(tuple, object, object)
+    failed = QtCore.pyqtSignal(tuple, str)
 
+
+def report_saved(db, signals):
+    """on_done callback of WriteQueue. Runs on the writer thread and
+    reads an inserted note as stored, with its date and tags, so the
+    grid adds the tile without a query on the GUI thread.
+    """
+    def on_done(write, note_id):
+        note = None
+        if write[0] == INSERT and note_id is not None:
+            note = db.get_notes_by_ids([note_id]).get(note_id)
+        signals.done.emit(write, note_id, note)
+    return on_done
+
+
+class MainWindow(QtWidgets.QMainWindow):
+    """Main window.
+
+    It is shown empty, with notes and controls disabled, and filled
+    when LoadTask has opened the notebook. Seconds from started_at to
+    the first paint and to that moment are kept in first_paint_time
+    and interactive_time and recorded by instrumentation.
+
+    db is the open notebook, the switcher offers it and the rest
+    of notebooks.
+    """
+    def __init__(
+            self, db, search_debounce_ms=SEARCH_DEBOUNCE_MS, started_at=None,
+            notebooks=None
+    ):
+        super().__init__()
+        self.notebooks = Notebooks() if notebooks is None else notebooks
+        self.db = self.notebooks.add(db)
+        self.started_at = (
+            time.perf_counter() if started_at is None else started_at
+        )
+        self.first_paint_time = None
+        self.interactive_time = None
+
+        self.load_generation = 0
+        self.search_generation = 0
+        self.search_pool = QtCore.QThreadPool(self)
+        self.search_timer = QtCore.QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(search_debounce_ms)
+        self.search_timer.timeout.connect(self.start_search)
+
+        self.duplicate_generation = 0
+        self.duplicate_timer = QtCore.QTimer(self)
+        self.duplicate_timer.setSingleShot(True)
+        self.duplicate_timer.setInterval(DUPLICATE_DEBOUNCE_MS)
+        self.duplicate_timer.timeout.connect(self.start_duplicate_check)
+
+        # Graph screen is built when first opened
+        self.graph_page = None
+        self.layout_generation = 0
+        self.return_page = None
+
+        self.start_write_queue()
         self.initializeUI()
 
+    def start_write_queue(self):
+        "Notes of the open notebook are written on the writer thread."
+        self.write_signals = WriteSignals(self)
+        self.write_signals.done.connect(self.on_write_done)
+        self.write_signals.failed.connect(self.on_write_failed)
+        self.write_queue = WriteQueue(
+            self.db, report_saved(self.db, self.write_signals),
+            self.write_signals.failed.emit
+        )
+
     def initializeUI(self):
         self.setWindowTitle("Topaz")
         # self.setGeometry(300, 300, 400, 300)
@@ -64,8 +454,53 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.show_main_window()
 
+        if instrumentation.ENABLED:
+            # Latency report on demand
+            QtGui.QShortcut(
+                QtGui.QKeySequence('Ctrl+Shift+I'), self, instrumentation.dump
+            )
+
         self.show()
         self.center_window()
+        self.load_notebook()
+
+    def load_notebook(self):
+        "Open self.db with LoadTask."
+        self.load_generation += 1
+        # On the search pool, so closeEvent waits for it too
+        task = LoadTask(self.db, self.load_generation)
+        task.signals.loaded.connect(self.on_notes_loaded)
+        self.search_pool.start(task)
+
+    def startup_mark(self, name) -> float:
+        "Record and return seconds since started_at."
+        seconds = time.perf_counter() - self.started_at
+        instrumentation.record(name, seconds)
+        return seconds
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if self.first_paint_time is None:
+            self.first_paint_time = self.startup_mark('startup.first_paint')
+
+    @timed
+    def on_notes_loaded(self, generation, first_page):
+        "Fill the grid and enable the controls."
+        if generation != self.load_generation:
+            return
+        self.notes_model.start(first_page)
+        self.set_controls_enabled(True)
+        # Once the view has laid out the first tiles
+        QtCore.QTimer.singleShot(0, self.mark_interactive)
+
+    def set_controls_enabled(self, enabled):
+        self.notebook_box.setEnabled(enabled)
+        self.create_button.setEnabled(enabled)
+        self.graph_button.setEnabled(enabled)
+        self.search_bar.setEnabled(enabled)
+
+    def mark_interactive(self):
+        self.interactive_time = self.startup_mark('startup.interactive')
 
     def center_window(self):
         "Move the window to the center."
@@ -76,110 +511,204 @@ class MainWindow(QtWidgets.QMainWindow):
         frame.moveCenter(center_point)
         self.move(frame.topLeft())
 
+    @timed
     def show_main_window(self):
         "Display main window with all notes."
-        self.notes = self.load_notes_from_db()
-        self.note_widgets = {}
-
-        self.scroll_main_window = QtWidgets.QScrollArea()
-        self.window = QtWidgets.QWidget()
+        self.main_page = QtWidgets.QWidget()
 
         # Search bar
         self.search_bar = QtWidgets.QLineEdit()
         self.search_bar.setObjectName('search_bar') # NEED ADD STYLE IN style.qss
 
         self.main_box = QtWidgets.QVBoxLayout()
-        self.notes_grid = QtWidgets.QGridLayout()
 
         # Create button
         self.create_button = QtWidgets.QPushButton('Create note')
         self.create_button.setFixedWidth(200)
         self.create_button.setObjectName('create_button')
 
-        # Adding data into grid
-        self.cols = 2
-        self.fill_note_widgets()
-
-        self.main_box.addWidget(
-            self.create_button,
-            alignment=QtCore.Qt.AlignmentFlag.AlignCenter
+        self.graph_button = QtWidgets.QPushButton('Graph')
+        self.graph_button.setFixedWidth(100)
+        self.graph_button.setObjectName('graph_button')
+
+        # Notebook switcher, the last item adds a notebook
+        self.notebook_box = QtWidgets.QComboBox()
+        self.notebook_box.setObjectName('notebook_box')
+        self.fill_notebook_box()
+
+        # Notes grid. Only visible tiles are painted by delegate.
+        self.notes_model = NotesModel(self.db, self)
+        self.notes_view = QtWidgets.QListView()
+        self.notes_view.setObjectName('notes_view')
+        self.notes_view.setModel(self.notes_model)
+        self.notes_view.setItemDelegate(NoteDelegate(self.notes_view))
+        self.notes_view.setViewMode(QtWidgets.QListView.ViewMode.IconMode)
+        self.notes_view.setMovement(QtWidgets.QListView.Movement.Static)
+        self.notes_view.setResizeMode(QtWidgets.QListView.ResizeMode.Adjust)
+        self.notes_view.setUniformItemSizes(True)
+        self.notes_view.setLayoutMode(QtWidgets.QListView.LayoutMode.Batched)
+        self.notes_view.setSpacing(TILE_MARGIN)
+        self.notes_view.setMouseTracking(True)
+        self.notes_view.setContextMenuPolicy(
+            QtCore.Qt.ContextMenuPolicy.CustomContextMenu
         )
+        # Filled by on_notes_loaded(), the rest is fetched while scrolling
+        self.set_controls_enabled(False)
+
+        buttons = QtWidgets.QHBoxLayout()
+        buttons.addStretch()
+        buttons.addWidget(self.create_button)
+        buttons.addWidget(self.graph_button)
+        buttons.addStretch()
+        self.main_box.addLayout(buttons)
+        self.main_box.addWidget(self.notebook_box)
         self.main_box.addWidget(self.search_bar)
-        self.main_box.addLayout(self.notes_grid)
-        self.window.setLayout(self.main_box)
-        self.main_box.addStretch()
+        self.main_box.addWidget(self.notes_view)
+        self.main_page.setLayout(self.main_box)
 
         self.create_button.clicked.connect(self.create_note)
-        self.search_bar.textChanged.connect(self.update_display)
-
-        self.scroll_main_window.setWidgetResizable(True)
-        self.scroll_main_window.setWidget(self.window)
-
-        self.stack.addWidget(self.scroll_main_window)
-        self.stack.setCurrentWidget(self.scroll_main_window)
-
-    # def create_note_widget(self, note_id, title, text, tags, created_at):
-    #     box = QtWidgets.QWidget()
-    #     layout = QtWidgets.QVBoxLayout(box)
-
-    #     btn = NoteButton(note_id, title, text, tags, created_at)
-    #     btn.clicked.connect(self.show_single_note)
-    #     btn.request_delete.connect(self.confirm_delete_note)
-
-    #     # store data for search
-    #     box.setProperty("noteId", note_id)
-    #     box.setProperty("noteTitle", title)
-    #     box.setProperty("noteText", text)
-    #     box.setProperty("noteTags", tags)
-
-    #     layout.addWidget(btn)
-    #     return box
-    
-    # def load_all_notes(self):
-    #     for note_id, (title, text, tags, created_at) in self.notes.items():
-    #         widget = self.create_note_widget(note_id, title, text, tags, created_at)
-    #         self.note_widgets[note_id] = widget
-
-    #     self.rebuild_grid(list(self.note_widgets.values()))
-
-    def adding_data_into_widget(self, note_id: int, *note: tuple):
-        "Add data into VBox Layout. Then it'll add to a grid."
-        box = QtWidgets.QWidget()
-
-        notes_box = QtWidgets.QVBoxLayout(box)
-        note_id = note_id
-        title = note[0]
-        text = note[1]
-        tags = note[2]
-        created_at = note[3]
-        note_button = NoteButton(note_id, title, text, tags, created_at)
-
-        # Add data for sender. For editing.
-        note_button.note_id = note_id
-        note_button.title = title
-        note_button.text = text
-        note_button.tags = tags
-        note_button.created_at = created_at
-
-        # Set properties to widget. For searching.
-        box.setProperty("noteId", note_id)
-        box.setProperty("noteTitle", title)
-        box.setProperty("noteText", text)
-        box.setProperty("noteTags", tags)
-
-        note_button.clicked.connect(self.show_single_note)
-        note_button.request_delete.connect(self.confirm_delete_note)
-        notes_box.addWidget(note_button)
-        return box
-
-    def show_single_note(self):
+        self.graph_button.clicked.connect(self.show_graph)
+        self.notebook_box.activated.connect(self.on_notebook_chosen)
+        self.search_bar.textChanged.connect(self.search_timer.start)
+        self.notes_view.clicked.connect(self.show_single_note)
+        self.notes_view.customContextMenuRequested.connect(
+            self.show_note_menu
+        )
+
+        self.stack.addWidget(self.main_page)
+        self.stack.setCurrentWidget(self.main_page)
+
+    def fill_notebook_box(self):
+        "List notebooks, the open one selected."
+        self.notebook_box.clear()
+        for path in self.notebooks.paths:
+            self.notebook_box.addItem(Path(path).stem, path)
+            if path == self.db.db_name:
+                self.notebook_box.setCurrentIndex(self.notebook_box.count() - 1)
+        self.notebook_box.addItem('Open notebook...', None)
+
+    def on_notebook_chosen(self, index):
+        path = self.notebook_box.itemData(index)
+        if path is None:
+            path, _ = QtWidgets.QFileDialog.getSaveFileName(
+                self, 'Open or create notebook', '', 'Notebooks (*.db)',
+                options=QtWidgets.QFileDialog.Option.DontConfirmOverwrite
+            )
+        if path:
+            self.switch_notebook(path)
+        else:
+            # Back to the open notebook
+            self.fill_notebook_box()
+
+    @timed
+    def switch_notebook(self, path):
+        "Show another notebook, new file is a new empty notebook."
+        db = self.notebooks.open(path)
+        if db is self.db:
+            return
+        # Drop tasks of the current notebook and write what is queued,
+        # results still on the way are ignored
+        self.load_generation += 1
+        self.search_generation += 1
+        self.layout_generation += 1
+        self.duplicate_generation += 1
+        self.search_timer.stop()
+        self.duplicate_timer.stop()
+        self.search_pool.waitForDone()
+        self.write_queue.close()
+
+        self.db = db
+        self.fill_notebook_box()
+        self.start_write_queue()
+        self.notes_model.db = db
+        self.notes_model.start({})
+        self.search_bar.blockSignals(True)
+        self.search_bar.clear()
+        self.search_bar.blockSignals(False)
+        if self.graph_page is not None:
+            self.graph_view.clear()
+        self.stack.setCurrentWidget(self.main_page)
+        self.set_controls_enabled(False)
+        self.load_notebook()
+
+    def show_note_menu(self, pos):
+        index = self.notes_view.indexAt(pos)
+        if not index.isValid():
+            return
+        menu = QtWidgets.QMenu(self)
+        delete_action = menu.addAction("Delete")
+        action = menu.exec(self.notes_view.viewport().mapToGlobal(pos))
+
+        if action == delete_action:
+            self.confirm_delete_note(index.data(NOTE_ID_ROLE), index.data())
+
+    def show_single_note(self, index):
         "Show note to user; user can update note."
-        sender = self.sender()
-        self.editing_button = sender
-        self.create_note(
-            sender.title, sender.text, sender.tags,
-            sender.created_at, is_update=True
+        self.open_note(index.data(NOTE_ID_ROLE))
+
+    @timed
+    def open_note(self, note_id):
+        "Open note in the editor, from the grid or from the graph."
+        note = self.notes_model.notes.get(note_id)
+        if note is None:
+            # Graph shows notes the grid has not loaded
+            note = self.db.get_notes_by_ids([note_id]).get(note_id)
+            if note is None:
+                return
+        self.editing_note_id = note_id
+        # Grid has only previews, the body is read when it is opened.
+        # A queued edit is newer than the db.
+        queued = self.write_queue.queued_write(note_id)
+        if queued and queued[0] == UPDATE:
+            text = queued[3]
+        else:
+            text = self.db.get_note_text(note_id)
+        title, _, tags, created_at = note
+        self.create_note(title, text, tags, created_at, is_update=True)
+
+    def show_graph(self):
+        "Show graph of similar notes, laid out on the thread pool."
+        # NumPy is loaded with the first graph
+        from graph_view import GraphView, LayoutTask
+
+        if self.graph_page is None:
+            self.graph_page = QtWidgets.QWidget()
+            back_button = QtWidgets.QPushButton('← Back')
+            back_button.setObjectName('back_button')
+            back_button.clicked.connect(self.click_graph_back_button)
+            self.graph_status = QtWidgets.QLabel()
+            self.graph_view = GraphView()
+            self.graph_view.note_clicked.connect(self.open_note)
+
+            top = QtWidgets.QHBoxLayout()
+            top.addWidget(self.graph_status)
+            top.addStretch()
+            top.addWidget(back_button)
+            layout = QtWidgets.QVBoxLayout()
+            layout.addLayout(top)
+            layout.addWidget(self.graph_view)
+            self.graph_page.setLayout(layout)
+            self.stack.addWidget(self.graph_page)
+
+        # Notes may have changed since the last time
+        self.layout_generation += 1
+        self.graph_status.setText('Loading graph...')
+        task = LayoutTask(
+            self.db, self.layout_generation, lambda: self.layout_generation
         )
+        task.signals.progress.connect(self.on_layout_progress)
+        task.signals.finished.connect(self.on_graph_loaded)
+        self.search_pool.start(task)
+        self.stack.setCurrentWidget(self.graph_page)
+
+    def on_layout_progress(self, done, total):
+        self.graph_status.setText(f'Laying out notes: {done}/{total}')
+
+    def on_graph_loaded(self, generation, graph):
+        if generation != self.layout_generation:
+            return
+        self.graph_status.setText(f'{len(graph)} notes')
+        self.graph_view.set_graph(graph)
 
     def confirm_delete_note(self, note_id, title):
         reply = QtWidgets.QMessageBox.question(
@@ -191,85 +720,74 @@ class MainWindow(QtWidgets.QMainWindow):
         )
 
         if reply == QtWidgets.QMessageBox.StandardButton.Yes:
-            self.db.delete_note(note_id)
-
-            widget = self.note_widgets.pop(note_id)
-            self.notes_grid.removeWidget(widget)
-            widget.deleteLater()
-            self.notes.pop(note_id, None)
-            self.rebuild_grid(list(self.note_widgets.values()))
-
-    def fill_note_widgets(self):
-        "Fill note_widgets dict with widgets forming from notes."
-        notes_box, r, c = None, None, None
-        for i, note in enumerate(self.notes.items()):
-            note_id, (title, text, tags, created_at) = note
-            r, c = divmod(i, self.cols)
-            notes_box = self.adding_data_into_widget(note_id, title, text, tags, created_at)
-            self.note_widgets[note_id] = notes_box
-
-        self.rebuild_grid(list(self.note_widgets.values()))
-        return notes_box, r, c
-
-    def clean_grid_layout(self):
-        "Clear grid layout from all widgets."
-        for i in reversed(range(self.notes_grid.count())):
-            widget = self.notes_grid.itemAt(i).widget()
-            if widget:
-                self.notes_grid.removeWidget(widget)
-
-    def rebuild_grid(self, widgets):
-        "Reform grid layout after changing in notes_grid dict."
-        self.clean_grid_layout()
-
-        for i, w in enumerate(widgets):
-            r, c = divmod(i, self.cols)
-            self.notes_grid.addWidget(
-                w, r, c, alignment=QtCore.Qt.AlignmentFlag.AlignCenter
-            )
-
-    def refresh_notes(self, data):
-        "Reform grid layout after adding new data."
-        self.clean_grid_layout()
-
-        self.notes[data['note_id']] = (
-            data['title'], data['text'], data['tags'], data['created_at']
-        )
-
-        self.fill_note_widgets()
-
-    def update_display(self, search_input):
-        "Form widgets which satisfy user's input."
-        query = search_input.lower().strip()
+            self.write_queue.delete(note_id)
+            self.notes_model.remove_note(note_id)
+
+    def start_search(self):
+        "Search text of search bar on the thread pool."
+        # Any running search becomes stale
+        self.search_generation += 1
+        query = self.search_bar.text().strip()
         if not query:
-            for w in self.note_widgets.values():
-                w.setVisible(True)
-            self.rebuild_grid(list(self.note_widgets.values()))
+            self.notes_model.set_filter(None)
             return
 
-        visible_widgets = []
-        for widget in self.note_widgets.values():
-            title = widget.property('noteTitle').lower()
-            text = widget.property('noteText').lower()
-            preview = widget.property('noteText').lower()
-            tags = widget.property('noteTags') or []
-
-            is_match = (
-                query in title
-                or query in text
-                or query in preview
-                or any(query in t.lower() for t in tags)
-            )
+        task = SearchTask(
+            self.db, query, self.search_generation,
+            lambda: self.search_generation
+        )
+        task.signals.finished.connect(self.update_display)
+        self.search_pool.start(task)
 
-            widget.setVisible(is_match)
-            if is_match:
-                visible_widgets.append(widget)
+    @timed
+    def update_display(self, generation, found_ids):
+        "Show notes found by the latest search."
+        if generation != self.search_generation:
+            return
+        self.notes_model.set_filter(found_ids)
+
+    @timed
+    def on_write_done(self, write, note_id, note):
+        """Show the note saved by the writer thread, a new note as a
+        single new tile.
+        """
+        if self.sender() is not self.write_signals:
+            # Saved to the notebook open before
+            return
+        if write[0] == INSERT and note is not None:
+            self.notes_model.add_note(note_id, *note)
 
-        self.rebuild_grid(visible_widgets)
+    def on_write_failed(self, write, message):
+        QtWidgets.QMessageBox.warning(
+            self, 'Note is not saved',
+            f'Could not {write[0]} the note:\n{message}'
+        )
+        if write[0] != INSERT and self.sender() is self.write_signals:
+            # Tiles show the change which did not happen
+            self.notes_model.reload()
+
+    def closeEvent(self, event):
+        # Cancel search and layout, let them finish before db is closed
+        self.search_generation += 1
+        self.layout_generation += 1
+        self.duplicate_timer.stop()
+        self.search_pool.waitForDone()
+        # Nothing queued is lost
+        self.write_queue.close()
+        super().closeEvent(event)
 
     def create_note(
             self, title=None, text=None, tags=None, date=None, is_update=False
     ):
+        # Back to the grid or to the graph
+        self.return_page = self.stack.currentWidget()
+        if not is_update:
+            self.editing_note_id = None
+        # Results for the previous editor are dropped
+        self.duplicate_generation += 1
+        self.duplicate_query = None
+        self.duplicate_checked = None
+        self.save_when_checked = False
         self.create_window = QtWidgets.QWidget()
         self.stack.addWidget(self.create_window)
 
@@ -303,9 +821,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.tags = QtWidgets.QLineEdit()
         self.tags.setPlaceholderText('Enter note tags here')
         if tags:
-            self.tags.setText(', '.join(tag if tag else '' for tag in tags))
+            self.tags.setText(', '.join(tags))
         self.tags.setObjectName('tags_edit')
 
+        # Hint about near-identical saved notes
+        self.duplicate_label = QtWidgets.QLabel()
+        self.duplicate_label.setObjectName('duplicate_label')
+        self.duplicate_label.setWordWrap(True)
+        self.duplicate_label.hide()
+
         # Text field
         self.text = QtWidgets.QTextEdit()
         self.text.setPlaceholderText('Enter note text here')
@@ -325,6 +849,7 @@ class MainWindow(QtWidgets.QMainWindow):
         layout.addWidget(self.title)
         layout.addWidget(self.time_label)
         layout.addWidget(self.tags)
+        layout.addWidget(self.duplicate_label)
         layout.addWidget(self.text)
         # layout.addStretch()
         self.create_window.setLayout(layout)
@@ -339,6 +864,11 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.click_accept_and_save_button
             )
         self.back_button.clicked.connect(self.click_back_button)
+        self.title.textChanged.connect(self.duplicate_timer.start)
+        self.text.textChanged.connect(self.duplicate_timer.start)
+        if is_update:
+            # The note may already have a copy
+            self.duplicate_timer.start()
 
         self.stack.setCurrentWidget(self.create_window)
 
@@ -348,57 +878,108 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             self.title.setStyleSheet("font-size: 18px; font-weight: normal;")
 
+    def start_duplicate_check(self):
+        "Look for saved notes near-identical to the edited one."
+        self.duplicate_generation += 1
+        self.duplicate_query = (self.title.text(), self.text.toPlainText())
+        task = DuplicateTask(
+            self.db, *self.duplicate_query, self.editing_note_id,
+            self.duplicate_generation
+        )
+        task.signals.finished.connect(self.on_duplicates_found)
+        self.search_pool.start(task)
+
+    def on_duplicates_found(self, generation, found):
+        if generation != self.duplicate_generation:
+            return
+        self.show_duplicates(found, self.duplicate_query)
+        if self.save_when_checked:
+            # Save clicked before the hint was up to date
+            self.save_when_checked = False
+            if not found and self.stack.currentWidget() is self.create_window:
+                self.save_new_note(*self.duplicate_query)
+
+    def show_duplicates(self, found, query):
+        "Show or hide the hint, query is the (title, text) checked."
+        self.duplicate_checked = query
+        if not found:
+            self.duplicate_label.hide()
+            return
+        _, title, score = found[0]
+        hint = f'Similar note exists: "{title}", {score:.0%} alike'
+        if len(found) > 1:
+            hint += f', and {len(found) - 1} more'
+        self.duplicate_label.setText(hint)
+        self.duplicate_label.show()
+
     def click_accept_and_save_button(self):
         title = self.title.text()
         text = self.text.toPlainText()
         if not title and not text:
             return
+        if (title, text) != self.duplicate_checked:
+            # Hint is not up to date: check on the pool and save if
+            # nothing is found, the next click saves a duplicate. An
+            # edit meanwhile starts a new check and is saved with it.
+            self.duplicate_timer.stop()
+            self.save_when_checked = True
+            self.start_duplicate_check()
+            return
+        self.save_new_note(title, text)
+
+    def save_new_note(self, title, text):
+        "Queue the new note and go back to the grid."
         note = {
                 'title': title,
                 'text': text,
-                'tags': rsplit(r'[,|\s|,\s]', self.tags.text()),
+                'tags': normalize_tags(self.tags.text()),
                 'created_at': None
         }
-        adding_data_and_get_id = self.db.insert_data_in_tables(
-            note['title'], note['text'], note['tags']
-        )
-        note['note_id'] = adding_data_and_get_id
-        self.refresh_notes(note)
-        self.stack.setCurrentWidget(self.scroll_main_window)
+        # Tile is added when the writer thread reports the id
+        self.write_queue.insert(note['title'], note['text'], note['tags'])
+        self.stack.setCurrentWidget(self.main_page)
 
     def click_accept_and_update_button(self):
-        button = self.editing_button
+        note_id = self.editing_note_id
         note = {
                 'title': self.title.text(),
                 'text': self.text.toPlainText(),
-                'tags': rsplit(r'[, |,|\s|,\s]', self.tags.text()),
+                'tags': normalize_tags(self.tags.text()),
                 'created_at': self.time_label.text()
         }
-        self.db.update_data(
-            button.note_id, note['title'], note['text'], note['tags']
+        self.write_queue.update(
+            note_id, note['title'], note['text'], note['tags']
         )
 
         # ADD GETTING DATA FROM DB for consistency?
-        button.title = note['title']
-        button.text = note['text']
-        button.tags = note['tags']
-        button.created_at = note['created_at']
-        button.setText(f"{button.title}\n\n{button.text}")
+        self.notes_model.update_note(
+            note_id, note['title'], make_preview(note['text']), note['tags'],
+            note['created_at']
+        )
 
-        self.stack.setCurrentWidget(self.scroll_main_window)
+        self.stack.setCurrentWidget(self.return_page)
 
     def click_back_button(self):
-        self.stack.setCurrentWidget(self.scroll_main_window)
+        self.stack.setCurrentWidget(self.return_page)
 
-    def load_notes_from_db(self) -> dict:
-        data = self.db.get_all_data_from_db()
-        return data
+    def click_graph_back_button(self):
+        self.stack.setCurrentWidget(self.main_page)
 
 
 if __name__ == '__main__':
-    db = ManageDb()
-    db.create_tables() # Later hide this in some script
+    started_at = time.perf_counter()
+    # Notebooks of the last session, or the one given as argument
+    paths, current = load_list()
+    if len(sys.argv) > 1:
+        current = sys.argv[1]
+    notebooks = Notebooks(paths)
+    db = notebooks.open(current)
     app = QtWidgets.QApplication(sys.argv)
     app.setStyleSheet(Path('style.qss').read_text())
-    window = MainWindow(db)
-    app.exec()
+    with instrumentation.profile_session():
+        # Tables are created by LoadTask
+        window = MainWindow(db, started_at=started_at, notebooks=notebooks)
+        app.exec()
+    window.write_queue.close()
+    save_list(notebooks.paths, window.db.db_name)
+    notebooks.close()
@@ -0,0 +1,144 @@
+"""Write-behind queue: one thread owns all note writes.
+
+The GUI puts writes in the queue and goes on. The writer thread waits
+BATCH_DELAY_S after the first pending write to gather a burst, then
+applies all pending writes with ManageDb.write_batch() in a single
+transaction. Writes of the same note collapse while they wait: only
+the last update is written, and a delete drops the update before it.
+
+Results are reported with callbacks called from the writer thread:
+on_done(write, note_id) and on_error(write, message). A write which
+fails, with sqlite3.Error or any other exception, is reported and the
+thread goes on with the next ones.
+"""
+import atexit
+import threading
+import time
+from itertools import count
+
+from models import DELETE, INSERT, UPDATE
+
+BATCH_DELAY_S = 0.05
+
+
+class WriteQueue:
+    "Queue of note writes applied in batches by a writer thread."
+    def __init__(
+            self, db, on_done=None, on_error=None, batch_delay=BATCH_DELAY_S
+    ):
+        self.db = db
+        self.on_done = on_done
+        self.on_error = on_error
+        self.batch_delay = batch_delay
+        # Pending writes in order, key is the note id or a ticket
+        # for new notes
+        self.pending = {}
+        self.tickets = count(1)
+        # Writes taken by the thread and not committed yet
+        self.in_flight = {}
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.run, name='topaz-writer', daemon=True
+        )
+        self.thread.start()
+        # Daemon thread is not waited for, flush it explicitly
+        atexit.register(self.close)
+
+    def put(self, key, write):
+        with self.condition:
+            if self.closing:
+                raise RuntimeError('Write queue is closed')
+            # Replaced write keeps its place in the order
+            self.pending[key] = write
+            self.condition.notify_all()
+
+    def insert(self, title, text, tags):
+        self.put(('new', next(self.tickets)), (INSERT, title, text, tags))
+
+    def update(self, note_id, title, text, tags):
+        self.put(note_id, (UPDATE, note_id, title, text, tags))
+
+    def delete(self, note_id):
+        self.put(note_id, (DELETE, note_id))
+
+    def queued_write(self, note_id):
+        "Latest write of the note not committed yet, or None."
+        with self.condition:
+            return self.pending.get(note_id) or self.in_flight.get(note_id)
+
+    def take_batch(self) -> list:
+        "Wait for writes and return all of them, [] when closed."
+        with self.condition:
+            while not self.pending and not self.closing:
+                self.condition.wait()
+            # More edits often follow
+            deadline = time.monotonic() + self.batch_delay
+            while not self.closing:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            batch = list(self.pending.values())
+            self.in_flight, self.pending = self.pending, {}
+            return batch
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            if not batch:
+                if self.closing:
+                    return
+                continue
+            try:
+                self.apply(batch)
+            except Exception as e:
+                # Only a callback can get here, the writer goes on
+                print(f'Error occured: \n {e}')
+            finally:
+                with self.condition:
+                    self.in_flight = {}
+                    self.condition.notify_all()
+
+    def apply(self, batch):
+        try:
+            results = self.db.write_batch(batch)
+        except Exception:
+            # Not only sqlite3.Error: a malformed write must not stop
+            # the thread. Find the failing writes, write the rest one
+            # by one
+            for write in batch:
+                self.apply_one(write)
+            return
+        for write, note_id in zip(batch, results):
+            self.report_done(write, note_id)
+
+    def apply_one(self, write):
+        try:
+            note_id = self.db.write_batch([write])[0]
+        except Exception as e:
+            print(f'Error occured: \n {e}')
+            if self.on_error:
+                self.on_error(write, str(e))
+            return
+        self.report_done(write, note_id)
+
+    def report_done(self, write, note_id):
+        if self.on_done:
+            self.on_done(write, note_id)
+
+    def flush(self, timeout=None) -> bool:
+        "Wait until every queued write is committed."
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not self.pending and not self.in_flight, timeout
+            )
+
+    def close(self):
+        "Write what is left and stop the thread. Safe to call twice."
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+        atexit.unregister(self.close)